@@ -19,25 +19,83 @@ from future.builtins.disabled import *  # noqa: F401,F403; pylint: disable=redef
 
 # ---- Imports -----------------------------------------------------------
 
-from datetime import datetime
-from logging import ERROR
-from os import linesep
+from datetime import (
+    datetime,
+    timedelta,
+    tzinfo,
+)
+from logging import (
+    ERROR,
+    getLogger,
+)
+from os import (
+    environ,
+    getpid,
+    linesep,
+    makedirs,
+    rename,
+)
+from os.path import (
+    expanduser,
+    isdir,
+    join as ospath_join,
+)
 from traceback import (
     format_exception,
     format_stack,
 )
-from dateutil.tz import tzutc
-from humanize import naturaltime as _naturaltime
 from sys import exc_info
 
+# ---- Classes -----------------------------------------------------------
+
+# ========================================================================
+class _Utc(tzinfo):
+    """
+    A minimal UTC :class:`~datetime.tzinfo` so that :mod:`dateutil` need
+    not be imported just to build timezone-aware :class:`datetime`
+    objects.
+    """
+
+    # ---- Public hooks --------------------------------------------------
+
+    def __repr__(self):
+        return '{}()'.format(type(self).__name__)
+
+    def dst(self, dt):  # pylint: disable=unused-argument
+        return _ZERO
+
+    def tzname(self, dt):  # pylint: disable=unused-argument
+        return 'UTC'
+
+    def utcoffset(self, dt):  # pylint: disable=unused-argument
+        return _ZERO
+
 # ---- Constants ---------------------------------------------------------
 
 __all__ = ()
 
-TZ_UTC = tzutc()
+_LOGGER = getLogger(__name__.lstrip('_'))
+_PROBES = {}
+_ZERO = timedelta(0)
+TZ_UTC = _Utc()
 
 # ---- Exceptions --------------------------------------------------------
 
+# ========================================================================
+class LayerDigestMismatch(Exception):
+    """
+    Raised while retrieving layers if the SHA-256 digest of a layer's
+    contents does not match the one recorded for it in the image's
+    configuration (usually indicative of corruption in transit).
+    """
+
+# ========================================================================
+class SpoolLimitExceeded(Exception):
+    """
+    Raised while retrieving layers if spooling the next one would exceed
+    the spool's size limit (see :class:`~_dimgx.sources.LayerSpool`).
+    """
+
 # ========================================================================
 class UnsafeTarPath(Exception):
     """
@@ -48,6 +106,52 @@ class UnsafeTarPath(Exception):
 
 # ---- Functions ---------------------------------------------------------
 
+# ========================================================================
+def cachedprobe(name, key, probe):
+    """
+    Returns the result of calling :obj:`probe` (which must be
+    JSON-serializable), consulting (and updating) a small on-disk record
+    named :obj:`name` in :func:`usercachedir` keyed by :obj:`key`. Any
+    failure to read or write the record is logged and ignored.
+    """
+    from json import (
+        dump as json_dump,
+        load as json_load,
+    )
+
+    probes = _PROBES.get(name)
+    cache_path = ospath_join(usercachedir(), '{}.json'.format(name))
+
+    if probes is None:
+        try:
+            with open(cache_path) as cache_file:
+                probes = json_load(cache_file)
+        except (EnvironmentError, ValueError):
+            probes = {}
+
+        _PROBES[name] = probes
+
+    try:
+        return probes[key]
+    except KeyError:
+        pass
+
+    probes[key] = result = probe()
+    tmp_path = '{}.{}'.format(cache_path, getpid())
+
+    try:
+        if not isdir(usercachedir()):
+            makedirs(usercachedir())
+
+        with open(tmp_path, 'w') as tmp_file:
+            json_dump(probes, tmp_file)
+
+        rename(tmp_path, cache_path)
+    except EnvironmentError as e:
+        _LOGGER.debug('unable to record probe "%s": %s', name, e)
+
+    return result
+
 # ========================================================================
 def logexception(*args, **kw):
     return _logexception(*args, **kw)
@@ -62,8 +166,24 @@ def naturaltime(value, future=False, months=True):
 
         value = now - value
 
+    from humanize import naturaltime as _naturaltime
+
     return _naturaltime(value, future, months)
 
+# ========================================================================
+def usercachedir():
+    """
+    Returns the directory in which ``dimgx`` keeps per-user state (e.g.,
+    probe results), which is :envvar:`DIMGX_CACHE_DIR` if set, otherwise
+    ``dimgx`` in :envvar:`XDG_CACHE_HOME` (or ``~/.cache``).
+    """
+    cache_dir = environ.get('DIMGX_CACHE_DIR')
+
+    if cache_dir:
+        return cache_dir
+
+    return ospath_join(environ.get('XDG_CACHE_HOME') or expanduser(ospath_join('~', '.cache')), 'dimgx')
+
 # ========================================================================
 def _debugtrace(logger, lvl, msg, last_type, last_value, last_tb):
     logger.log(lvl, msg)
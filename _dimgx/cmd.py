@@ -24,8 +24,16 @@ from argparse import (
     ArgumentTypeError,
 )
 from collections import OrderedDict
-from errno import errorcode
-from functools import wraps
+from contextlib import contextmanager
+from errno import (
+    EEXIST,
+    ENOENT,
+    errorcode,
+)
+from functools import (
+    partial,
+    wraps,
+)
 from logging import (
     DEBUG,
     ERROR,
@@ -44,11 +52,19 @@ from os import (
     environ,
     fdopen,
     fstat,
+    listdir,
     lseek,
+    lstat,
     open as os_open,
+    unlink,
 )
 from os.path import (
     extsep as ospath_extsep,
+    isdir,
+    isfile,
+    join as ospath_join,
+    lexists,
+    realpath,
     splitext as ospath_splitext,
 )
 from re import (
@@ -59,15 +75,29 @@ from stat import S_ISREG
 from sys import (
     argv as sys_argv,
     exit as sys_exit,
+    stderr,
     stdout,
 )
-from tarfile import open as tarfile_open
-from docker import AutoVersionClient
-from docker.utils import kwargs_from_env
-from humanize import naturalsize
 from dimgx import (
+    ArchiveCache,
+    ArchiveIndexer,
+    BlockGzipFile,
+    DigestingFile,
+    DirectoryWriter,
+    GraphDriverClient,
+    LayerGraph,
+    OciLayoutWriter,
+    PrefetchingClient,
+    SavedImageClient,
+    analyzeimages,
+    catpath as dimgx_catpath,
+    diffimages,
+    extractdelta,
     inspectlayers,
+    loadlayers,
+    extractimages as dimgx_extractimages,
     extractlayers as dimgx_extractlayers,
+    extractloadable as dimgx_extractloadable,
     patch_broken_tarfile_29760,
 )
 from _dimgx import (
@@ -87,10 +117,14 @@ _LOGGER = getLogger(__name__.lstrip('_'))
 _LAYER_RE_STR = r'(?:[0-9A-Fa-f]{1,64})'
 _LAYER_SPEC_RE = re_compile(r'^(?P<l>{layer_re})(?::(?P<r>{layer_re}))?$'.format(layer_re=_LAYER_RE_STR), IGNORECASE)
 _TARGET_STDOUT = '-'
+_INDEX_SUFFIX = '.index.json'
+_RECORD_SUFFIX = '.layers.json'
+_OCI_CONFIG_KEYS = ( 'Cmd', 'Entrypoint', 'Env', 'ExposedPorts', 'Labels', 'StopSignal', 'User', 'Volumes', 'WorkingDir' )
 _CMP_BZIP2 = 'bz2'
 _CMP_GZIP = 'gz'
 _CMP_NONE = None
 _DEFAULT_CMP_LVL = 9
+_DEFAULT_CACHE_SIZE_MB = 4096
 _DEFAULT_LOG_FMT = '%(levelname)-8s: %(message)s'
 _LOG_LEVELS_BY_NAME = OrderedDict(( ( logging_getLevelName(l), l ) for l in ( ERROR, WARNING, INFO, DEBUG ) ))
 _DEFAULT_LOG_LVL = logging_getLevelName(WARNING)
@@ -99,6 +133,11 @@ _EXIT_LAYER_SPEC = 3
 
 _USAGE = """
 %(prog)s [options] [-l LAYER_SPEC] ... [-t PATH] IMAGE_SPEC
+%(prog)s [options] [-l LAYER_SPEC] ... [-t PATH_TEMPLATE] IMAGE_SPEC IMAGE_SPEC ...
+%(prog)s [options] -a
+%(prog)s [options] -d BASE_SPEC [-t PATH] IMAGE_SPEC
+%(prog)s [options] [-l LAYER_SPEC] ... --load [--tag REPO_TAG] ... IMAGE_SPEC
+%(prog)s [options] [-l LAYER_SPEC] ... --cat PATH IMAGE_SPEC
 %(prog)s -h # for help
 """
 
@@ -120,9 +159,48 @@ Layers are extracted in order, which means that files from layers specified late
 Ordering is resolved before retrieval so that each distinct layer is only extracted once.
 """
 
+_ANALYSIS_GROUP_DESCRIPTION = """
+With -a, IMAGE_SPEC is omitted, and every image on the host is analyzed at once.
+REFS is the number of tagged images whose chains include a layer.
+EXCLUSIVE is (for a tagged image) the size of the layers used by no other tagged image, or (for an untagged leaf) the size of its chain not used by any tagged image.
+"""
+
+_DIFF_GROUP_DESCRIPTION = """
+With -d, the flattened contents of IMAGE_SPEC are compared with those of BASE_SPEC without extracting either, one line per changed path: "A" (only in IMAGE_SPEC), "D" (only in BASE_SPEC), or "M" (followed by what differs).
+If a target is provided (with -t), a single delta layer is written instead, which (applied on top of BASE_SPEC) results in IMAGE_SPEC, with whiteouts for removed paths.
+Only layers above the images' common ancestor are examined in full.
+"""
+
+_LOAD_GROUP_DESCRIPTION = """
+With --load, the specified layers are squashed into a new single-layer image, which is streamed directly to Docker (as "docker load" would) without writing anything to disk, and its ID is written to STDOUT.
+With --loadable, such an image is written to the target (with -t) instead, which can be loaded later with "docker load".
+"""
+
+_CACHE_GROUP_DESCRIPTION = """
+With --cache, each archive written (with -t) is also kept in DIR, keyed by the selected layers and the options that affect its contents, and writing the same archive again is just a matter of copying (or, with --cache-link, hard linking) the cached one.
+Once the cached archives exceed the cache's size, the least recently used ones are removed.
+"""
+
+_SPOOL_GROUP_DESCRIPTION = """
+Layers retrieved from the Docker daemon (or from a compressed archive) are spooled so that they can be read in any order.
+Without -l (and without --previous or --cache), all of IMAGE_SPEC's layers are needed, so retrieving them from the Docker daemon starts while IMAGE_SPEC is still being inspected.
+With --spool-memory, layers are held in memory for as long as they fit within MB in total, and the rest are written to a temporary directory in DIR (e.g., a tmpfs) with --spool-dir, or in the default temporary directory otherwise.
+With --spool-limit, retrieval stops with an error before the spooled layers would exceed MB in total.
+With --spool-persist, layers are written to DIR itself and kept there (along with a record of which ones are complete), so that running again after an interrupted transfer only retrieves the layers still missing; with --retries, a failed retrieval is retried in the same way up to NUM times before giving up.
+"""
+
 _TARGET_GROUP_DESCRIPTION = """
 If no target is provided, information about the specified layers is written to STDOUT, one line per layer.
 If a target is provided, the specified layers will be extracted and written to the target as a tar archive.
+If a target directory is provided instead, the flattened files are written into it directly (using several threads).
+If an OCI directory is provided instead, an OCI image layout is written there with the flattened files as its single (gzip-compressed) layer, ready to be pushed to a registry (e.g., with skopeo).
+With more than one IMAGE_SPEC, each image is written to its own target, where "{image}" (the IMAGE_SPEC, with any "/" replaced by "_") and "{short_id}" (the abbreviated ID of the top-most selected layer) in PATH_TEMPLATE are replaced accordingly (e.g., "-t {image}.tar").
+Layers shared among the images are retrieved only once, and images are flattened concurrently.
+With --cat, layers are searched from the top-most down only until the one providing PATH (or hiding it) is found, and only that file is read.
+With --include or --exclude, only the matching files (and the directories leading to them) are written, and excluded subtrees are skipped without reading their contents; in a glob, "*", "?", and "[...]" never match "/", but "**" does.
+With --index, an index of where each member of the archive starts (and, with -z, of the archive's compressed blocks) is written alongside it as JSON (see ArchiveIndexer and BlockGzipFile in the documentation), so that members can be read without scanning the archive.
+With --previous, if the selected layers are those recorded for PREV_PATH (with --record) with newer ones on top, only the newer layers are read and applied to PREV_PATH's contents, which is much faster than flattening every layer again (the result is the same).
+With --verify, each layer's digest is checked against the image's configuration as it is retrieved (or, with --archive, when it is first read; --verify cannot be combined with --graph-root), and the SHA-256 digest of each archive written is printed to STDERR (in the format used by sha256sum).
 """
 
 # ---- Decorators --------------------------------------------------------
@@ -144,7 +222,13 @@ def exitonraise(f):
 def buildparser(cls=ArgumentParser):
     parser = cls(description=_DESCRIPTION, epilog=_EPILOG, usage=_USAGE)
     parser.add_argument('-V', '--version', action='version', version='%(prog)s {}'.format(__release__))
-    parser.add_argument('image', help='the name or ID of the Docker image', metavar='IMAGE_SPEC')
+    parser.add_argument('image', help='the name or ID of the Docker image', metavar='IMAGE_SPEC', nargs='?')
+    parser.add_argument('more_images', help='the names or IDs of additional Docker images to extract (each to its own target)', metavar='IMAGE_SPEC', nargs='*')
+
+    source_group = parser.add_argument_group()
+    source_group.add_argument('--archive', action='store', help='read images from an archive created with "docker save" (optionally compressed) instead of from the Docker daemon', metavar='PATH')
+    source_group.add_argument('--graph-root', action='store', help='read images directly from the Docker daemon\'s storage in its root directory (e.g., /var/lib/docker) instead of via its API', metavar='PATH')
+    source_group.add_argument('--graph-driver', choices=( 'overlay2', 'aufs' ), help='with --graph-root, the storage driver (defaults to whichever is present)')
 
     layer_group = parser.add_argument_group(description=_LAYER_GROUP_DESCRIPTION)
     layer_group.add_argument('-l', '--layers', action='append', help='the selected layer(s) (defaults to all layers in ascending order)', metavar='LAYER_SPEC', type=layertype)
@@ -153,13 +237,52 @@ def buildparser(cls=ArgumentParser):
     layer_group.add_argument('-s', '--strict', action='store_true', dest='strict', help='treat any layer specification that doesn\'t reference at least one known layer as an error')
     layer_group.add_argument('-S', '--no-strict', action='store_false', dest='strict', help='ignore any layer specification that doesn\'t reference a known layer (default))')
 
+    analysis_group = parser.add_argument_group(description=_ANALYSIS_GROUP_DESCRIPTION)
+    analysis_group.add_argument('-a', '--all', action='store_true', dest='all', help='analyze layer sharing among all images on the host instead of inspecting IMAGE_SPEC')
+    analysis_group.add_argument('--json', action='store_true', dest='json', help='with -a or -d, write the results as JSON rather than as a table')
+
+    diff_group = parser.add_argument_group(description=_DIFF_GROUP_DESCRIPTION)
+    diff_group.add_argument('-d', '--diff', action='store', help='compare IMAGE_SPEC with BASE_SPEC instead of inspecting it', metavar='BASE_SPEC')
+    diff_group.add_argument('--digests', action='store_true', dest='digests', help='with -d, also compare the contents of regular files (which requires reading them)')
+
+    load_group = parser.add_argument_group(description=_LOAD_GROUP_DESCRIPTION)
+    load_group.add_argument('--load', action='store_true', dest='load', help='load the squashed image into Docker instead of writing it to a target')
+    load_group.add_argument('--loadable', action='store_true', dest='loadable', help='write the target as a "docker load"-able image archive rather than a plain archive')
+    load_group.add_argument('--tag', action='append', dest='tags', help='with --load or --loadable, tag the squashed image (e.g., "nifty-box:squashed")', metavar='REPO_TAG')
+
     target_group = parser.add_argument_group(description=_TARGET_GROUP_DESCRIPTION)
     target_group.add_argument('-t', '--target', action='store', help='the path to which to write the archive ("{}" for STDOUT)'.format(_TARGET_STDOUT.replace('%', '%%')), metavar='PATH')
+    target_group.add_argument('--target-dir', action='store', help='the directory into which to write the flattened files directly (rather than to an archive)', metavar='PATH')
+    target_group.add_argument('--oci-dir', action='store', help='the directory in which to write (or to which to add) an OCI image layout with the flattened files as its single layer (rather than an archive)', metavar='PATH')
     target_group.add_argument('-q', '--quiet', action='store_true', dest='quiet', help='when no target is specified, print only the image IDs')
     target_group.add_argument('-Q', '--no-quiet', action='store_false', dest='quiet', help='when no target is specified, print the image IDs with additional information in a table (default)')
+    target_group.add_argument('--cat', action='store', help='write the contents of the file at PATH in the flattened layers to STDOUT (rather than extracting them all)', metavar='PATH')
+    target_group.add_argument('--include', action='append', dest='includes', help='extract only PATTERN (a path or glob, e.g., "etc" or "usr/lib/python*") and what is beneath it (may be given more than once)', metavar='PATTERN')
+    target_group.add_argument('--exclude', action='append', dest='excludes', help='don\'t extract PATTERN (a path or glob, e.g., "**/*.pyc") or what is beneath it, even if included (may be given more than once)', metavar='PATTERN')
+    target_group.add_argument('--workers', default=None, help='with more than one IMAGE_SPEC, the number of images to flatten concurrently (defaults to the number of CPUs)', metavar='NUM', type=int)
+    target_group.add_argument('--index', action='store_true', dest='index', help='also write an index of the archive\'s members to PATH.index.json (with -z, compressing the archive in independently decompressible blocks)')
+    target_group.add_argument('--record', action='store_true', dest='record', help='also record the layers flattened into the archive in PATH.layers.json (for use with --previous)')
+    target_group.add_argument('--previous', action='store', help='build on PREV_PATH (an archive previously written with --record), reading only the layers added since', metavar='PREV_PATH')
+    target_group.add_argument('--reproducible', action='store_true', dest='reproducible', help='write entries in sorted order with normalized metadata, so that the same layers always produce the same archive')
+    target_group.add_argument('--clamp-mtime', default=None, help='with --reproducible, replace modification times later than EPOCH (in seconds since the epoch) with it (defaults to $SOURCE_DATE_EPOCH, if set)', metavar='EPOCH', type=int)
+    target_group.add_argument('--dedupe', action='store_true', dest='dedupe', help='write regular files that duplicate ones already written (in both contents and metadata) as hard links to them')
+    target_group.add_argument('--sparse', action='store_true', dest='sparse', help='write sparse files as sparse entries (or, with --target-dir, as sparse files) rather than filling in their holes')
+    target_group.add_argument('--verify', action='store_true', dest='verify', help='verify the digest of each layer as it is retrieved and print the digest of each target archive')
     target_group.add_argument('-w', '--force', action='store_true', dest='force', help='overwrite the target archive if it already exists')
     target_group.add_argument('-W', '--no-force', action='store_false', dest='force', help='don\'t overwrite the target archive if it already exists (default)')
 
+    cache_group = parser.add_argument_group(description=_CACHE_GROUP_DESCRIPTION)
+    cache_group.add_argument('--cache', action='store', help='the directory in which to cache archives', metavar='DIR')
+    cache_group.add_argument('--cache-size', default=_DEFAULT_CACHE_SIZE_MB, help='with --cache, the most the cached archives may take up in total (defaults to {})'.format(_DEFAULT_CACHE_SIZE_MB), metavar='MB', type=int)
+    cache_group.add_argument('--cache-link', action='store_true', dest='cache_link', help='with --cache, hard link targets to cached archives rather than copying them (the targets must not be modified in place)')
+
+    spool_group = parser.add_argument_group(description=_SPOOL_GROUP_DESCRIPTION)
+    spool_group.add_argument('--spool-dir', action='store', help='the directory in which to spool retrieved layers (defaults to the default temporary directory)', metavar='DIR')
+    spool_group.add_argument('--spool-memory', default=0, help='the most the layers spooled in memory may take up in total (defaults to 0)', metavar='MB', type=int)
+    spool_group.add_argument('--spool-limit', default=None, help='the most the spooled layers may take up in total (defaults to no limit)', metavar='MB', type=int)
+    spool_group.add_argument('--spool-persist', action='store_true', dest='spool_persist', help='with --spool-dir, keep the spooled layers in DIR for later runs (which only retrieve what is missing) rather than removing them')
+    spool_group.add_argument('--retries', default=0, help='retry a failed retrieval up to NUM times, asking only for the layers still missing (defaults to 0)', metavar='NUM', type=int)
+
     compress_group = parser.add_argument_group()
     compress_group.add_argument('-j', '--bzip2', action='store_const', const=_CMP_BZIP2, dest='compression', help='compress the target archive with bzip2 compression')
     compress_group.add_argument('-z', '--gzip', action='store_const', const=_CMP_GZIP, dest='compression', help='compress the target archive with gzip compression')
@@ -172,9 +295,315 @@ def buildparser(cls=ArgumentParser):
 
     return parser
 
+# ========================================================================
+def catpath(dc, args, layers, top_most_layer_id, outfile=None):
+    outfile = getattr(stdout, 'buffer', stdout) if outfile is None else outfile
+    found = dimgx_catpath(dc, layers, args.cat, outfile, top_most_layer_id, args.verify, spoolopts(args))
+
+    if found is None:
+        exc = IOError(ENOENT, 'no such file in the selected layers')
+        logexception(_LOGGER, ERROR, 'unable to read "{}": {{e}}'.format(args.cat), exc)
+
+    _, info = found
+
+    if not info.isreg() \
+            and not info.islnk():
+        exc = ValueError('not a regular file' if not info.issym() else 'a symbolic link to "{}"'.format(info.linkname))
+        logexception(_LOGGER, ERROR, 'unable to read "{}": {{e}}'.format(args.cat), exc)
+
+    outfile.flush()
+
+# ========================================================================
+def dockerclient():
+    # docker-py (and requests with it) is by far the most expensive thing
+    # we import, so wait until we know we need it
+    from docker import AutoVersionClient
+    from docker.utils import kwargs_from_env
+    dc_kw = kwargs_from_env()
+
+    # TODO: hack to work around github:docker/docker-py#706
+    if DOCKER_TLS_VERIFY == '0':
+        dc_kw['tls'].assert_hostname = False
+
+    return AutoVersionClient(**dc_kw)
+
+# ========================================================================
+def extractimages(dc, args, selections):
+    jobs = []
+    target_paths = set()
+
+    for image_spec, top_most_layer_id, selected_layers in selections:
+        target_path = targetpath(targetarg(args), image_spec, top_most_layer_id)
+
+        if target_path in target_paths:
+            exc = ValueError('"{}" is the target for more than one image (use "{{image}}" or "{{short_id}}" in the target)'.format(target_path))
+            logexception(_LOGGER, ERROR, 'unable to extract "{}": {{e}}'.format(image_spec), exc)
+
+        target_paths.add(target_path)
+        jobs.append(( selected_layers, partial(opentarget, args, target_path, image_spec, ociconfig(dc, args, image_spec)), top_most_layer_id ))
+
+    # Do this once up front rather than racing to do it in each worker
+    patch_broken_tarfile_29760()
+    dimgx_extractimages(dc, jobs, args.workers, args.verify, args.includes, args.excludes, args.reproducible, args.clamp_mtime, args.dedupe, args.sparse, spoolopts(args))
+
 # ========================================================================
 def extractlayers(dc, args, layers, top_most_layer_id):
-    target_path = args.target
+    target_path = targetarg(args)
+    cache, cache_key = opencache(args, layers)
+
+    if cache is not None \
+            and ( args.force or not lexists(target_path) ) \
+            and logexception(_LOGGER, ERROR, 'unable to write "{}" from the cache: {{e}}'.format(target_path), cache.fetch, cache_key, target_path):
+        _LOGGER.info('wrote "%s" from the cache', target_path)
+
+        if args.verify:
+            from hashlib import sha256
+            hash_obj = sha256()
+
+            with open(target_path, 'rb') as target_file:
+                for chunk in iter(lambda: target_file.read(1 << 20), b''):
+                    hash_obj.update(chunk)
+
+            print('{}  {}'.format(hash_obj.hexdigest(), target_path), file=stderr)
+    else:
+        config = ociconfig(dc, args, args.image)
+
+        with opentarget(args, target_path, args.image, config) as tar_file:
+            if args.loadable:
+                dimgx_extractloadable(dc, layers, tar_file, args.tags or (), top_most_layer_id, config, args.verify, args.includes, args.excludes, args.reproducible, args.clamp_mtime, args.sparse, spoolopts(args))
+            else:
+                dimgx_extractlayers(dc, layers, tar_file, top_most_layer_id, args.verify, args.includes, args.excludes, readrecord(args), args.reproducible, args.clamp_mtime, args.dedupe, args.sparse, spoolopts(args))
+
+        if cache is not None:
+            logexception(_LOGGER, ERROR, 'unable to cache "{}": {{e}}'.format(target_path), cache.store, cache_key, target_path)
+
+    if args.record:
+        writerecord(args, target_path, layers)
+
+# ========================================================================
+def layerspec2index(args, graph, top_most_layer_id, layer_spec_part):
+    # Returns the index in top_most_layer_id's chain of the layer
+    # layer_spec_part resolves to among top_most_layer_id and its ancestors
+    if layer_spec_part is None:
+        return None
+
+    layer_ids = graph.matches(layer_spec_part, within=top_most_layer_id)
+
+    if len(layer_ids) == 1:
+        return graph.depth(top_most_layer_id) - graph.depth(layer_ids[0])
+
+    no_layer_msg = '"%s" does not resolve to any layer associated with image "%s"'
+
+    if args.strict:
+        _LOGGER.error(no_layer_msg, layer_spec_part, args.image)
+        sys_exit(_EXIT_LAYER_SPEC)
+
+    _LOGGER.warning(no_layer_msg, layer_spec_part, args.image)
+
+    return None
+
+# ========================================================================
+def layertype(value):
+    matches = _LAYER_SPEC_RE.search(value)
+
+    if not matches:
+        raise ArgumentTypeError('"{}" is not a valid LAYER_SPEC'.format(value))
+
+    return ( matches.group('l'), matches.group('r'), value )
+
+# ========================================================================
+def main():
+    import _dimgx
+    _dimgx._logexception = exitonraise(_dimgx._logexception)  # WARNING: monkey patch; pylint: disable=protected-access
+    parser = buildparser()
+    args = parser.parse_args(sys_argv[1:])
+
+    if args.all:
+        if args.image is not None or args.layers or targetarg(args) is not None:
+            parser.error('-a cannot be combined with IMAGE_SPEC, -l, -t, --target-dir, or --oci-dir')
+    elif args.image is None:
+        parser.error('IMAGE_SPEC is required (unless -a is given)')
+    elif args.more_images \
+            and args.target == _TARGET_STDOUT:
+        parser.error('more than one IMAGE_SPEC cannot be written to "{}"'.format(_TARGET_STDOUT))
+
+    if len([ t for t in ( args.target, args.target_dir, args.oci_dir ) if t is not None ]) > 1:
+        parser.error('-t, --target-dir, and --oci-dir cannot be combined')
+
+    if args.diff is not None \
+            and ( args.all or args.more_images or args.layers or args.target_dir is not None or args.oci_dir is not None ):
+        parser.error('-d cannot be combined with -a, more than one IMAGE_SPEC, -l, --target-dir, or --oci-dir')
+
+    if args.load \
+            and ( args.all or args.more_images or args.diff is not None or targetarg(args) is not None ):
+        parser.error('--load cannot be combined with -a, more than one IMAGE_SPEC, -d, -t, --target-dir, or --oci-dir')
+
+    if args.loadable \
+            and ( args.target is None or args.more_images or args.diff is not None or args.load ):
+        parser.error('--loadable requires -t and cannot be combined with more than one IMAGE_SPEC, -d, or --load')
+
+    if args.tags \
+            and not ( args.load or args.loadable ):
+        parser.error('--tag requires --load or --loadable')
+
+    if args.cat is not None \
+            and ( args.all or args.more_images or args.diff is not None or args.load or targetarg(args) is not None or args.includes or args.excludes ):
+        parser.error('--cat cannot be combined with -a, more than one IMAGE_SPEC, -d, --load, -t, --target-dir, --oci-dir, --include, or --exclude')
+
+    if ( args.includes or args.excludes ) \
+            and ( args.diff is not None or not ( args.load or targetarg(args) is not None ) ):
+        parser.error('--include and --exclude require a target (or --load) and cannot be combined with -d')
+
+    if args.reproducible \
+            and ( args.diff is not None or not ( args.load or targetarg(args) is not None ) ):
+        parser.error('--reproducible requires a target (or --load) and cannot be combined with -d')
+    elif args.reproducible \
+            and args.clamp_mtime is None \
+            and environ.get('SOURCE_DATE_EPOCH'):
+        try:
+            args.clamp_mtime = int(environ['SOURCE_DATE_EPOCH'])
+        except ValueError:
+            parser.error('SOURCE_DATE_EPOCH must be a whole number of seconds')
+    elif not args.reproducible \
+            and args.clamp_mtime is not None:
+        parser.error('--clamp-mtime requires --reproducible')
+
+    if args.dedupe \
+            and ( targetarg(args) is None or args.diff is not None or args.loadable or args.previous is not None ):
+        parser.error('--dedupe requires -t, --target-dir, or --oci-dir and cannot be combined with -d, --loadable, or --previous')
+
+    if args.sparse \
+            and ( args.diff is not None or args.index or not ( args.load or targetarg(args) is not None ) ):
+        parser.error('--sparse requires a target (or --load) and cannot be combined with -d or --index')
+
+    if args.index \
+            and ( args.target is None or args.target == _TARGET_STDOUT or args.compression == _CMP_BZIP2 ):
+        parser.error('--index requires -t (with a PATH other than "{}") and cannot be combined with -j'.format(_TARGET_STDOUT))
+
+    if ( args.record or args.previous is not None ) \
+            and ( args.target is None or args.target == _TARGET_STDOUT or args.more_images or args.diff is not None or args.loadable ):
+        parser.error('--record and --previous require -t (with a PATH other than "{}") and cannot be combined with more than one IMAGE_SPEC, -d, or --loadable'.format(_TARGET_STDOUT))
+
+    if args.previous is not None \
+            and realpath(args.previous) == realpath(args.target):
+        parser.error('--previous cannot be the same as the target')
+
+    if args.cache is not None \
+            and ( args.target is None or args.target == _TARGET_STDOUT or args.more_images or args.diff is not None or args.loadable or args.index ):
+        parser.error('--cache requires -t (with a PATH other than "{}") and cannot be combined with more than one IMAGE_SPEC, -d, --loadable, or --index'.format(_TARGET_STDOUT))
+    elif args.cache is None \
+            and args.cache_link:
+        parser.error('--cache-link requires --cache')
+
+    if args.spool_dir is not None \
+            and not isdir(args.spool_dir):
+        parser.error('--spool-dir must be an existing directory')
+
+    if args.spool_memory < 0 \
+            or args.retries < 0 \
+            or ( args.spool_limit is not None and args.spool_limit < 0 ):
+        parser.error('--spool-memory, --spool-limit, and --retries cannot be negative')
+
+    if args.spool_persist \
+            and args.spool_dir is None:
+        parser.error('--spool-persist requires --spool-dir')
+
+    if args.archive is not None and args.graph_root is not None:
+        parser.error('--archive cannot be combined with --graph-root')
+    elif args.graph_driver is not None and args.graph_root is None:
+        parser.error('--graph-driver requires --graph-root')
+    elif args.verify and args.graph_root is not None:
+        # Docker's storage holds extracted files, not the archives the
+        # layers' digests describe
+        parser.error('--verify cannot be combined with --graph-root')
+
+    logging_basicConfig(format=args.log_format)
+    getLogger().setLevel(logging_getLevelName(args.log_level))
+
+    if args.archive is not None:
+        dc = logexception(_LOGGER, ERROR, 'unable to read archive "{}": {{e}}'.format(args.archive), SavedImageClient, args.archive, spoolopts(args), args.verify)
+    elif args.graph_root is not None:
+        dc = logexception(_LOGGER, ERROR, 'unable to read Docker storage in "{}": {{e}}'.format(args.graph_root), GraphDriverClient, args.graph_root, args.graph_driver)
+    else:
+        dc = None
+
+    if dc is not None:
+        with dc:
+            # Loading still requires the daemon
+            runwithclient(dc, args, dockerclient() if args.load else None)
+
+        return
+
+    runwithclient(dockerclient(), args)
+
+# ========================================================================
+def ociconfig(dc, args, image_spec):
+    # Returns the parts of image_spec's configuration to carry over to a
+    # new image (or None if not creating one or if the image can't be
+    # inspected)
+    if ( args.oci_dir is None and not args.load and not args.loadable ) \
+            or not hasattr(dc, 'inspect_image'):
+        return None
+
+    image = logexception(_LOGGER, WARNING, 'unable to inspect "{}" (its configuration will be omitted): {{e}}'.format(image_spec), dc.inspect_image, image_spec)
+
+    if not image:
+        return None
+
+    config = {
+        'architecture': image.get('Architecture') or 'amd64',
+        'os': image.get('Os') or 'linux',
+        'config': dict(( k, v ) for k, v in ( image.get('Config') or {} ).items() if k in _OCI_CONFIG_KEYS and v),
+    }
+
+    if image.get('Created'):
+        config['created'] = image['Created']
+
+    return config
+
+# ========================================================================
+def opencache(args, layers):
+    # Returns the cache (or None) and the key for the archive of layers
+    if args.cache is None:
+        return None, None
+
+    cache = logexception(_LOGGER, ERROR, 'unable to open cache "{}": {{e}}'.format(args.cache), ArchiveCache, args.cache, args.cache_size << 20, link=args.cache_link)
+    compress_level = args.compress_level if args.compression is not None else None
+    cache_key = cache.key(( layer[':id'] for layer in layers ), compression=args.compression, compress_level=compress_level, include=args.includes, exclude=args.excludes, reproducible=args.reproducible, clamp_mtime=args.clamp_mtime, dedupe=args.dedupe, sparse=args.sparse, version=__release__)
+
+    return cache, cache_key
+
+# ========================================================================
+@contextmanager
+def opentarget(args, target_path, image_spec=None, oci_config=None):
+    if args.oci_dir is not None:
+        if isdir(target_path) \
+                and listdir(target_path) \
+                and not isfile(ospath_join(target_path, 'oci-layout')) \
+                and not args.force:
+            exc = OSError(EEXIST, 'directory exists, is not empty, and is not an OCI image layout (use -w to write into it anyway)')
+            logexception(_LOGGER, ERROR, 'unable to open target directory "{}": {{e}}'.format(target_path), exc)
+
+        with logexception(_LOGGER, ERROR, 'unable to open target directory "{}": {{e}}'.format(target_path), OciLayoutWriter, target_path, image_spec, oci_config, args.compress_level) as oci_writer:
+            yield oci_writer
+
+        if args.verify:
+            print('{}  {}'.format(oci_writer.manifest_descriptor['digest'].split(':', 1)[1], target_path), file=stderr)
+
+        return
+
+    if args.target_dir is not None:
+        if isdir(target_path) \
+                and listdir(target_path) \
+                and not args.force:
+            exc = OSError(EEXIST, 'directory exists and is not empty (use -w to write into it anyway)')
+            logexception(_LOGGER, ERROR, 'unable to open target directory "{}": {{e}}'.format(target_path), exc)
+
+        with logexception(_LOGGER, ERROR, 'unable to open target directory "{}": {{e}}'.format(target_path), DirectoryWriter, target_path) as dir_writer:
+            yield dir_writer
+
+        return
+
     flags = O_WRONLY
 
     if target_path == _TARGET_STDOUT:
@@ -184,10 +613,14 @@ def extractlayers(dc, args, layers, top_most_layer_id):
 
         if not args.force:
             flags |= O_EXCL
+        else:
+            unlinkshared(target_path)
 
         target_fd = logexception(_LOGGER, ERROR, 'unable to open target file "{}": {{e}}'.format(target_path), os_open, target_path, flags, 0o666)
 
     with fdopen(target_fd, 'wb') as target_file:
+        digesting_file = DigestingFile(target_file) if args.verify else None
+
         if hasattr(target_file, 'seekable'):
             seekable = target_file.seekable()
         else:
@@ -200,7 +633,7 @@ def extractlayers(dc, args, layers, top_most_layer_id):
 
                 seekable = False
 
-        open_args = { 'fileobj': target_file }
+        open_args = { 'fileobj': target_file if digesting_file is None else digesting_file }
 
         if args.compression is None:
             open_args['mode'] = 'w' if seekable else 'w|'
@@ -218,63 +651,131 @@ def extractlayers(dc, args, layers, top_most_layer_id):
 
             open_args['mode'] = mode.format(args.compression)
 
+        # An indexed archive is compressed in blocks that can be
+        # decompressed independently (tarfile would compress it as one);
+        # a reproducible one is compressed without a timestamp (tarfile
+        # would use the current time)
+        block_file = None
+        gzip_file = None
+
+        if args.index \
+                and args.compression == _CMP_GZIP:
+            block_file = BlockGzipFile(open_args['fileobj'], compresslevel=args.compress_level)
+            open_args = { 'fileobj': block_file, 'mode': 'w|' }
+        elif args.reproducible \
+                and args.compression == _CMP_GZIP:
+            from gzip import GzipFile
+            gzip_file = GzipFile(filename='', mode='wb', compresslevel=args.compress_level, fileobj=open_args['fileobj'], mtime=0)
+            open_args = { 'fileobj': gzip_file, 'mode': 'w|' }
+
+        if args.reproducible:
+            from tarfile import PAX_FORMAT
+            open_args['format'] = PAX_FORMAT
+
+        patch_broken_tarfile_29760()
+
+        from tarfile import open as tarfile_open
+
         with tarfile_open(**open_args) as tar_file:
-            dimgx_extractlayers(dc, layers, tar_file, top_most_layer_id)
+            indexer = ArchiveIndexer(tar_file) if args.index else None
+            yield tar_file if indexer is None else indexer
+
+        for compressed_file in ( block_file, gzip_file ):
+            if compressed_file is not None:
+                compressed_file.close()
+
+        if digesting_file is not None:
+            print('{}  {}'.format(digesting_file.hash_obj.hexdigest(), target_path), file=stderr)
+
+    if indexer is not None:
+        index_path = target_path + _INDEX_SUFFIX
+        index_fd = logexception(_LOGGER, ERROR, 'unable to open index file "{}": {{e}}'.format(index_path), os_open, index_path, flags, 0o666)
+
+        with fdopen(index_fd, 'wb') as index_file:
+            indexer.writeindex(index_file, None if block_file is None else block_file.blocks)
 
 # ========================================================================
-def layerspec2index(args, layers, layer_spec_part):
-    if layer_spec_part is None:
-        return None
+def printanalysis(args, analysis, outfile=stdout):
+    layers = analysis[':layers']
+    ref_counts = analysis[':ref_counts']
+    exclusive_sizes = dict(analysis[':exclusive_sizes'])
+    exclusive_sizes.update(analysis[':dangling'])
 
-    try:
-        return layers[layer_spec_part]
-    except KeyError:
-        pass
+    if args.quiet:
+        for layer in layers:
+            print(layer[':short_id'], file=outfile)
 
-    no_layer_msg = '"%s" does not resolve to any layer associated with image "%s"'
+        return
 
-    if args.strict:
-        _LOGGER.error(no_layer_msg, layer_spec_part, args.image)
-        sys_exit(_EXIT_LAYER_SPEC)
+    if args.json:
+        from json import dump as json_dump
 
-    _LOGGER.warning(no_layer_msg, layer_spec_part, args.image)
+        summary = {
+            'layers': [ {
+                'id': layer[':id'],
+                'parent_id': layer[':parent_id'] or None,
+                'repo_tags': list(layer[':repo_tags']),
+                'size': layer.get('Size') or 0,
+                'ref_count': ref_counts[layer[':id']],
+                'exclusive_size': exclusive_sizes.get(layer[':id']),
+            } for layer in layers ],
+            'dangling': [ layer_id for layer_id, _ in analysis[':dangling'] ],
+        }
 
-    return None
+        for k in ( 'total_size', 'shared_size', 'exclusive_size', 'dangling_size' ):
+            summary[k] = analysis[':' + k]
 
-# ========================================================================
-def layertype(value):
-    matches = _LAYER_SPEC_RE.search(value)
+        json_dump(summary, outfile, indent=2, sort_keys=True)
+        print(file=outfile)
 
-    if not matches:
-        raise ArgumentTypeError('"{}" is not a valid LAYER_SPEC'.format(value))
+        return
 
-    return ( matches.group('l'), matches.group('r'), value )
+    from humanize import naturalsize
+    fields_fmt = '\t'.join([ '{:<23}' ] + [ '{:<15}' ] * 5)
+    print(fields_fmt.format('REPO TAG', 'IMAGE ID', 'PARENT ID', 'REFS', 'LAYER SIZE', 'EXCLUSIVE'), file=outfile)
 
-# ========================================================================
-def main():
-    import _dimgx
-    _dimgx._logexception = exitonraise(_dimgx._logexception)  # WARNING: monkey patch; pylint: disable=protected-access
-    args = buildparser().parse_args(sys_argv[1:])
-    logging_basicConfig(format=args.log_format)
-    getLogger().setLevel(logging_getLevelName(args.log_level))
-    patch_broken_tarfile_29760()
-    dc_kw = kwargs_from_env()
+    for layer in layers:
+        try:
+            image_tag = layer[':repo_tags'][0]
+        except IndexError:
+            image_tag = '-'
 
-    # TODO: hack to work around github:docker/docker-py#706
-    if DOCKER_TLS_VERIFY == '0':
-        dc_kw['tls'].assert_hostname = False
+        layer_id = layer[':id']
+        parent_id = layer[':parent_id'][:12] or '-'
+        exclusive_size = exclusive_sizes.get(layer_id)
+        exclusive_size = '-' if exclusive_size is None else naturalsize(exclusive_size)
+        print(fields_fmt.format(image_tag, layer[':short_id'], parent_id, ref_counts[layer_id], naturalsize(layer.get('Size') or 0), exclusive_size), file=outfile)
 
-    dc = AutoVersionClient(**dc_kw)
-    layers_dict = inspectlayers(dc, args.image)
-    top_most_layer_id, selected_layers = selectlayers(args, layers_dict)
+    print(file=outfile)
+    print('total: {}; shared: {}; exclusive: {}; dangling: {}'.format(*( naturalsize(analysis[k]) for k in ( ':total_size', ':shared_size', ':exclusive_size', ':dangling_size' ) )), file=outfile)
 
-    if not selected_layers:
-        _LOGGER.warning('no known layers selected')
+# ========================================================================
+def printdiff(args, diff, outfile=stdout):
+    if args.json:
+        from json import dump as json_dump
+        summary = {
+            'ancestor_id': diff[':ancestor_id'],
+            'added': diff[':added'],
+            'removed': diff[':removed'],
+            'modified': [ { 'path': path, 'fields': list(fields) } for path, fields in diff[':modified'] ],
+        }
+        json_dump(summary, outfile, indent=2, sort_keys=True)
+        print(file=outfile)
 
-    if args.target is None:
-        printlayerinfo(args, selected_layers)
-    else:
-        extractlayers(dc, args, selected_layers, top_most_layer_id)
+        return
+
+    changes = [ ( path, 'A', () ) for path in diff[':added'] ]
+    changes.extend(( path, 'D', () ) for path in diff[':removed'])
+    changes.extend(( path, 'M', fields ) for path, fields in diff[':modified'])
+    changes.sort()
+
+    for path, change, fields in changes:
+        if args.quiet:
+            print(path, file=outfile)
+        elif fields:
+            print('{}\t{}\t{}'.format(change, path, ','.join(fields)), file=outfile)
+        else:
+            print('{}\t{}'.format(change, path), file=outfile)
 
 # ========================================================================
 def printlayerinfo(args, layers, outfile=stdout):
@@ -284,6 +785,7 @@ def printlayerinfo(args, layers, outfile=stdout):
 
         return
 
+    from humanize import naturalsize
     total_size = 0
     fields_fmt = '\t'.join([ '{:<23}' ] + [ '{:<15}' ] * 5)
     print(fields_fmt.format('REPO TAG', 'IMAGE ID', 'PARENT ID', 'CREATED', 'LAYER SIZE', 'VIRTUAL SIZE'), file=outfile)
@@ -308,6 +810,110 @@ def printlayerinfo(args, layers, outfile=stdout):
         print(fields_fmt.format(image_tag, image_id, parent_id, created, layer_size, virt_size), file=outfile)
         total_size -= layer['Size']
 
+# ========================================================================
+def readrecord(args):
+    # Returns the previous archive and its layers for extractlayers (see
+    # writerecord), or None if there is none to use
+    if args.previous is None:
+        return None
+
+    from json import loads as json_loads
+    record_path = args.previous + _RECORD_SUFFIX
+
+    def _read():
+        with open(record_path, 'rb') as record_file:
+            return json_loads(record_file.read().decode('utf-8'))
+
+    record = logexception(_LOGGER, ERROR, 'unable to read layer record "{}": {{e}}'.format(record_path), _read)
+
+    if record.get('dedupe'):
+        # Newer layers might change or remove what its files are linked to
+        _LOGGER.warning('"%s" was written with --dedupe; ignoring it', args.previous)
+
+        return None
+
+    # Anything that changes how entries are written makes the previous
+    # archive's entries unusable as they are
+    recorded_options = (
+        ( '--include', record.get('include') or None, args.includes or None ),
+        ( '--exclude', record.get('exclude') or None, args.excludes or None ),
+        ( '--reproducible', bool(record.get('reproducible')), bool(args.reproducible) ),
+        ( '--clamp-mtime', record.get('clamp_mtime'), args.clamp_mtime ),
+        ( '--sparse', bool(record.get('sparse')), bool(args.sparse) ),
+    )
+    mismatched = [ option for option, recorded, requested in recorded_options if recorded != requested ]
+
+    if mismatched:
+        _LOGGER.warning('"%s" was written with different %s options; ignoring it', args.previous, ', '.join(mismatched))
+
+        return None
+
+    return args.previous, record['layers']
+
+# ========================================================================
+def runwithclient(dc, args, load_dc=None):
+    if args.all:
+        printanalysis(args, analyzeimages(dc))
+
+        return
+
+    if args.diff is not None:
+        if args.target is None:
+            printdiff(args, diffimages(dc, args.diff, args.image, args.digests, spoolopts(args)))
+        else:
+            with opentarget(args, args.target) as tar_file:
+                extractdelta(dc, args.diff, args.image, tar_file, args.digests, args.verify, spoolopts(args))
+
+        return
+
+    if args.more_images:
+        selections = []
+
+        for image_spec in [ args.image ] + args.more_images:
+            top_most_layer_id, selected_layers = selectlayers(args, inspectlayers(dc, image_spec))
+
+            if not selected_layers:
+                _LOGGER.warning('no known layers selected for "%s"', image_spec)
+
+            selections.append(( image_spec, top_most_layer_id, selected_layers ))
+
+        if targetarg(args) is None:
+            for _, _, selected_layers in selections:
+                printlayerinfo(args, selected_layers)
+        else:
+            extractimages(dc, args, selections)
+
+        return
+
+    if not args.layers \
+            and args.previous is None \
+            and args.cache is None \
+            and not hasattr(dc, 'openlayer') \
+            and ( args.cat is not None or args.load or targetarg(args) is not None ):
+        # All of the image's layers will be needed, so start retrieving
+        # them while they're being inspected
+        _LOGGER.debug('retrieving "%s" while inspecting it', args.image)
+
+        with PrefetchingClient(dc, args.image, args.verify, spoolopts(args)) as prefetching_dc:
+            runwithclient(prefetching_dc, args, load_dc)
+
+        return
+
+    layers_dict = inspectlayers(dc, args.image)
+    top_most_layer_id, selected_layers = selectlayers(args, layers_dict)
+
+    if not selected_layers:
+        _LOGGER.warning('no known layers selected')
+
+    if args.cat is not None:
+        catpath(dc, args, selected_layers, top_most_layer_id)
+    elif args.load:
+        print(loadlayers(dc, selected_layers, args.tags or (), top_most_layer_id, ociconfig(dc, args, args.image), args.verify, load_dc, args.includes, args.excludes, args.reproducible, args.clamp_mtime, args.sparse, spoolopts(args)))
+    elif targetarg(args) is None:
+        printlayerinfo(args, selected_layers)
+    else:
+        extractlayers(dc, args, selected_layers, top_most_layer_id)
+
 # ========================================================================
 def selectlayers(args, layers):
     layer_specs = args.layers
@@ -318,13 +924,15 @@ def selectlayers(args, layers):
         if args.reverse:
             selected_indexes.reverse()
     else:
+        graph = LayerGraph(layers[':all_images'].values())
+        image_id = layers[':layers'][0][':id']
         selected_indexes = []
         last_num_selected_indexes = num_selected_indexes = len(selected_indexes)
 
         for l, r, v in layer_specs:
             last_num_selected_indexes = num_selected_indexes
-            li = layerspec2index(args, layers, l)
-            ri = layerspec2index(args, layers, r)
+            li = layerspec2index(args, graph, image_id, l)
+            ri = layerspec2index(args, graph, image_id, r)
 
             if li is None:
                 continue
@@ -364,3 +972,68 @@ def selectlayers(args, layers):
     selected_layers = [ layers[':layers'][i] for i in seen ]
 
     return top_most_layer_id, selected_layers
+
+# ========================================================================
+def spoolopts(args):
+    # Returns the keyword arguments for the LayerSpool that holds any
+    # retrieved layers
+    return {
+        'spool_dir': args.spool_dir,
+        'memory_limit': args.spool_memory << 20,
+        'size_limit': args.spool_limit << 20 if args.spool_limit is not None else None,
+        'persist': args.spool_persist,
+        'retries': args.retries,
+    }
+
+# ========================================================================
+def targetarg(args):
+    # Returns whichever of -t, --target-dir, or --oci-dir was given (if any)
+    for target in ( args.target, args.target_dir, args.oci_dir ):
+        if target is not None:
+            return target
+
+    return None
+
+# ========================================================================
+def writerecord(args, target_path, layers):
+    # Records the layers flattened into target_path (and how) for use
+    # with --previous
+    from json import dump as json_dump
+    record_path = target_path + _RECORD_SUFFIX
+    record = {
+        'layers': [ layer[':id'] for layer in layers ],
+        'include': args.includes,
+        'exclude': args.excludes,
+        'reproducible': args.reproducible,
+        'clamp_mtime': args.clamp_mtime,
+        'sparse': args.sparse,
+        'dedupe': args.dedupe,
+    }
+    flags = O_WRONLY | O_CREAT | O_TRUNC | ( 0 if args.force else O_EXCL )
+    record_fd = logexception(_LOGGER, ERROR, 'unable to open layer record "{}": {{e}}'.format(record_path), os_open, record_path, flags, 0o666)
+
+    with fdopen(record_fd, 'w') as record_file:
+        json_dump(record, record_file)
+
+# ========================================================================
+def targetpath(target, image_spec, top_most_layer_id):
+    # Expands any "{image}" or "{short_id}" in target for image_spec
+    # (leaving any other braces alone)
+    short_id = '' if top_most_layer_id is None else top_most_layer_id[:12]
+
+    return target.replace('{image}', image_spec.replace('/', '_')).replace('{short_id}', short_id)
+
+# ========================================================================
+def unlinkshared(target_path):
+    # Removes target_path if it is a regular file with other hard links
+    # (e.g., to an archive in a cache with --cache-link), so that
+    # truncating it doesn't clobber them
+    try:
+        st = lstat(target_path)
+    except OSError:
+        return
+
+    if S_ISREG(st.st_mode) \
+            and st.st_nlink > 1:
+        _LOGGER.debug('unlinking "%s" (which has other hard links) rather than overwriting it', target_path)
+        logexception(_LOGGER, ERROR, 'unable to replace target file "{}": {{e}}'.format(target_path), unlink, target_path)
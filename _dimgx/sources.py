@@ -0,0 +1,1532 @@
+# -*- encoding: utf-8; mode: python; grammar-ext: py -*-
+
+# ========================================================================
+"""
+Copyright and other protections apply. Please see the accompanying
+:doc:`LICENSE <LICENSE>` and :doc:`CREDITS <CREDITS>` file(s) for rights
+and restrictions governing use of this software. All rights not expressly
+waived or licensed are reserved. If those files are missing or appear to
+be modified from their originals, then please contact the author before
+viewing or using this software in any capacity.
+"""
+# ========================================================================
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals,
+)
+from builtins import *  # noqa: F401,F403; pylint: disable=redefined-builtin,unused-wildcard-import,useless-suppression,wildcard-import
+from future.builtins.disabled import *  # noqa: F401,F403; pylint: disable=redefined-builtin,unused-wildcard-import,useless-suppression,wildcard-import
+
+# ---- Imports -----------------------------------------------------------
+
+from contextlib import contextmanager
+from functools import partial
+from itertools import chain
+from io import (
+    BytesIO,
+    SEEK_CUR,
+    SEEK_END,
+    SEEK_SET,
+)
+from logging import (
+    ERROR,
+    getLogger,
+)
+from os import (
+    getpid,
+    listdir,
+    lstat,
+    makedirs,
+    readlink,
+    rename,
+)
+from os.path import (
+    isdir,
+    join as ospath_join,
+    realpath as ospath_realpath,
+)
+from posixpath import (
+    dirname as posixpath_dirname,
+    join as posixpath_join,
+    normpath as posixpath_normpath,
+)
+from stat import (
+    S_IMODE,
+    S_ISBLK,
+    S_ISCHR,
+    S_ISDIR,
+    S_ISFIFO,
+    S_ISLNK,
+    S_ISREG,
+)
+from sys import exc_info
+from threading import Lock
+from weakref import WeakSet
+from _dimgx import (
+    LayerDigestMismatch,
+    SpoolLimitExceeded,
+    UnsafeTarPath,
+    logexception,
+)
+
+# ---- Constants ---------------------------------------------------------
+
+__all__ = (
+    'DirectoryLayerReader',
+    'GraphDriverClient',
+    'LayerSpool',
+    'PrefetchingClient',
+    'SavedImageClient',
+    'TarLayerReader',
+    'opensource',
+)
+
+# tarfile, tempfile, and shutil are imported where they are used so that
+# merely importing dimgx (e.g., to print usage) stays cheap
+
+_LOGGER = getLogger(__name__.lstrip('_'))
+_LAYER_TAR = 'layer.tar'
+_CHECKPOINT = 'spool.json'
+_COPY_BUFSIZE = 1 << 20
+_WHITEOUT_PFX = '.wh.'
+_OPAQUE_WHITEOUT = _WHITEOUT_PFX + _WHITEOUT_PFX + '.opq'
+_OVERLAY_OPAQUE_XATTRS = ( 'trusted.overlay.opaque', 'user.overlay.opaque' )
+_GRAPH_DRIVERS = ( 'overlay2', 'aufs' )
+
+# ---- Exceptions --------------------------------------------------------
+
+# ========================================================================
+class _Abandoned(BaseException):
+    """
+    Raised from a :class:`PrefetchingClient`'s stream once the client is
+    closed. It isn't an :class:`Exception` so that it isn't mistaken for
+    (and retried or logged as) a failed retrieval.
+    """
+
+# ---- Classes -----------------------------------------------------------
+
+# ========================================================================
+class TarLayerReader(object):
+    """
+    Reads the entries of a single layer's archive, which must be seekable
+    so that entries' contents can be retrieved (in any order) while the
+    reader remains open.
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, fileobj, layer_id):
+        super().__init__()
+        from tarfile import open as tarfile_open
+        self.layer_id = layer_id
+        self._fileobj = fileobj
+        self._tar_file = tarfile_open(mode='r', fileobj=fileobj)
+
+    # ---- Public hooks --------------------------------------------------
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        next_info = self._tar_file.next()
+
+        while next_info:
+            yield next_info
+            next_info = self._tar_file.next()
+
+    # ---- Public methods ------------------------------------------------
+
+    def close(self):
+        self._tar_file.close()
+        self._fileobj.close()
+
+    def extractfile(self, info):
+        """
+        Returns a file object for the contents of :obj:`info` (or
+        :const:`None` if :obj:`info` is not a regular file).
+        """
+        if info.linkname:
+            # TarFile.extractfile() tries to do something weird when its
+            # parameter represents a link (see the docs)
+            return None
+
+        return self._tar_file.extractfile(info)
+
+# ========================================================================
+class DirectoryLayerReader(object):
+    """
+    Reads a single layer's changes from a storage driver's diff directory
+    (rather than from an archive), providing the same interface as
+    :class:`TarLayerReader`. Entries are described by :class:`tarfile.TarInfo`
+    objects (directories before their contents, as with ``tar``), and the
+    driver's representation of deleted files is translated to that used by
+    ``docker save``.
+
+    If :obj:`driver` is ``'overlay2'``, whiteouts are character devices
+    (0, 0), and a directory marked opaque (via an extended attribute) is
+    followed by a ``.wh..wh..opq`` entry. If :obj:`driver` is ``'aufs'``,
+    whiteouts are already ``.wh.`` files, and aufs's own bookkeeping
+    entries (e.g., ``.wh..wh.plnk``) are omitted.
+
+    If :attr:`prune` is set to a callable, it is called with the name of
+    each directory, and, if it returns :const:`True`, the directory's
+    contents are not visited at all.
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, path, layer_id, driver='overlay2'):
+        super().__init__()
+        self.layer_id = layer_id
+        self.driver = driver
+        self.path = path
+        self.prune = None
+        self._paths_by_name = {}
+        self._open_files = WeakSet()
+
+    # ---- Public hooks --------------------------------------------------
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        self._paths_by_name.clear()
+
+        return self._walk('', {})
+
+    # ---- Public methods ------------------------------------------------
+
+    def close(self):
+        for open_file in list(self._open_files):
+            open_file.close()
+
+        self._open_files.clear()
+        self._paths_by_name.clear()
+
+    def extractfile(self, info):
+        """
+        Returns a new file object for the contents of :obj:`info` (or
+        :const:`None` if :obj:`info` is not a regular file). Each is
+        independent of any others, and any still open are closed when the
+        reader is.
+        """
+        path = self._paths_by_name.get(info.name)
+
+        if path is None \
+                or not info.isreg():
+            return None
+
+        open_file = open(path, 'rb')
+        self._open_files.add(open_file)
+
+        return open_file
+
+    # ---- Private methods -----------------------------------------------
+
+    def _walk(self, dir_name, names_by_inode):
+        for child in sorted(listdir(ospath_join(self.path, dir_name))):
+            name = posixpath_join(dir_name, child) if dir_name else child
+            path = ospath_join(self.path, name)
+            st = lstat(path)
+
+            if self.driver == 'aufs' \
+                    and child.startswith(_WHITEOUT_PFX + _WHITEOUT_PFX) \
+                    and child != _OPAQUE_WHITEOUT:
+                continue
+
+            if self.driver == 'overlay2' \
+                    and S_ISCHR(st.st_mode) \
+                    and st.st_rdev == 0:
+                yield _whiteoutinfo(posixpath_join(dir_name, _WHITEOUT_PFX + child), st)
+
+                continue
+
+            info = _tarinfofromstat(name, path, st)
+
+            if info.isreg():
+                if st.st_nlink > 1:
+                    inode = ( st.st_dev, st.st_ino )
+
+                    if inode in names_by_inode:
+                        from tarfile import LNKTYPE
+                        info.type = LNKTYPE
+                        info.linkname = names_by_inode[inode]
+                        info.size = 0
+                    else:
+                        names_by_inode[inode] = name
+
+                if info.isreg():
+                    self._paths_by_name[name] = path
+
+            yield info
+
+            if info.isdir():
+                if self.prune is not None \
+                        and self.prune(name):
+                    continue
+
+                if self.driver == 'overlay2' \
+                        and _isoverlayopaque(path):
+                    yield _whiteoutinfo(posixpath_join(name, _OPAQUE_WHITEOUT), st)
+
+                for sub_info in self._walk(name, names_by_inode):
+                    yield sub_info
+
+# ========================================================================
+class LayerSpool(object):
+    """
+    Holds the layers retrieved from one or more |docker.Client.get_image|_
+    streams so that they can be read in any order. Each distinct layer is
+    only held once.
+
+    Layers are held in memory for as long as they fit within
+    :obj:`memory_limit` bytes (in total), and are otherwise written to a
+    temporary directory created in :obj:`spool_dir` (or the default
+    temporary directory, if :const:`None`), which can be on a faster (or
+    larger) file system, e.g., a ``tmpfs``. If :obj:`size_limit` is not
+    :const:`None`, it is the most the held layers may take up in total
+    (in memory and on disk), and
+    :class:`~dimgx.SpoolLimitExceeded` is raised (before anything is
+    written) for the first layer that would exceed it.
+
+    If :obj:`persist` is :const:`True`, layers are always written to disk,
+    in :obj:`spool_dir` itself (which is required, and created if
+    necessary), and are kept there after the spool is closed. Each layer
+    is recorded in a checkpoint (``spool.json``) once it is complete, and
+    a later spool in the same directory (e.g., that of a retry after an
+    interrupted transfer) starts out holding those layers. (If verifying,
+    those layers are hashed again, and any that weren't already verified
+    are only trusted once the image's configuration has been retrieved
+    again to check them against.) A persistent spool shouldn't be shared
+    by concurrent processes, and removing it is up to the caller.
+
+    Where the IDs of the layers wanted from an image are provided (see
+    :meth:`addimage`), images whose layers are all held already are not
+    retrieved at all, and (unless verifying) a stream is abandoned as soon
+    as it has provided everything wanted from it. If retrieving images
+    fails (e.g., because the stream is cut off), it is retried up to
+    :obj:`retries` more times, asking only for what is still missing.
+
+    If :obj:`verify` is :const:`True`, the SHA-256 digest of each layer is
+    computed as it is written (and kept in :attr:`layer_digests`) and
+    compared with the one recorded in the image's configuration (if the
+    stream includes one), raising :class:`~dimgx.LayerDigestMismatch` on
+    the first difference. The configuration usually follows the layers,
+    so checks happen when it arrives (i.e., before the stream ends, but
+    without reading the spooled layers again).
+
+    .. |docker.Client.get_image| replace:: :func:`docker.Client.get_image`
+    .. _`docker.Client.get_image`: https://docker-py.readthedocs.org/en/latest/api/#get_image
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, verify=False, spool_dir=None, memory_limit=0, size_limit=None, persist=False, retries=0):
+        super().__init__()
+        self._aliases = {}
+        self._buffers = {}
+        self._sizes = {}
+        self._verified = set()
+        self.layer_digests = {}
+        self.layer_ids = set()
+        self.memory_limit = memory_limit
+        self.memory_size = 0
+        self.persist = persist
+        self.retries = retries
+        self.size_limit = size_limit
+        self.spooled_size = 0
+        self.verify = verify
+
+        if persist:
+            if spool_dir is None:
+                raise ValueError('a persistent spool requires a spool_dir')
+
+            if not isdir(spool_dir):
+                makedirs(spool_dir)
+
+            self._spool_path = ospath_realpath(spool_dir)
+            self._readcheckpoint()
+        else:
+            from tempfile import mkdtemp
+            self._spool_path = ospath_realpath(mkdtemp(dir=spool_dir))
+
+    # ---- Public hooks --------------------------------------------------
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    # ---- Public methods ------------------------------------------------
+
+    def addimage(self, dc, image_spec, layer_ids=None):
+        """
+        Retrieves :obj:`image_spec` from :obj:`dc` and spools any layers
+        not already held. If :obj:`layer_ids` is provided, it is the IDs of
+        the layers wanted from the image, and nothing is retrieved if they
+        are all held already.
+        """
+        self._retrieve(dc, [ ( image_spec, layer_ids ) ])
+
+    def addimages(self, dc, image_specs, layer_ids=None):
+        """
+        Retrieves all of :obj:`image_specs` from :obj:`dc` and spools any
+        layers not already held. If :obj:`dc` is a |docker.Client|_, this
+        is done with a single (multi-name) ``docker save`` so that layers
+        shared among the images are only transferred once. Otherwise, each
+        image is retrieved in turn via :meth:`addimage`. If
+        :obj:`layer_ids` is provided, it is a sequence of the IDs of the
+        layers wanted from each of :obj:`image_specs` (or :const:`None`
+        where they aren't known).
+
+        .. |docker.Client| replace:: :class:`docker.Client`
+        .. _`docker.Client`: https://docker-py.readthedocs.org/en/latest/api/
+        """
+        image_specs = list(image_specs)
+        layer_ids = list(layer_ids) if layer_ids is not None else [ None ] * len(image_specs)
+
+        if len(image_specs) > 1 \
+                and hasattr(dc, '_url') \
+                and hasattr(dc, '_get'):
+            self._retrieve(dc, list(zip(image_specs, layer_ids)))
+        else:
+            for image_spec, wanted_ids in zip(image_specs, layer_ids):
+                self.addimage(dc, image_spec, wanted_ids)
+
+    def addstream(self, fileobj, image_spec, layer_ids=None):
+        """
+        Spools any layers not already held from :obj:`fileobj` (a stream in
+        the format produced by ``docker save``). :obj:`image_spec` is only
+        used for messages. If :obj:`layer_ids` is provided (and not
+        verifying), the rest of the stream is skipped once those layers
+        are all held.
+        """
+        from tarfile import open as tarfile_open
+        diff_ids_by_config = {}
+        manifest = None
+
+        with tarfile_open(mode='r|*', fileobj=fileobj) as image_tar_file:
+            next_info = image_tar_file.next()
+
+            while next_info:
+                layer_id = _layeridfromname(self._spool_path, next_info.name, image_spec)
+
+                if self.verify \
+                        and layer_id is None \
+                        and next_info.isreg() \
+                        and _ismetadataname(next_info.name):
+                    from json import loads as json_loads
+                    metadata = json_loads(image_tar_file.extractfile(next_info).read().decode('utf-8'))
+
+                    if next_info.name == 'manifest.json':
+                        manifest = metadata if isinstance(metadata, list) else []
+                    elif isinstance(metadata, dict):
+                        diff_ids_by_config[next_info.name] = ( metadata.get('rootfs') or {} ).get('diff_ids')
+
+                    if manifest is not None:
+                        self._verifydigests(image_spec, manifest, diff_ids_by_config)
+                elif layer_id is not None \
+                        and layer_id not in self.layer_ids:
+                    if next_info.issym() or next_info.islnk():
+                        # Newer versions of Docker link duplicate layers
+                        # to a single copy
+                        self._aliases[layer_id] = _linktarget(next_info).split('/')[0]
+                        self.layer_ids.add(layer_id)
+
+                        if self.persist:
+                            self._writecheckpoint()
+                    elif next_info.isreg():
+                        if self.size_limit is not None \
+                                and self.spooled_size + next_info.size > self.size_limit:
+                            exc = SpoolLimitExceeded('layer "{}" ({} bytes) would exceed the limit of {} bytes ({} bytes already spooled)'.format(layer_id, next_info.size, self.size_limit, self.spooled_size))
+                            logexception(_LOGGER, ERROR, 'unable to spool layers retrieved from "{}": {{e}}'.format(image_spec), exc)
+
+                        if not self.persist \
+                                and self.memory_size + next_info.size <= self.memory_limit:
+                            layer_file = BytesIO()
+                            self._copylayer(layer_id, image_tar_file.extractfile(next_info), layer_file)
+                            self._buffers[layer_id] = layer_file.getvalue()
+                            self.memory_size += next_info.size
+                        else:
+                            layer_dir = ospath_join(self._spool_path, layer_id)
+
+                            if not isdir(layer_dir):
+                                makedirs(layer_dir)
+
+                            with open(ospath_join(layer_dir, _LAYER_TAR), 'wb') as layer_file:
+                                self._copylayer(layer_id, image_tar_file.extractfile(next_info), layer_file)
+
+                        self._sizes[layer_id] = next_info.size
+                        self.spooled_size += next_info.size
+                        self.layer_ids.add(layer_id)
+
+                        if self.persist:
+                            self._writecheckpoint()
+
+                        if manifest is not None:
+                            self._verifydigests(image_spec, manifest, diff_ids_by_config)
+
+                    if layer_ids is not None \
+                            and not self.verify \
+                            and self._holds(layer_ids):
+                        _LOGGER.debug('retrieved all wanted layers from "%s"; skipping the rest', image_spec)
+
+                        break
+
+                next_info = image_tar_file.next()
+
+        if self.verify \
+                and manifest is None:
+            _LOGGER.warning('unable to verify layers retrieved from "%s" (export has no manifest)', image_spec)
+
+    def close(self):
+        self._buffers.clear()
+
+        if not self.persist:
+            from shutil import rmtree
+            rmtree(self._spool_path, ignore_errors=True)
+
+    def openlayer(self, layer_id):
+        """
+        Returns a :class:`TarLayerReader` for :obj:`layer_id`.
+        """
+        spooled_id = self._spooledid(layer_id)
+
+        if spooled_id in self._buffers:
+            return TarLayerReader(BytesIO(self._buffers[spooled_id]), layer_id)
+
+        return TarLayerReader(open(ospath_join(self._spool_path, spooled_id, _LAYER_TAR), 'rb'), layer_id)
+
+    # ---- Private methods -----------------------------------------------
+
+    def _copylayer(self, layer_id, src_file, dst_file):
+        # Copies layer_id's contents from src_file to dst_file (recording
+        # their digest if verifying)
+        if self.verify:
+            self.layer_digests[layer_id] = _copyanddigest(src_file, dst_file)
+        else:
+            from shutil import copyfileobj
+            copyfileobj(src_file, dst_file, _COPY_BUFSIZE)
+
+    def _holds(self, layer_ids):
+        # Returns True if layer_ids (and any layers they alias) are all
+        # held (and, if verifying, verified)
+        for layer_id in layer_ids:
+            spooled_id = self._spooledid(layer_id)
+
+            if layer_id not in self.layer_ids \
+                    or spooled_id not in self.layer_ids \
+                    or ( self.verify and spooled_id not in self._verified ):
+                return False
+
+        return True
+
+    def _readcheckpoint(self):
+        # Starts out holding the layers recorded in the checkpoint of a
+        # persistent spool (if any) that are still present
+        from json import load as json_load
+        checkpoint_path = ospath_join(self._spool_path, _CHECKPOINT)
+
+        try:
+            with open(checkpoint_path) as checkpoint_file:
+                checkpoint = json_load(checkpoint_file)
+        except EnvironmentError:
+            return
+        except ValueError as e:
+            _LOGGER.warning('ignoring unreadable checkpoint "%s": %s', checkpoint_path, e)
+
+            return
+
+        verified = set(checkpoint.get('verified') or ())
+
+        for layer_id, ( size, digest ) in ( checkpoint.get('layers') or {} ).items():
+            layer_path = ospath_join(self._spool_path, layer_id, _LAYER_TAR)
+
+            try:
+                if lstat(layer_path).st_size != size:
+                    continue
+            except EnvironmentError:
+                continue
+
+            if self.verify:
+                # What's on disk is only as good as its digest
+                with open(layer_path, 'rb') as layer_file:
+                    spooled_digest = _digest(layer_file)
+
+                if digest is not None \
+                        and spooled_digest != digest:
+                    _LOGGER.warning('ignoring layer "%s" in "%s" (its digest has changed)', layer_id, self._spool_path)
+
+                    continue
+
+                if digest is not None \
+                        and layer_id in verified:
+                    self._verified.add(layer_id)
+
+                digest = spooled_digest
+
+            if digest is not None:
+                self.layer_digests[layer_id] = digest
+
+            self._sizes[layer_id] = size
+            self.spooled_size += size
+            self.layer_ids.add(layer_id)
+
+        for layer_id, target_id in ( checkpoint.get('aliases') or {} ).items():
+            self._aliases[layer_id] = target_id
+            self.layer_ids.add(layer_id)
+
+        _LOGGER.debug('resuming with %d layer(s) (%d bytes) spooled in "%s"', len(self._sizes), self.spooled_size, self._spool_path)
+
+    def _retrieve(self, dc, specs_and_ids):
+        # Retrieves those of specs_and_ids (( image_spec, layer_ids )
+        # tuples) whose layers aren't all held with a single stream,
+        # retrying with what is still missing if it fails
+        attempt = 0
+
+        while True:
+            missing = [ ( image_spec, layer_ids ) for image_spec, layer_ids in specs_and_ids if layer_ids is None or not self._holds(layer_ids) ]
+
+            if not missing:
+                _LOGGER.debug('already holding the layers of %s', ', '.join('"{}"'.format(image_spec) for image_spec, _ in specs_and_ids))
+
+                return
+
+            image_specs = [ image_spec for image_spec, _ in missing ]
+            wanted_ids = None if any(layer_ids is None for _, layer_ids in missing) else set(chain.from_iterable(layer_ids for _, layer_ids in missing))
+
+            if len(image_specs) > 1:
+                desc = ', '.join('"{}"'.format(image_spec) for image_spec in image_specs)
+                get_image = partial(_getimages, dc, image_specs)
+            else:
+                desc = '"{}"'.format(image_specs[0])
+                get_image = partial(dc.get_image, image_specs[0])
+
+            try:
+                self.addstream(get_image(), desc if len(image_specs) > 1 else image_specs[0], wanted_ids)
+
+                return
+            except ( LayerDigestMismatch, SpoolLimitExceeded, UnsafeTarPath ):
+                raise
+            except Exception as e:  # pylint: disable=broad-except
+                if attempt >= self.retries:
+                    logexception(_LOGGER, ERROR, 'unable to retrieve image layers from {}: {{e}}'.format(desc), e)
+
+                attempt += 1
+                _LOGGER.warning('unable to retrieve image layers from %s (%s); retrying (%d of %d)', desc, e, attempt, self.retries)
+
+    def _spooledid(self, layer_id):
+        # Returns the ID under which layer_id's contents were spooled
+        # (following any aliases)
+        spooled_id = layer_id
+        seen = set()
+
+        while spooled_id in self._aliases and spooled_id not in seen:
+            seen.add(spooled_id)
+            spooled_id = self._aliases[spooled_id]
+
+        return spooled_id
+
+    def _verifydigests(self, image_spec, manifest, diff_ids_by_config):
+        # Compares the digests of any newly spooled layers named in
+        # manifest with those recorded in their images' configurations
+        for entry in manifest:
+            diff_ids = diff_ids_by_config.get(entry.get('Config'))
+
+            if not diff_ids:
+                continue
+
+            for layer_path, diff_id in zip(entry.get('Layers') or (), diff_ids):
+                layer_id = self._spooledid(posixpath_normpath(layer_path).split('/')[0])
+                digest = self.layer_digests.get(layer_id)
+
+                if digest is None \
+                        or layer_id in self._verified:
+                    continue
+
+                if digest != diff_id:
+                    exc = LayerDigestMismatch('layer "{}" has digest {} (expected {})'.format(layer_id, digest, diff_id))
+                    logexception(_LOGGER, ERROR, 'unable to verify layers retrieved from "{}": {{e}}'.format(image_spec), exc)
+
+                _LOGGER.debug('verified layer "%s" (%s)', layer_id, digest)
+                self._verified.add(layer_id)
+
+                if self.persist:
+                    self._writecheckpoint()
+
+    def _writecheckpoint(self):
+        # Records the layers held by a persistent spool (replacing any
+        # previous checkpoint atomically)
+        from json import dump as json_dump
+        checkpoint_path = ospath_join(self._spool_path, _CHECKPOINT)
+        tmp_path = '{}.{}'.format(checkpoint_path, getpid())
+        checkpoint = {
+            'layers': dict(( layer_id, ( size, self.layer_digests.get(layer_id) ) ) for layer_id, size in self._sizes.items()),
+            'aliases': self._aliases,
+            'verified': sorted(self._verified),
+        }
+
+        with open(tmp_path, 'w') as tmp_file:
+            json_dump(checkpoint, tmp_file)
+
+        rename(tmp_path, checkpoint_path)
+
+# ========================================================================
+class SavedImageClient(object):
+    """
+    Stand-in for a |docker.Client|_ that reads from an archive previously
+    created with ``docker save`` (or |docker.Client.get_image|_) rather
+    than from a Docker daemon. It can be used anywhere ``dimgx`` expects a
+    client (e.g., with :func:`~dimgx.inspectlayers` and
+    :func:`~dimgx.extractlayers`).
+
+    The layer chain is built from each layer's ``json`` metadata, and
+    repository tags from the archive's ``repositories`` and
+    ``manifest.json`` files. If the archive is not compressed, each
+    layer's ``layer.tar`` is read in place (without being copied);
+    otherwise the layers are spooled once on first use (by a
+    :class:`LayerSpool` created with any keyword arguments in
+    :obj:`spool`).
+
+    If :obj:`verify` is :const:`True`, the SHA-256 digest of each layer is
+    compared with the diff ID recorded for it in its image's configuration
+    (as named by ``manifest.json``) the first time it is opened, raising
+    :class:`~dimgx.LayerDigestMismatch` on a mismatch. (Layers the
+    archive has no diff IDs for can't be verified, which is logged.)
+
+    .. |docker.Client| replace:: :class:`docker.Client`
+    .. _`docker.Client`: https://docker-py.readthedocs.org/en/latest/api/
+    .. |docker.Client.get_image| replace:: :func:`docker.Client.get_image`
+    .. _`docker.Client.get_image`: https://docker-py.readthedocs.org/en/latest/api/#get_image
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, path, spool=None, verify=False):
+        super().__init__()
+        self.path = path
+        self.verify = verify
+        self._diff_ids = {} if verify else None
+        self._layer_members = {}
+        self._spool = None
+        self._spool_kw = dict(spool or {})
+        self._spool_lock = Lock()
+        self._verified = set()
+        self._images, seekable = _readsavemetadata(path, self._layer_members, self._diff_ids)
+
+        if verify \
+                and not self._diff_ids:
+            _LOGGER.warning('unable to verify layers in "%s" (archive has no manifest)', path)
+
+        if not seekable:
+            self._layer_members = None
+
+    # ---- Public hooks --------------------------------------------------
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    # ---- Public methods ------------------------------------------------
+
+    def close(self):
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+    def get_image(self, image):  # pylint: disable=unused-argument
+        """
+        Returns the (entire) archive, opened for reading.
+        """
+        return open(self.path, 'rb')
+
+    def images(self, name=None, quiet=False, all=False, viz=False, filters=None):  # pylint: disable=redefined-builtin
+        return _filterimages(self._images, name, quiet, all, viz, filters)
+
+    def openlayer(self, layer_id):
+        """
+        Returns a :class:`TarLayerReader` for :obj:`layer_id`.
+        """
+        if self._layer_members is not None:
+            try:
+                offset, size = self._layer_members[layer_id]
+            except KeyError:
+                raise KeyError('{} not found in {}'.format(layer_id, self.path))
+
+            if self.verify \
+                    and layer_id not in self._verified:
+                self._verifylayer(layer_id, offset, size)
+
+            return TarLayerReader(_FileWindow(open(self.path, 'rb'), offset, size), layer_id)
+
+        # Several threads (e.g., extractimages's workers) may get here at
+        # once, but only one should spool the archive
+        with self._spool_lock:
+            if self._spool is None:
+                spool = LayerSpool(self.verify, **self._spool_kw)
+
+                try:
+                    with open(self.path, 'rb') as image_file:
+                        spool.addstream(image_file, self.path)
+                except Exception:
+                    spool.close()
+                    raise
+
+                self._spool = spool
+
+        return self._spool.openlayer(layer_id)
+
+    # ---- Private methods -----------------------------------------------
+
+    def _verifylayer(self, layer_id, offset, size):
+        # Compares the digest of layer_id's layer.tar (in place) with its
+        # diff ID
+        diff_id = self._diff_ids.get(layer_id)
+
+        if diff_id is None:
+            if self._diff_ids:
+                _LOGGER.warning('unable to verify layer "%s" in "%s" (archive has no diff ID for it)', layer_id, self.path)
+        else:
+            layer_file = _FileWindow(open(self.path, 'rb'), offset, size)
+
+            try:
+                digest = _digest(layer_file)
+            finally:
+                layer_file.close()
+
+            if digest != diff_id:
+                exc = LayerDigestMismatch('layer "{}" has digest {} (expected {})'.format(layer_id, digest, diff_id))
+                logexception(_LOGGER, ERROR, 'unable to verify layers in "{}": {{e}}'.format(self.path), exc)
+
+            _LOGGER.debug('verified layer "%s" (%s)', layer_id, digest)
+
+        self._verified.add(layer_id)
+
+# ========================================================================
+class GraphDriverClient(object):
+    """
+    Stand-in for a |docker.Client|_ that reads layers directly from a
+    Docker daemon's on-disk storage (rather than via the daemon's API),
+    which avoids streaming (and spooling) entire images when running on
+    the Docker host itself. It can be used anywhere ``dimgx`` expects a
+    client (e.g., with :func:`~dimgx.inspectlayers` and
+    :func:`~dimgx.extractlayers`).
+
+    :obj:`root` is Docker's root directory (e.g., ``/var/lib/docker``).
+    :obj:`driver` is the storage driver (``'overlay2'`` or ``'aufs'``), or
+    :const:`None` to use whichever one is present under :obj:`root`.
+
+    Each layer is described by its chain ID (from Docker's layer
+    database), with repository tags (from ``repositories.json``) attached
+    to the top-most layer of each tagged image. Each layer's changes are
+    read from the driver's diff directory by a
+    :class:`DirectoryLayerReader`.
+
+    .. |docker.Client| replace:: :class:`docker.Client`
+    .. _`docker.Client`: https://docker-py.readthedocs.org/en/latest/api/
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, root, driver=None):
+        super().__init__()
+
+        if driver is None:
+            for driver in _GRAPH_DRIVERS:
+                if isdir(ospath_join(root, 'image', driver, 'layerdb')):
+                    break
+            else:
+                raise ValueError('no supported storage driver ({}) found in "{}"'.format(', '.join(_GRAPH_DRIVERS), root))
+        elif driver not in _GRAPH_DRIVERS:
+            raise ValueError('unsupported storage driver "{}" (must be one of {})'.format(driver, ', '.join(_GRAPH_DRIVERS)))
+
+        self.driver = driver
+        self.root = root
+        self._cache_ids = {}
+        self._images = _readlayerdb(root, driver, self._cache_ids)
+
+    # ---- Public hooks --------------------------------------------------
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    # ---- Public methods ------------------------------------------------
+
+    def close(self):
+        pass
+
+    def images(self, name=None, quiet=False, all=False, viz=False, filters=None):  # pylint: disable=redefined-builtin
+        return _filterimages(self._images, name, quiet, all, viz, filters)
+
+    def openlayer(self, layer_id):
+        """
+        Returns a :class:`DirectoryLayerReader` for :obj:`layer_id`.
+        """
+        try:
+            cache_id = self._cache_ids[layer_id]
+        except KeyError:
+            raise KeyError('{} not found in "{}"'.format(layer_id, self.root))
+
+        if self.driver == 'aufs':
+            diff_path = ospath_join(self.root, 'aufs', 'diff', cache_id)
+        else:
+            diff_path = ospath_join(self.root, self.driver, cache_id, 'diff')
+
+        return DirectoryLayerReader(diff_path, layer_id, self.driver)
+
+# ========================================================================
+class PrefetchingClient(object):
+    """
+    Stand-in for a |docker.Client|_ that starts retrieving (and spooling)
+    :obj:`image_spec` from :obj:`dc` in the background as soon as it is
+    created, so that the transfer overlaps whatever is done before the
+    layers are needed (e.g., :func:`~dimgx.inspectlayers`). It can be
+    used anywhere ``dimgx`` expects a client; everything but
+    :meth:`openlayer` is passed through to :obj:`dc`. :obj:`verify` and
+    :obj:`spool` are as for :func:`opensource`.
+
+    Only the layers of :obj:`image_spec`'s chain are available via
+    :meth:`openlayer`, which waits for the retrieval to finish (and raises
+    anything it did). Closing the client abandons any retrieval still in
+    progress, waiting at most :obj:`abandon_timeout` seconds for it to
+    stop (e.g., if the stream has stalled, the retrieval is left to finish
+    or fail on its own daemon thread).
+
+    .. |docker.Client| replace:: :class:`docker.Client`
+    .. _`docker.Client`: https://docker-py.readthedocs.org/en/latest/api/
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, dc, image_spec, verify=False, spool=None, abandon_timeout=10):
+        super().__init__()
+        from threading import (
+            Event,
+            Thread,
+        )
+        self.abandon_timeout = abandon_timeout
+        self.dc = dc
+        self.image_spec = image_spec
+        self._abandon = Event()
+        self._failure = None
+        self._spool = LayerSpool(verify, **dict(spool or {}))
+        self._thread = Thread(target=self._prefetch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    # ---- Public hooks --------------------------------------------------
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self.dc, name)
+
+    # ---- Public methods ------------------------------------------------
+
+    def close(self):
+        if self._thread.is_alive():
+            _LOGGER.debug('abandoning retrieval of "%s"', self.image_spec)
+
+        # The stream is only checked between reads, so one that has
+        # stalled (or a get_image that never returns) isn't waited for
+        self._abandon.set()
+        self._thread.join(self.abandon_timeout)
+
+        if self._thread.is_alive():
+            _LOGGER.warning('retrieval of "%s" did not stop within %s seconds; leaving it behind', self.image_spec, self.abandon_timeout)
+
+        self._spool.close()
+
+    def get_image(self, image):
+        """
+        Returns :obj:`dc`'s stream for :obj:`image`, which fails once the
+        client is closed.
+        """
+        return _AbandonableFile(self.dc.get_image(image), self._abandon)
+
+    def openlayer(self, layer_id):
+        """
+        Returns a :class:`TarLayerReader` for :obj:`layer_id` once
+        :obj:`image_spec` has been retrieved.
+        """
+        self._thread.join()
+
+        if self._failure is not None:
+            from future.utils import raise_
+            raise_(*self._failure)
+
+        return self._spool.openlayer(layer_id)
+
+    # ---- Private methods -----------------------------------------------
+
+    def _prefetch(self):
+        # Retrieves image_spec into the spool (on its own thread), keeping
+        # any failure for openlayer to raise
+        try:
+            self._spool.addimage(self, self.image_spec)
+        except _Abandoned:
+            pass
+        except BaseException:  # pylint: disable=broad-except
+            self._failure = exc_info()
+
+# ========================================================================
+class _AbandonableFile(object):
+    """
+    A stream that reads from :obj:`fileobj` until :obj:`abandon` (a
+    :class:`threading.Event`) is set, after which it closes
+    :obj:`fileobj` and raises :class:`_Abandoned`.
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, fileobj, abandon):
+        super().__init__()
+        self._fileobj = fileobj
+        self._abandon = abandon
+
+    # ---- Public methods ------------------------------------------------
+
+    def close(self):
+        if hasattr(self._fileobj, 'close'):
+            self._fileobj.close()
+
+    def read(self, size=-1):
+        if self._abandon.is_set():
+            self.close()
+
+            raise _Abandoned()
+
+        return self._fileobj.read(size)
+
+# ========================================================================
+class _FileWindow(object):
+    """
+    A read-only, seekable view of :obj:`size` bytes of :obj:`fileobj`
+    starting at :obj:`offset`. Each window has its own file object, so
+    several can be read independently.
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, fileobj, offset, size):
+        super().__init__()
+        self._fileobj = fileobj
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+
+    # ---- Public methods ------------------------------------------------
+
+    def close(self):
+        self._fileobj.close()
+
+    def read(self, size=-1):
+        remaining = self._size - self._pos
+
+        if size is None \
+                or size < 0 \
+                or size > remaining:
+            size = remaining
+
+        if size <= 0:
+            return b''
+
+        self._fileobj.seek(self._offset + self._pos)
+        buf = self._fileobj.read(size)
+        self._pos += len(buf)
+
+        return buf
+
+    def seek(self, pos, whence=SEEK_SET):
+        if whence == SEEK_CUR:
+            pos += self._pos
+        elif whence == SEEK_END:
+            pos += self._size
+
+        self._pos = max(0, pos)
+
+        return self._pos
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+# ---- Functions ---------------------------------------------------------
+
+# ========================================================================
+@contextmanager
+def opensource(dc, image_specs, verify=False, spool=None, layer_ids=None):
+    """
+    Context manager providing an object with an ``openlayer(layer_id)``
+    method for the layers of :obj:`image_specs`. If :obj:`dc` provides
+    such a method itself, it is used directly; otherwise the images are
+    spooled via :meth:`LayerSpool.addimages` (verifying their digests if
+    :obj:`verify` is :const:`True`, and passing along :obj:`layer_ids`),
+    where :obj:`spool` provides any other keyword arguments for the
+    :class:`LayerSpool` (e.g., ``{ 'spool_dir': '/dev/shm',
+    'memory_limit': 1 << 26 }``).
+    """
+    if hasattr(dc, 'openlayer'):
+        yield dc
+
+        return
+
+    with LayerSpool(verify, **dict(spool or {})) as layer_spool:
+        layer_spool.addimages(dc, image_specs, layer_ids)
+
+        yield layer_spool
+
+# ========================================================================
+def _addvirtualsizes(images):
+    # Sets the VirtualSize of each of images (image descriptions in the
+    # form returned by docker.Client.images) to the sum of the Sizes of
+    # its chain
+    sizes_by_id = dict(( image['Id'], image['Size'] ) for image in images)
+    parents_by_id = dict(( image['Id'], image['ParentId'] ) for image in images)
+
+    for image in images:
+        virtual_size = 0
+        layer_id = image['Id']
+        seen = set()
+
+        while layer_id in sizes_by_id and layer_id not in seen:
+            seen.add(layer_id)
+            virtual_size += sizes_by_id[layer_id]
+            layer_id = parents_by_id[layer_id]
+
+        image['VirtualSize'] = virtual_size
+
+# ========================================================================
+def _copyanddigest(src_file, dst_file):
+    # Copies src_file to dst_file, returning the digest of what was copied
+    # (in the form Docker uses for diff IDs)
+    from hashlib import sha256
+    hash_obj = sha256()
+
+    while True:
+        buf = src_file.read(_COPY_BUFSIZE)
+
+        if not buf:
+            break
+
+        hash_obj.update(buf)
+        dst_file.write(buf)
+
+    return 'sha256:' + hash_obj.hexdigest()
+
+# ========================================================================
+def _digest(src_file):
+    # Returns the digest of what remains of src_file (in the form Docker
+    # uses for diff IDs)
+    from hashlib import sha256
+    hash_obj = sha256()
+
+    for buf in iter(partial(src_file.read, _COPY_BUFSIZE), b''):
+        hash_obj.update(buf)
+
+    return 'sha256:' + hash_obj.hexdigest()
+
+# ========================================================================
+def _filterimages(all_images, name, quiet, all, viz, filters):  # pylint: disable=redefined-builtin
+    # Emulates docker.Client.images over all_images (image descriptions
+    # in the form it returns), supporting the "dangling" filter (the only
+    # one answerable from the metadata we keep)
+    if viz:
+        raise ValueError('viz output is not supported')
+
+    images = [ dict(image) for image in all_images ]
+
+    if name:
+        images = [ image for image in images if name in image['RepoTags'] or image['Id'].startswith(name.lower()) ]
+
+    if not all:
+        child_ids = set(image['ParentId'] for image in all_images)
+        images = [ image for image in images if image['Id'] not in child_ids ]
+
+    for filter_name, value in ( filters or {} ).items():
+        if filter_name != 'dangling':
+            raise ValueError('unsupported filter "{}" (must be "dangling")'.format(filter_name))
+
+        dangling = value if isinstance(value, bool) else str(value).lower() in ( '1', 'true' )
+        images = [ image for image in images if ( image['RepoTags'] in ( [], [ '<none>:<none>' ] ) ) == dangling ]
+
+    if quiet:
+        return [ image['Id'] for image in images ]
+
+    return images
+
+# ========================================================================
+def _getimages(dc, image_specs):
+    # Like docker.Client.get_image, but for several images at once (see
+    # <https://docs.docker.com/engine/api/v1.24/#get-a-tarball-containing-all-images>)
+    res = dc._get(dc._url('/images/get'), params={ 'names': image_specs }, stream=True)  # pylint: disable=protected-access
+    dc._raise_for_status(res)  # pylint: disable=protected-access
+
+    return res.raw
+
+# ========================================================================
+def _ismetadataname(name):
+    # Returns True if name is a top-level JSON member of an export (i.e.,
+    # manifest.json or an image configuration)
+    return '/' not in name \
+        and name.endswith('.json')
+
+# ========================================================================
+def _isoverlayopaque(path):
+    # Returns True if the directory at path is marked opaque by overlayfs
+    # (extended attributes are only readable on Python 3 and Linux)
+    try:
+        from os import getxattr
+    except ImportError:
+        return False
+
+    for xattr in _OVERLAY_OPAQUE_XATTRS:
+        try:
+            if getxattr(path, xattr, follow_symlinks=False) == b'y':
+                return True
+        except EnvironmentError:
+            pass
+
+    return False
+
+# ========================================================================
+def _layeridfromname(root, name, image_spec):
+    # Returns the layer ID if name is "<layer_id>/layer.tar"; raises
+    # UnsafeTarPath if name would escape root
+    path = ospath_realpath(ospath_join(root, name))
+
+    if not path.startswith(root):
+        exc = UnsafeTarPath('unsafe path: "{}"'.format(name))
+        logexception(_LOGGER, ERROR, 'unable to retrieve entry from export of "{}": {{e}}'.format(image_spec), exc)
+
+    parts = posixpath_normpath(name).split('/')
+
+    if len(parts) == 2 \
+            and parts[1] == _LAYER_TAR:
+        return parts[0]
+
+    return None
+
+# ========================================================================
+def _linktarget(info):
+    # Resolves a link's target relative to the directory of the link (for
+    # symbolic links) or the archive's root (for hard links)
+    if info.issym():
+        return posixpath_normpath(posixpath_join(posixpath_dirname(info.name), info.linkname))
+
+    return posixpath_normpath(info.linkname)
+
+# ========================================================================
+def _readlayerdb(root, driver, cache_ids):
+    # Reads the layer database (and the image database and repositories
+    # for tags and creation times) of the driver under root, returning
+    # image descriptions in the form returned by docker.Client.images;
+    # cache_ids is populated with the driver's directory for each layer
+    from hashlib import sha256
+    from json import loads as json_loads
+
+    image_root = ospath_join(root, 'image', driver)
+    layerdb_dir = ospath_join(image_root, 'layerdb', 'sha256')
+    images = []
+
+    for chain_id in sorted(listdir(layerdb_dir)):
+        layer_dir = ospath_join(layerdb_dir, chain_id)
+
+        if not isdir(layer_dir):
+            continue
+
+        cache_ids[chain_id] = _readdbfile(layer_dir, 'cache-id')
+        images.append({
+            'Created': int(lstat(layer_dir).st_mtime),
+            'Id': chain_id,
+            'ParentId': _stripdigestalgo(_readdbfile(layer_dir, 'parent', '')),
+            'RepoTags': [],
+            'Size': int(_readdbfile(layer_dir, 'size', '0') or 0),
+        })
+
+    images_by_id = dict(( image['Id'], image ) for image in images)
+
+    try:
+        with open(ospath_join(image_root, 'repositories.json'), 'rb') as repositories_file:
+            repositories = json_loads(repositories_file.read().decode('utf-8')).get('Repositories') or {}
+    except EnvironmentError:
+        repositories = {}
+
+    tags_by_image_id = {}
+
+    for refs in repositories.values():
+        for ref, image_id in refs.items():
+            if '@' not in ref:
+                tags_by_image_id.setdefault(_stripdigestalgo(image_id), []).append(ref)
+
+    imagedb_dir = ospath_join(image_root, 'imagedb', 'content', 'sha256')
+
+    for image_id in sorted(listdir(imagedb_dir)) if isdir(imagedb_dir) else ():
+        with open(ospath_join(imagedb_dir, image_id), 'rb') as config_file:
+            config = json_loads(config_file.read().decode('utf-8'))
+
+        chain_id = None
+
+        # See <https://github.com/opencontainers/image-spec/blob/master/config.md#layer-chainid>
+        for diff_id in ( config.get('rootfs') or {} ).get('diff_ids') or ():
+            chain_id = diff_id if chain_id is None else 'sha256:' + sha256('{} {}'.format(chain_id, diff_id).encode('utf-8')).hexdigest()
+
+        image = images_by_id.get(_stripdigestalgo(chain_id or ''))
+
+        if image is None:
+            continue
+
+        if config.get('created'):
+            image['Created'] = config['created']
+
+        image['RepoTags'].extend(tags_by_image_id.get(image_id, ()))
+
+    for image in images:
+        image['RepoTags'] = sorted(set(image['RepoTags'])) or [ '<none>:<none>' ]
+
+    _addvirtualsizes(images)
+
+    return images
+
+# ========================================================================
+def _readdbfile(layer_dir, name, default=None):
+    # Returns the (stripped) contents of the file name in layer_dir, or
+    # default if it does not exist (and default is not None)
+    try:
+        with open(ospath_join(layer_dir, name), 'rb') as db_file:
+            return db_file.read().decode('utf-8').strip()
+    except EnvironmentError:
+        if default is None:
+            raise
+
+        return default
+
+# ========================================================================
+def _readsavemetadata(path, layer_members, diff_ids=None):
+    # Reads the per-layer json metadata, repositories, and manifest.json
+    # from the archive at path, returning image descriptions in the form
+    # returned by docker.Client.images and whether the archive is seekable
+    # (i.e., not compressed). If it is, layer_members is populated with the
+    # offsets and sizes of each layer.tar. If diff_ids is provided, it is
+    # populated with each layer's diff ID from its image's configuration.
+    from json import loads as json_loads
+    from tarfile import (
+        ReadError,
+        open as tarfile_open,
+    )
+
+    configs = {}
+    layer_jsons = {}
+    layer_sizes = {}
+    repositories = {}
+    manifest = []
+
+    try:
+        tar_file = tarfile_open(path, mode='r:')
+    except ReadError:
+        tar_file = tarfile_open(path, mode='r|*')
+        seekable = False
+    else:
+        seekable = True
+
+    with tar_file:
+        links = {}
+
+        for info in tar_file:
+            parts = posixpath_normpath(info.name).split('/')
+
+            if len(parts) == 2 \
+                    and parts[1] == 'json':
+                layer_jsons[parts[0]] = json_loads(tar_file.extractfile(info).read().decode('utf-8'))
+            elif len(parts) == 2 \
+                    and parts[1] == _LAYER_TAR:
+                if info.issym() or info.islnk():
+                    links[parts[0]] = _linktarget(info)
+                else:
+                    layer_sizes[parts[0]] = info.size
+
+                    if seekable:
+                        layer_members[parts[0]] = ( info.offset_data, info.size )
+            elif info.name == 'repositories':
+                repositories = json_loads(tar_file.extractfile(info).read().decode('utf-8'))
+            elif info.name == 'manifest.json':
+                manifest = json_loads(tar_file.extractfile(info).read().decode('utf-8'))
+            elif diff_ids is not None \
+                    and len(parts) == 1 \
+                    and info.isreg() \
+                    and _ismetadataname(info.name):
+                configs[info.name] = json_loads(tar_file.extractfile(info).read().decode('utf-8'))
+
+        for layer_id, target in links.items():
+            target_id = target.split('/')[0]
+            layer_sizes[layer_id] = layer_sizes.get(target_id, 0)
+
+            if seekable \
+                    and target_id in layer_members:
+                layer_members[layer_id] = layer_members[target_id]
+
+    tags_by_id = {}
+
+    for repo, tags in repositories.items():
+        for tag, layer_id in tags.items():
+            tags_by_id.setdefault(layer_id, []).append('{}:{}'.format(repo, tag))
+
+    for entry in manifest:
+        layers = entry.get('Layers') or ()
+
+        if diff_ids is not None:
+            config = configs.get(entry.get('Config'))
+            config_diff_ids = ( config.get('rootfs') or {} ).get('diff_ids') if isinstance(config, dict) else None
+
+            for layer_path, diff_id in zip(layers, config_diff_ids or ()):
+                layer_id = posixpath_normpath(layer_path).split('/')[0]
+                diff_ids[layer_id] = diff_id
+
+                if layer_id in links:
+                    diff_ids.setdefault(links[layer_id].split('/')[0], diff_id)
+
+        if layers:
+            top_id = posixpath_normpath(layers[-1]).split('/')[0]
+
+            for repo_tag in entry.get('RepoTags') or ():
+                if repo_tag not in tags_by_id.get(top_id, ()):
+                    tags_by_id.setdefault(top_id, []).append(repo_tag)
+
+    images = []
+
+    for layer_id, layer_json in layer_jsons.items():
+        images.append({
+            'Created': layer_json.get('created', 0),
+            'Id': layer_json.get('id', layer_id),
+            'ParentId': layer_json.get('parent', ''),
+            'RepoTags': sorted(tags_by_id.get(layer_id, ())) or [ '<none>:<none>' ],
+            'Size': layer_json.get('Size', layer_sizes.get(layer_id, 0)),
+        })
+
+    _addvirtualsizes(images)
+
+    return images, seekable
+
+# ========================================================================
+def _sparsesegments(path, size):
+    # Returns the ( offset, size ) data segments of the file at path (of
+    # size), or None if it has no holes (or they can't be found)
+    try:
+        from os import (
+            SEEK_DATA,
+            SEEK_HOLE,
+        )
+    except ImportError:  # Python 2 or no support
+        return None
+
+    from errno import ENXIO
+    from os import lseek
+    segments = []
+
+    try:
+        with open(path, 'rb') as f:
+            offset = 0
+
+            while offset < size:
+                try:
+                    data_offset = lseek(f.fileno(), offset, SEEK_DATA)
+                except EnvironmentError as e:
+                    if e.errno != ENXIO:
+                        raise
+
+                    break  # only a hole remains
+
+                offset = min(lseek(f.fileno(), data_offset, SEEK_HOLE), size)
+                segments.append(( data_offset, offset - data_offset ))
+    except EnvironmentError:
+        return None
+
+    if sum(length for _, length in segments) >= size:
+        return None
+
+    return segments
+
+# ========================================================================
+def _stripdigestalgo(digest):
+    # Returns digest without any "sha256:" (or similar) prefix
+    return digest.split(':', 1)[-1]
+
+# ========================================================================
+def _tarinfofromstat(name, path, st):
+    # Returns a TarInfo for the file at path (with the results of lstat
+    # st), as it would appear in a layer's archive as name
+    from tarfile import (
+        BLKTYPE,
+        CHRTYPE,
+        DIRTYPE,
+        FIFOTYPE,
+        REGTYPE,
+        SYMTYPE,
+        TarInfo,
+    )
+
+    info = TarInfo(name)
+    info.mode = S_IMODE(st.st_mode)
+    info.uid = st.st_uid
+    info.gid = st.st_gid
+    info.mtime = int(st.st_mtime)
+    mode = st.st_mode
+
+    if S_ISREG(mode):
+        info.type = REGTYPE
+        info.size = st.st_size
+
+        # Only a file with fewer blocks than its size can have holes
+        if getattr(st, 'st_blocks', st.st_size) * 512 < st.st_size:
+            info.sparse = _sparsesegments(path, st.st_size)
+    elif S_ISDIR(mode):
+        info.type = DIRTYPE
+    elif S_ISLNK(mode):
+        info.type = SYMTYPE
+        info.linkname = readlink(path)
+    elif S_ISCHR(mode) or S_ISBLK(mode):
+        from os import (
+            major,
+            minor,
+        )
+
+        info.type = CHRTYPE if S_ISCHR(mode) else BLKTYPE
+        info.devmajor = major(st.st_rdev)
+        info.devminor = minor(st.st_rdev)
+    elif S_ISFIFO(mode):
+        info.type = FIFOTYPE
+    else:
+        raise ValueError('unsupported file type for "{}"'.format(path))
+
+    return info
+
+# ========================================================================
+def _whiteoutinfo(name, st):
+    # Returns a TarInfo for an (empty) whiteout file called name, owned
+    # like the file (with the results of lstat st) that it represents
+    from tarfile import TarInfo
+
+    info = TarInfo(name)
+    info.uid = st.st_uid
+    info.gid = st.st_gid
+    info.mtime = int(st.st_mtime)
+
+    return info
@@ -0,0 +1,1006 @@
+# -*- encoding: utf-8; mode: python; grammar-ext: py -*-
+
+# ========================================================================
+"""
+Copyright and other protections apply. Please see the accompanying
+:doc:`LICENSE <LICENSE>` and :doc:`CREDITS <CREDITS>` file(s) for rights
+and restrictions governing use of this software. All rights not expressly
+waived or licensed are reserved. If those files are missing or appear to
+be modified from their originals, then please contact the author before
+viewing or using this software in any capacity.
+"""
+# ========================================================================
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals,
+)
+from builtins import *  # noqa: F401,F403; pylint: disable=redefined-builtin,unused-wildcard-import,useless-suppression,wildcard-import
+from future.builtins.disabled import *  # noqa: F401,F403; pylint: disable=redefined-builtin,unused-wildcard-import,useless-suppression,wildcard-import
+
+# ---- Imports -----------------------------------------------------------
+
+from collections import OrderedDict
+from copy import copy as shallowcopy
+from errno import EEXIST
+from logging import (
+    ERROR,
+    WARNING,
+    getLogger,
+)
+from os import (
+    chmod,
+    fdopen,
+    link,
+    listdir,
+    lstat,
+    makedirs,
+    rename,
+    symlink,
+    unlink,
+    utime,
+)
+from os.path import (
+    dirname as ospath_dirname,
+    isdir,
+    islink,
+    join as ospath_join,
+    lexists,
+    realpath as ospath_realpath,
+    sep as ospath_sep,
+)
+from posixpath import (
+    dirname as posixpath_dirname,
+    isabs as posixpath_isabs,
+    join as posixpath_join,
+    normpath as posixpath_normpath,
+    split as posixpath_split,
+)
+from stat import S_ISDIR
+from threading import BoundedSemaphore
+from _dimgx import (
+    UnsafeTarPath,
+    logexception,
+)
+
+# ---- Constants ---------------------------------------------------------
+
+__all__ = (
+    'ArchiveCache',
+    'ArchiveIndexer',
+    'BlockGzipFile',
+    'DigestingFile',
+    'DirectoryWriter',
+    'OciLayoutWriter',
+    'imageconfig',
+    'sparsemember',
+)
+
+_LOGGER = getLogger(__name__.lstrip('_'))
+_GZIP_BLOCK_SIZE = 1 << 20
+_INDEX_VERSION = 1
+_MAX_BUFFERED_SIZE = 1 << 23  # larger files are written in the caller's thread
+_PENDING_PER_WORKER = 4
+_SPARSE_DIR = 'GNUSparseFile.0'  # what GNU tar puts in placeholder names
+_SPARSE_PAX_PFX = 'GNU.sparse.'
+_OCI_CONFIG_TYPE = 'application/vnd.oci.image.config.v1+json'
+_OCI_INDEX_TYPE = 'application/vnd.oci.image.index.v1+json'
+_OCI_LAYER_TYPE = 'application/vnd.oci.image.layer.v1.tar+gzip'
+_OCI_MANIFEST_TYPE = 'application/vnd.oci.image.manifest.v1+json'
+_OCI_REF_NAME = 'org.opencontainers.image.ref.name'
+
+# ---- Classes -----------------------------------------------------------
+
+# ========================================================================
+class ArchiveCache(object):
+    """
+    A cache of finished archives in the directory :obj:`path` (which is
+    created if necessary), so that producing the same archive again (i.e.,
+    from the same layers with the same options; see :meth:`key`) only
+    requires copying (or, if :obj:`link` is :const:`True`, hard linking)
+    it. Hard links are cheaper, but a cached archive and the targets
+    linked to it share their contents, so they must not be modified in
+    place.
+
+    Once the archives in the cache exceed :obj:`max_size` bytes in total,
+    or number more than :obj:`max_entries`, the least recently used ones
+    are removed (if either is :const:`None`, that limit is not enforced).
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, path, max_size=None, max_entries=None, link=False):
+        super().__init__()
+        self.path = path
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.link = link
+
+        if not isdir(path):
+            makedirs(path)
+
+    # ---- Public methods ------------------------------------------------
+
+    def evict(self):
+        """
+        Removes the least recently used archives until what remains is
+        within :attr:`max_size` and :attr:`max_entries`.
+        """
+        entries = []
+
+        for name in listdir(self.path):
+            if name.startswith('.'):
+                continue
+
+            entry_path = ospath_join(self.path, name)
+
+            try:
+                st = lstat(entry_path)
+            except OSError:
+                continue
+
+            entries.append(( st.st_mtime, st.st_size, entry_path ))
+
+        entries.sort(reverse=True)
+        total_size = sum(size for _, size, _ in entries)
+
+        while entries \
+                and ( ( self.max_size is not None and total_size > self.max_size ) or ( self.max_entries is not None and len(entries) > self.max_entries ) ):
+            _, size, entry_path = entries.pop()
+            _LOGGER.debug('evicting "%s" from the cache', entry_path)
+            _removeexisting(entry_path)
+            total_size -= size
+
+    def fetch(self, key, target_path):
+        """
+        Writes the archive cached for :obj:`key` to :obj:`target_path`
+        (replacing anything there), and returns :const:`True`, or returns
+        :const:`False` if there is no such archive.
+        """
+        from shutil import copyfile
+        entry_path = self._entrypath(key)
+
+        try:
+            # Mark it as recently used
+            utime(entry_path, None)
+        except OSError:
+            return False
+
+        _removeexisting(target_path)
+
+        if self.link:
+            try:
+                link(entry_path, target_path)
+            except OSError as e:
+                _LOGGER.debug('unable to link "%s" to "%s" (%s); copying instead', target_path, entry_path, e)
+            else:
+                return True
+
+        copyfile(entry_path, target_path)
+
+        return True
+
+    @staticmethod
+    def key(layer_ids, **options):
+        """
+        Returns a key identifying the archive of the layers
+        :obj:`layer_ids` (in order) written with :obj:`options` (e.g.,
+        ``compression='gz', include=[ 'etc' ]``), which must be JSON
+        serializable.
+        """
+        from hashlib import sha256
+
+        return sha256(_jsonbytes({ 'layers': list(layer_ids), 'options': options })).hexdigest()
+
+    def store(self, key, archive_path):
+        """
+        Caches the archive at :obj:`archive_path` for :obj:`key`, and then
+        removes the least recently used archives as necessary.
+        """
+        from shutil import copyfile
+        from tempfile import mkstemp
+        fd, tmp_path = mkstemp(dir=self.path, prefix='.tmp-')
+
+        try:
+            fdopen(fd, 'wb').close()
+            linked = False
+
+            if self.link:
+                try:
+                    unlink(tmp_path)
+                    link(archive_path, tmp_path)
+                    linked = True
+                except OSError as e:
+                    _LOGGER.debug('unable to link "%s" to "%s" (%s); copying instead', tmp_path, archive_path, e)
+
+            if not linked:
+                copyfile(archive_path, tmp_path)
+
+            rename(tmp_path, self._entrypath(key))
+        except BaseException:
+            _removeexisting(tmp_path)
+            raise
+
+        # A linked archive keeps its own mtime, but it's the most recently
+        # used now
+        utime(self._entrypath(key), None)
+        self.evict()
+
+    # ---- Private methods -----------------------------------------------
+
+    def _entrypath(self, key):
+        return ospath_join(self.path, key)
+
+# ========================================================================
+class ArchiveIndexer(object):
+    """
+    A wrapper around :obj:`tar_file` (a :class:`~tarfile.TarFile` open for
+    writing, e.g., for use with :func:`~dimgx.extractlayers`) that records
+    where each member is written, so that an index can be written
+    alongside the archive (see :meth:`writeindex`) with which readers can
+    find members without scanning the archive.
+
+    :attr:`members` is a list of ``( name, header_offset, data_offset,
+    size, type )`` tuples (in the order they were written), where the
+    offsets are into the uncompressed archive, and ``type`` is the tar
+    type flag (e.g., ``'0'`` for a regular file, or ``'5'`` for a
+    directory).
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, tar_file):
+        super().__init__()
+        self.tar_file = tar_file
+        self.members = []
+
+    # ---- Public methods ------------------------------------------------
+
+    def addfile(self, tarinfo, fileobj=None):
+        """
+        Adds :obj:`tarinfo` (with contents read from :obj:`fileobj`) to
+        :attr:`tar_file`, like :meth:`tarfile.TarFile.addfile`.
+        """
+        from tarfile import BLOCKSIZE
+        header_offset = self.tar_file.offset
+        self.tar_file.addfile(tarinfo, fileobj)
+        size = tarinfo.size if fileobj is not None else 0
+        data_offset = self.tar_file.offset - -(-size // BLOCKSIZE) * BLOCKSIZE
+        self.members.append(( tarinfo.name, header_offset, data_offset, size, tarinfo.type.decode('ascii') ))
+
+    def writeindex(self, fileobj, blocks=None):
+        """
+        Writes the index to :obj:`fileobj` as (compact) JSON, in the form
+        ``{ "version": 1, "members": [ [ name, header_offset, data_offset,
+        size, type ], ... ] }`` (see :attr:`members`). If the archive was
+        compressed with a :class:`BlockGzipFile`, its :attr:`~BlockGzipFile.blocks`
+        should be provided as :obj:`blocks`, and are included as
+        ``"blocks": [ [ offset, compressed_offset ], ... ]``.
+        """
+        index = { 'version': _INDEX_VERSION, 'members': [ list(member) for member in self.members ] }
+
+        if blocks is not None:
+            index['blocks'] = [ list(block) for block in blocks ]
+
+        fileobj.write(_jsonbytes(index))
+
+# ========================================================================
+class BlockGzipFile(object):
+    """
+    A write-only wrapper around :obj:`fileobj` that gzip-compresses what
+    is written through it in blocks of :obj:`block_size` (uncompressed)
+    bytes, each compressed independently as a complete gzip member. The
+    result is still an ordinary gzip stream (members may be concatenated),
+    but one that can be decompressed starting at any block.
+
+    :attr:`blocks` is a list of ``( offset, compressed_offset )`` tuples,
+    one for each block written so far, where ``offset`` is where the block
+    starts in the uncompressed data, and ``compressed_offset`` is where
+    its gzip member starts in :obj:`fileobj` (relative to where writing
+    began). So to read from ``offset`` ``n``, a reader can seek to the
+    ``compressed_offset`` of the last block whose ``offset`` is no more
+    than ``n``, decompress from there, and skip what precedes ``n``.
+
+    :meth:`close` must be called to write the last (partial) block, but
+    does not close :obj:`fileobj`.
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, fileobj, block_size=_GZIP_BLOCK_SIZE, compresslevel=9):
+        super().__init__()
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self.compresslevel = compresslevel
+        self.blocks = []
+        self._buf = bytearray()
+        self._offset = 0
+        self._compressed_offset = 0
+
+    # ---- Public methods ------------------------------------------------
+
+    def close(self):
+        if self._buf:
+            self._writeblock(len(self._buf))
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def tell(self):
+        return self._offset + len(self._buf)
+
+    def write(self, data):
+        self._buf.extend(data)
+
+        while len(self._buf) >= self.block_size:
+            self._writeblock(self.block_size)
+
+        return len(data)
+
+    # ---- Private methods -----------------------------------------------
+
+    def _writeblock(self, size):
+        from gzip import GzipFile
+        from io import BytesIO
+        compressed_file = BytesIO()
+
+        with GzipFile(filename='', mode='wb', compresslevel=self.compresslevel, fileobj=compressed_file, mtime=0) as gzip_file:
+            gzip_file.write(bytes(self._buf[:size]))
+
+        compressed = compressed_file.getvalue()
+        self.fileobj.write(compressed)
+        self.blocks.append(( self._offset, self._compressed_offset ))
+        self._offset += size
+        self._compressed_offset += len(compressed)
+        del self._buf[:size]
+
+# ========================================================================
+class DigestingFile(object):
+    """
+    A write-only wrapper around :obj:`fileobj` that computes the SHA-256
+    digest of everything written through it (e.g., to report the digest
+    of an archive as it is written rather than by reading it back).
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, fileobj):
+        super().__init__()
+        from hashlib import sha256
+        self.fileobj = fileobj
+        self.hash_obj = sha256()
+        self.size = 0
+
+    # ---- Public properties ---------------------------------------------
+
+    @property
+    def digest(self):
+        """
+        The digest of what has been written so far (e.g.,
+        ``'sha256:0123...'``).
+        """
+        return 'sha256:' + self.hash_obj.hexdigest()
+
+    # ---- Public methods ------------------------------------------------
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def tell(self):
+        return self.fileobj.tell()
+
+    def write(self, data):
+        self.hash_obj.update(data)
+        self.size += len(data)
+
+        return self.fileobj.write(data)
+
+# ========================================================================
+class DirectoryWriter(object):
+    """
+    A stand-in for a :class:`~tarfile.TarFile` open for writing (e.g., for
+    use with :func:`~dimgx.extractlayers`) that materializes entries in
+    the directory :obj:`path` (which is created if necessary) rather than
+    archiving them.
+
+    Regular files are written by :obj:`num_workers` threads (defaults to
+    twice the number of CPUs). Links, devices, and FIFOs are created, and
+    ownership (if :obj:`preserve_owner` is :const:`True`, which it is by
+    default when running as root), modes, and modification times are
+    applied, in a final pass when the writer is closed, so that the
+    result does not depend on the order in which entries arrive.
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, path, num_workers=None, preserve_owner=None):
+        super().__init__()
+        from multiprocessing.pool import ThreadPool
+
+        if num_workers is None:
+            from multiprocessing import cpu_count
+            num_workers = 2 * cpu_count()
+
+        if preserve_owner is None:
+            try:
+                from os import geteuid
+            except ImportError:
+                preserve_owner = False
+            else:
+                preserve_owner = geteuid() == 0
+
+        if not isdir(path):
+            makedirs(path)
+
+        self.path = ospath_realpath(path)
+        self.preserve_owner = preserve_owner
+        self._closed = False
+        self._created_dirs = set()
+        self._deferred = []
+        self._infos = []
+        self._pending = []
+        self._pool = ThreadPool(max(1, num_workers))
+        self._pool_slots = BoundedSemaphore(max(1, num_workers) * _PENDING_PER_WORKER)
+
+    # ---- Public hooks --------------------------------------------------
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort()
+
+    # ---- Public methods ------------------------------------------------
+
+    def addfile(self, tarinfo, fileobj=None):
+        """
+        Materializes :obj:`tarinfo` (with contents read from
+        :obj:`fileobj` if it is a regular file). Like
+        :meth:`tarfile.TarFile.addfile`, :obj:`fileobj` is fully read
+        before returning, so it can be reused by the caller. If
+        :obj:`tarinfo` has data segments (see :func:`sparsemember`), only
+        those are read and written, leaving holes in between.
+        """
+        path = self._targetpath(tarinfo.name)
+        self._makeparents(tarinfo.name)
+        self._infos.append(( tarinfo, path ))
+
+        if tarinfo.isdir():
+            if path not in self._created_dirs:
+                if islink(path) \
+                        or not isdir(path):
+                    _removeexisting(path)
+                    makedirs(path)
+
+                self._created_dirs.add(path)
+        elif tarinfo.isreg():
+            if tarinfo.sparse is not None:
+                _writesparsefile(path, fileobj, tarinfo.sparse, tarinfo.size)
+            elif tarinfo.size > _MAX_BUFFERED_SIZE:
+                _writefile(path, _iterchunks(fileobj, tarinfo.size))
+            else:
+                data = fileobj.read(tarinfo.size) if fileobj is not None else b''
+                self._pool_slots.acquire()
+
+                try:
+                    self._pending.append(self._pool.apply_async(_writefile, ( path, ( data, ), self._pool_slots )))
+                except Exception:
+                    self._pool_slots.release()
+                    raise
+
+                self._reapfinished()
+        else:
+            self._deferred.append(( tarinfo, path ))
+
+    def close(self):
+        """
+        Waits for any pending writes and performs the final pass (see
+        above).
+        """
+        if self._closed:
+            return
+
+        self._closed = True
+        self._pool.close()
+
+        try:
+            for pending in self._pending:
+                pending.get()
+        finally:
+            self._pool.join()
+
+        del self._pending[:]
+
+        # Symlinks created in this pass can change where later entries'
+        # parents resolve, so those entries are checked again
+        made_symlinks = False
+
+        for tarinfo, path in self._deferred:
+            if made_symlinks:
+                self._targetpath(tarinfo.name)
+
+            self._createspecial(tarinfo, path)
+            made_symlinks = made_symlinks or tarinfo.issym()
+
+        # Apply metadata to the deepest entries first so that setting (e.g.)
+        # a directory's mtime isn't undone by touching its contents
+        for tarinfo, path in sorted(self._infos, key=lambda i: i[1].count('/'), reverse=True):
+            if made_symlinks:
+                self._targetpath(tarinfo.name)
+
+            self._applymetadata(tarinfo, path)
+
+    # ---- Private methods -----------------------------------------------
+
+    def _abort(self):
+        self._closed = True
+        self._pool.terminate()
+        self._pool.join()
+
+    def _applymetadata(self, tarinfo, path):
+        if tarinfo.islnk() \
+                or not lexists(path):
+            return
+
+        if self.preserve_owner:
+            from os import lchown
+            logexception(_LOGGER, WARNING, 'unable to set the owner of "{}": {{e}}'.format(tarinfo.name), lchown, path, tarinfo.uid, tarinfo.gid)
+
+        if tarinfo.issym():
+            # Most platforms can't set the mode or times of a link itself
+            return
+
+        chmod(path, tarinfo.mode)
+        utime(path, ( tarinfo.mtime, tarinfo.mtime ))
+
+    def _createspecial(self, tarinfo, path):
+        _removeexisting(path)
+
+        if tarinfo.issym():
+            logexception(_LOGGER, WARNING, 'unable to create symlink "{}" to "{}": {{e}}'.format(tarinfo.name, tarinfo.linkname), symlink, tarinfo.linkname, path)
+        elif tarinfo.islnk():
+            # The link is made to whatever the target resolves to, so that
+            # must be inside the directory, too
+            link_target = self._targetpath(tarinfo.linkname, resolve=True)
+            logexception(_LOGGER, WARNING, 'unable to link "{}" to "{}": {{e}}'.format(tarinfo.name, tarinfo.linkname), link, link_target, path)
+        elif tarinfo.ischr() or tarinfo.isblk() or tarinfo.isfifo():
+            from os import (
+                makedev,
+                mknod,
+            )
+            from stat import (
+                S_IFBLK,
+                S_IFCHR,
+                S_IFIFO,
+            )
+
+            if tarinfo.ischr():
+                mode = S_IFCHR
+            elif tarinfo.isblk():
+                mode = S_IFBLK
+            else:
+                mode = S_IFIFO
+
+            logexception(_LOGGER, WARNING, 'unable to create "{}": {{e}}'.format(tarinfo.name), mknod, path, mode | tarinfo.mode, makedev(tarinfo.devmajor, tarinfo.devminor))
+        else:
+            _LOGGER.warning('skipping "%s" of unsupported type %r', tarinfo.name, tarinfo.type)
+
+    def _makeparents(self, name):
+        # Entries arrive newest layer first, so a file may arrive before its
+        # parent directory does
+        parent = posixpath_dirname(posixpath_normpath(name))
+
+        if not parent:
+            return
+
+        parent_path = ospath_join(self.path, parent)
+
+        if parent_path in self._created_dirs:
+            return
+
+        try:
+            makedirs(parent_path)
+        except OSError as e:
+            if e.errno != EEXIST \
+                    or not isdir(parent_path):
+                raise
+
+        self._created_dirs.add(parent_path)
+
+    def _reapfinished(self):
+        # Surface failures early (and don't hold on to finished results)
+        if len(self._pending) < 2 * _PENDING_PER_WORKER:
+            return
+
+        still_pending = []
+
+        for pending in self._pending:
+            if pending.ready():
+                pending.get()
+            else:
+                still_pending.append(pending)
+
+        self._pending[:] = still_pending
+
+    def _targetpath(self, name, resolve=False):
+        # Returns the path for name in the directory, raising UnsafeTarPath
+        # if it (or, if resolve is True, what it resolves to) is outside of
+        # it (e.g., by way of an existing symlink)
+        norm_name = posixpath_normpath(name)
+
+        if posixpath_isabs(norm_name) \
+                or norm_name == '..' \
+                or norm_name.startswith('../'):
+            exc = UnsafeTarPath('unsafe path: "{}"'.format(name))
+            logexception(_LOGGER, ERROR, 'unable to write entry to "{}": {{e}}'.format(self.path), exc)
+
+        path = ospath_join(self.path, norm_name)
+        real_path = ospath_realpath(path if resolve else ospath_dirname(path))
+
+        if real_path != self.path \
+                and not real_path.startswith(self.path.rstrip(ospath_sep) + ospath_sep):
+            exc = UnsafeTarPath('path resolves outside of "{}": "{}"'.format(self.path, name))
+            logexception(_LOGGER, ERROR, 'unable to write entry to "{}": {{e}}'.format(self.path), exc)
+
+        return path
+
+# ========================================================================
+class OciLayoutWriter(object):
+    """
+    A stand-in for a :class:`~tarfile.TarFile` open for writing (e.g., for
+    use with :func:`~dimgx.extractlayers`) that writes an `OCI image
+    layout <https://github.com/opencontainers/image-spec/blob/main/image-layout.md>`__
+    in the directory :obj:`path` (which is created if necessary) with the
+    entries as its single (gzip-compressed) layer.
+
+    The layer's diff ID (the digest of the uncompressed archive) and its
+    blob's digest and size are computed as entries are written, so the
+    configuration, manifest, and index can be written when the writer is
+    closed without reading the layer back. :obj:`config` provides the
+    rest of the image configuration (see :func:`imageconfig`). If
+    :obj:`ref_name` is provided, the manifest is annotated with it in the
+    index (replacing any other with the same name if :obj:`path` already
+    contains a layout).
+
+    After closing, :attr:`manifest_descriptor` describes the manifest.
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, path, ref_name=None, config=None, compresslevel=9):
+        super().__init__()
+        from gzip import GzipFile
+        from tarfile import TarFile
+        from tempfile import mkstemp
+        self.path = path
+        self.ref_name = ref_name
+        self.config = dict(config) if config else {}
+        self.manifest_descriptor = None
+        self._blobs_dir = ospath_join(path, 'blobs', 'sha256')
+
+        if not isdir(self._blobs_dir):
+            makedirs(self._blobs_dir)
+
+        fd, self._tmp_path = mkstemp(dir=self._blobs_dir, prefix='.tmp-')
+        self._blob_file = DigestingFile(fdopen(fd, 'wb'))
+        self._gzip_file = GzipFile(filename='', mode='wb', compresslevel=compresslevel, fileobj=self._blob_file, mtime=0)
+        self._diff_file = DigestingFile(self._gzip_file)
+        self._tar_file = TarFile(mode='w', fileobj=self._diff_file)
+
+    # ---- Public hooks --------------------------------------------------
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort()
+
+    # ---- Public methods ------------------------------------------------
+
+    def addfile(self, tarinfo, fileobj=None):
+        """
+        Adds :obj:`tarinfo` (with contents read from :obj:`fileobj`) to the
+        layer, like :meth:`tarfile.TarFile.addfile` (but as a sparse member
+        if it has data segments; see :func:`sparsemember`).
+        """
+        from tarfile import PAX_FORMAT
+
+        if tarinfo.sparse is not None \
+                and self._tar_file.format == PAX_FORMAT:
+            tarinfo, fileobj = sparsemember(tarinfo, fileobj)
+
+        self._tar_file.addfile(tarinfo, fileobj)
+
+    def close(self):
+        """
+        Finishes the layer and writes its blob, the configuration, the
+        manifest, and the index (see above).
+        """
+        if self.manifest_descriptor is not None:
+            return
+
+        self._tar_file.close()
+        self._gzip_file.close()
+        self._blob_file.fileobj.close()
+        layer_descriptor = {
+            'mediaType': _OCI_LAYER_TYPE,
+            'digest': self._blob_file.digest,
+            'size': self._blob_file.size,
+        }
+        rename(self._tmp_path, ospath_join(self._blobs_dir, self._blob_file.hash_obj.hexdigest()))
+
+        manifest = {
+            'schemaVersion': 2,
+            'mediaType': _OCI_MANIFEST_TYPE,
+            'config': self._writeblob(_OCI_CONFIG_TYPE, imageconfig(( self._diff_file.digest, ), self.config)),
+            'layers': [ layer_descriptor ],
+        }
+        manifest_descriptor = self._writeblob(_OCI_MANIFEST_TYPE, manifest)
+
+        if self.ref_name is not None:
+            manifest_descriptor['annotations'] = { _OCI_REF_NAME: self.ref_name }
+
+        self._writeindex(manifest_descriptor)
+        self.manifest_descriptor = manifest_descriptor
+
+    # ---- Private methods -----------------------------------------------
+
+    def _abort(self):
+        self.manifest_descriptor = {}
+
+        try:
+            self._gzip_file.close()
+        finally:
+            self._blob_file.fileobj.close()
+
+        logexception(_LOGGER, WARNING, 'unable to remove "{}": {{e}}'.format(self._tmp_path), unlink, self._tmp_path)
+
+    def _writeblob(self, media_type, obj):
+        from hashlib import sha256
+        data = _jsonbytes(obj)
+        hexdigest = sha256(data).hexdigest()
+        blob_path = ospath_join(self._blobs_dir, hexdigest)
+
+        if not lexists(blob_path):
+            with open(blob_path, 'wb') as blob_file:
+                blob_file.write(data)
+
+        return {
+            'mediaType': media_type,
+            'digest': 'sha256:' + hexdigest,
+            'size': len(data),
+        }
+
+    def _writeindex(self, manifest_descriptor):
+        from json import loads as json_loads
+        index_path = ospath_join(self.path, 'index.json')
+        manifests = []
+
+        if lexists(index_path):
+            with open(index_path, 'rb') as index_file:
+                manifests = json_loads(index_file.read().decode('utf-8')).get('manifests') or []
+
+        if self.ref_name is not None:
+            manifests = [ m for m in manifests if ( m.get('annotations') or {} ).get(_OCI_REF_NAME) != self.ref_name ]
+
+        manifests.append(manifest_descriptor)
+
+        for name, obj in ( ( 'oci-layout', { 'imageLayoutVersion': '1.0.0' } ), ( 'index.json', { 'schemaVersion': 2, 'mediaType': _OCI_INDEX_TYPE, 'manifests': manifests } ) ):
+            with open(ospath_join(self.path, name), 'wb') as f:
+                f.write(_jsonbytes(obj))
+
+# ========================================================================
+class _SparseReader(object):
+    """
+    A file-like object from which the data of a sparse member (see
+    :func:`sparsemember`) can be read: :obj:`sparse_map` followed by each
+    of :obj:`segments` read from :obj:`fileobj`.
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, sparse_map, fileobj, segments):
+        super().__init__()
+        self._buf = bytearray(sparse_map)
+        self._fileobj = fileobj
+        self._segments = iter(segments)
+        self._remaining = 0
+
+    # ---- Public methods ------------------------------------------------
+
+    def read(self, size=-1):
+        buf = self._buf
+
+        while size is None \
+                or size < 0 \
+                or len(buf) < size:
+            if self._remaining <= 0:
+                segment = next(self._segments, None)
+
+                if segment is None:
+                    break
+
+                offset, self._remaining = segment
+                self._fileobj.seek(offset)
+
+                continue
+
+            chunk = self._fileobj.read(min(self._remaining, 1 << 20))
+
+            if not chunk:
+                raise IOError('unexpected end of data')
+
+            self._remaining -= len(chunk)
+            buf.extend(chunk)
+
+        if size is None \
+                or size < 0 \
+                or size > len(buf):
+            size = len(buf)
+
+        data = bytes(buf[:size])
+        del buf[:size]
+
+        return data
+
+# ---- Functions ---------------------------------------------------------
+
+# ========================================================================
+def imageconfig(diff_ids, config=None):
+    """
+    Returns an image configuration (in the form shared by Docker and OCI)
+    for an image whose layers have :obj:`diff_ids`, starting with
+    :obj:`config` (e.g., ``'architecture'``, ``'os'``, ``'created'``, and
+    ``'config'``; the defaults describe a Linux image for ``amd64``).
+    """
+    image_config = { 'architecture': 'amd64', 'os': 'linux' }
+
+    if config:
+        image_config.update(config)
+
+    image_config['rootfs'] = { 'type': 'layers', 'diff_ids': list(diff_ids) }
+    history = { 'comment': 'flattened by dimgx' }
+
+    if image_config.get('created'):
+        history['created'] = image_config['created']
+
+    image_config['history'] = [ history ]
+
+    return image_config
+
+# ========================================================================
+def sparsemember(tarinfo, fileobj=None):
+    """
+    Returns a ``( member_info, member_file )`` tuple with which to add
+    :obj:`tarinfo` to a :class:`~tarfile.TarFile` in PAX format as a
+    sparse member (in GNU's 1.0 format, which GNU tar, bsdtar, and
+    :mod:`tarfile` all read), so that its holes aren't written out in
+    full. :obj:`tarinfo` describes a regular file whose
+    :attr:`~tarfile.TarInfo.sparse` is a list of ``( offset, size )`` data
+    segments (everything else being a hole), and :obj:`fileobj` provides
+    its (expanded) contents, from which only the data segments are read
+    (it must be seekable). If :obj:`fileobj` is :const:`None`, so is
+    ``member_file`` (e.g., where only the member's size is needed).
+
+    The member is written under a placeholder name (in a
+    ``GNUSparseFile.0`` directory alongside where the file belongs), so
+    that a reader that doesn't understand the format extracts the
+    member's encoded data there rather than over anything.
+    """
+    from tarfile import (
+        BLOCKSIZE,
+        REGTYPE,
+    )
+    segments = []
+
+    # GNU tar reads each data segment in whole blocks, so segments are
+    # widened to block boundaries (taking in zeros from the holes around
+    # them) to read the same everywhere
+    for offset, size in tarinfo.sparse:
+        if size <= 0:
+            continue
+
+        start = offset - offset % BLOCKSIZE
+        end = min(-(-(offset + size) // BLOCKSIZE) * BLOCKSIZE, tarinfo.size)
+
+        if segments \
+                and start <= sum(segments[-1]):
+            start = segments[-1][0]
+            end = max(end, sum(segments[-1]))
+            segments.pop()
+
+        segments.append(( start, end - start ))
+
+    # The map ends at the end of the file, even if that's a hole
+    if not segments \
+            or sum(segments[-1]) < tarinfo.size:
+        segments.append(( tarinfo.size, 0 ))
+
+    sparse_map = '{}\n'.format(len(segments)) + ''.join('{}\n{}\n'.format(offset, size) for offset, size in segments)
+    sparse_map = sparse_map.encode('ascii')
+    sparse_map += b'\0' * (-len(sparse_map) % BLOCKSIZE)
+    dir_name, base_name = posixpath_split(tarinfo.name)
+    member_info = shallowcopy(tarinfo)
+    member_info.type = REGTYPE
+    member_info.sparse = None
+    member_info.name = posixpath_join(dir_name, _SPARSE_DIR, base_name)
+    member_info.size = len(sparse_map) + sum(size for _, size in segments)
+
+    # The real name and size must follow the placeholder name and the
+    # stored size (which tarfile would otherwise append), since whichever
+    # comes last is what a reader ends up with
+    pax_headers = OrderedDict(( k, v ) for k, v in tarinfo.pax_headers.items() if not k.startswith(_SPARSE_PAX_PFX) and k not in ( 'path', 'size' ))
+    pax_headers['path'] = member_info.name
+
+    if member_info.size >= 8 ** 11:
+        pax_headers['size'] = str(member_info.size)
+
+    pax_headers[_SPARSE_PAX_PFX + 'major'] = '1'
+    pax_headers[_SPARSE_PAX_PFX + 'minor'] = '0'
+    pax_headers[_SPARSE_PAX_PFX + 'name'] = tarinfo.name
+    pax_headers[_SPARSE_PAX_PFX + 'realsize'] = str(tarinfo.size)
+    member_info.pax_headers = pax_headers
+
+    return member_info, ( None if fileobj is None else _SparseReader(sparse_map, fileobj, segments) )
+
+# ========================================================================
+def _iterchunks(fileobj, size, chunk_size=1 << 20):
+    while size > 0:
+        buf = fileobj.read(min(size, chunk_size))
+
+        if not buf:
+            break
+
+        size -= len(buf)
+
+        yield buf
+
+# ========================================================================
+def _jsonbytes(obj):
+    from json import dumps as json_dumps
+
+    return json_dumps(obj, separators=( ',', ':' ), sort_keys=True).encode('utf-8')
+
+# ========================================================================
+def _removeexisting(path):
+    # Removes anything (other than a directory) at path
+    try:
+        st = lstat(path)
+    except OSError:
+        return
+
+    if not S_ISDIR(st.st_mode):
+        unlink(path)
+
+# ========================================================================
+def _writefile(path, chunks, slots=None):
+    try:
+        _removeexisting(path)
+
+        with open(path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+    finally:
+        if slots is not None:
+            slots.release()
+
+# ========================================================================
+def _writesparsefile(path, fileobj, segments, size):
+    # Writes the data segments (see sparsemember) of fileobj to a file of
+    # size at path, leaving holes in between
+    _removeexisting(path)
+
+    with open(path, 'wb') as f:
+        for offset, length in segments:
+            fileobj.seek(offset)
+            f.seek(offset)
+
+            for chunk in _iterchunks(fileobj, length):
+                f.write(chunk)
+
+        f.truncate(size)
@@ -72,57 +72,1185 @@ from __future__ import (
 )
 from builtins import *  # noqa: F401,F403; pylint: disable=redefined-builtin,unused-wildcard-import,useless-suppression,wildcard-import
 from future.builtins.disabled import *  # noqa: F401,F403; pylint: disable=redefined-builtin,unused-wildcard-import,useless-suppression,wildcard-import
-from future.utils import native
 
 # ---- Imports -----------------------------------------------------------
 
-from copy import deepcopy
-from datetime import datetime
+from array import array
+from bisect import bisect_left
+from collections import (
+    OrderedDict,
+    deque,
+)
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping  # pylint: disable=deprecated-class,useless-suppression
+
+from contextlib import contextmanager
+from copy import (
+    copy as shallowcopy,
+    deepcopy,
+)
+from datetime import (
+    datetime,
+    timedelta,
+)
+from errno import (
+    ENOENT,
+    EPIPE,
+)
 from functools import cmp_to_key
+from io import BytesIO
 from logging import (
     ERROR,
+    INFO,
     getLogger,
 )
 from posixpath import (
     basename as posixpath_basename,
-    commonprefix as posixpath_commonprefix,
     dirname as posixpath_dirname,
     join as posixpath_join,
     sep as posixpath_sep,
 )
-from os.path import (
-    join as path_join,
-    realpath as path_realpath,
+from re import (
+    compile as re_compile,
+    escape as re_escape,
 )
-from shutil import rmtree
-from tarfile import open as tarfile_open
-from tempfile import mkdtemp
-from dateutil.parser import parse as dateutil_parse
-from humanize import naturalsize
+from shutil import copyfileobj
+from sys import exc_info
+from time import time
 from _dimgx import (
+    LayerDigestMismatch,
+    SpoolLimitExceeded,
     TZ_UTC,
     UnsafeTarPath,
+    cachedprobe,
     logexception,
     naturaltime,
 )
+from _dimgx.sources import (
+    GraphDriverClient,
+    PrefetchingClient,
+    SavedImageClient,
+    TarLayerReader,
+    opensource,
+)
+from _dimgx.targets import (
+    ArchiveCache,
+    ArchiveIndexer,
+    BlockGzipFile,
+    DigestingFile,
+    DirectoryWriter,
+    OciLayoutWriter,
+    imageconfig,
+    sparsemember,
+)
 from _dimgx.version import __version__  # noqa: F401
 
 # ---- Constants ---------------------------------------------------------
 
 __all__ = (
+    'ArchiveCache',
+    'ArchiveIndexer',
+    'BlockGzipFile',
+    'DigestingFile',
+    'DirectoryWriter',
+    'GraphDriverClient',
+    'ImageRecord',
+    'LayerDigestMismatch',
+    'LayerGraph',
+    'OciLayoutWriter',
+    'PrefetchingClient',
+    'SavedImageClient',
+    'SpoolLimitExceeded',
     'UnsafeTarPath',
+    'analyzeimages',
+    'catpath',
+    'compactimages',
     'denormalizeimage',
+    'diffimages',
+    'extractdelta',
+    'extractimages',
     'extractlayers',
+    'extractloadable',
     'inspectlayers',
+    'loadlayers',
     'normalizeimage',
+    'normalizeimages',
 )
 
 _LOGGER = getLogger(__name__)
+_CHUNK_SIZE = 1 << 20
+_NO_REPO_TAGS = ()
 _WHITEOUT_PFX = '.wh.'
 _WHITEOUT_PFX_LEN = len(_WHITEOUT_PFX)
+_OPAQUE_WHITEOUT = _WHITEOUT_PFX + _WHITEOUT_PFX + '.opq'
+_TAR_ERRORS = 'surrogateescape'  # what TarFile uses by default
+_PREVIOUS_ID = ':previous'  # stands in for a previous archive's layers
+_PAX_XATTR_PFXS = ( 'SCHILY.xattr.', 'LIBARCHIVE.xattr.' )
+_PAX_MEMBER_KEYS = ( 'linkpath', 'path', 'size' )  # how a member is stored, not what it describes
+_SPARSE_PAX_PFX = 'GNU.sparse.'
+
+# The subset of RFC 3339 that Docker actually emits (e.g.,
+# "2015-04-10T00:00:00.123456789Z"); anything else goes to dateutil
+_RFC3339_RE = re_compile(r'^(\d{4})-(\d\d)-(\d\d)[Tt ](\d\d):(\d\d):(\d\d)(?:\.(\d+))?(?:([Zz])|([+-])(\d\d):?(\d\d))$')
+
+# ---- Classes -----------------------------------------------------------
+
+# ========================================================================
+class ImageRecord(Mapping):
+    """
+    A compact, read-mostly stand-in for a normalized image description
+    (see :func:`normalizeimage`) that holds only the fields ``dimgx``
+    uses. Instances are usually created with :func:`compactimages` (or
+    :func:`inspectlayers` with :obj:`compact` set).
+
+    Records behave like (immutable) :class:`dict` objects, so ``record[':id']``,
+    ``record['Size']``, etc. work as they do with normalized descriptions
+    (except that :attr:`':repo_tags'` is a :class:`tuple`). The
+    normalized keys (e.g., :attr:`':child_ids'`) may also be assigned.
+    Raw keys other than those listed below are not retained, and
+    :attr:`raw` (re)builds an approximation of the original description
+    only when asked.
+
+    Available keys are :attr:`':id'`, :attr:`':short_id'`,
+    :attr:`':parent_id'`, :attr:`':created_dt'`, :attr:`':repo_tags'`,
+    :attr:`':child_ids'` (if assigned), :attr:`'Id'`, :attr:`'ParentId'`,
+    :attr:`'Created'`, :attr:`'RepoTags'`, :attr:`'Size'`, and
+    :attr:`'VirtualSize'`.
+    """
+
+    # ---- Data ----------------------------------------------------------
+
+    __slots__ = ( '_child_ids', '_created', '_created_dt', '_id', '_parent_id', '_repo_tags', '_size', '_virtual_size' )
+
+    _NORMALIZED_ATTRS = {
+        ':child_ids': '_child_ids',
+        ':created_dt': '_created_dt',
+        ':id': '_id',
+        ':parent_id': '_parent_id',
+        ':repo_tags': '_repo_tags',
+    }
+
+    _RAW_ATTRS = {
+        'Created': '_created',
+        'Id': '_id',
+        'ParentId': '_parent_id',
+        'RepoTags': None,  # see _rawrepotags
+        'Size': '_size',
+        'VirtualSize': '_virtual_size',
+    }
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, image_id, parent_id, created, created_dt, repo_tags, size, virtual_size):
+        super().__init__()
+        self._id = image_id
+        self._parent_id = parent_id
+        self._created = created
+        self._created_dt = created_dt
+        self._repo_tags = repo_tags
+        self._size = size
+        self._virtual_size = virtual_size
+        self._child_ids = None
+
+    # ---- Public properties ---------------------------------------------
+
+    @property
+    def raw(self):
+        """
+        A new :class:`dict` resembling the description from which this
+        record was created (without any normalized keys).
+        """
+        return dict(( key, getattr(self, attr) if attr is not None else self._rawrepotags() ) for key, attr in self._RAW_ATTRS.items())
+
+    # ---- Public hooks --------------------------------------------------
+
+    def __contains__(self, key):
+        if key == ':child_ids':
+            return self._child_ids is not None
+
+        return key == ':short_id' \
+            or key in self._NORMALIZED_ATTRS \
+            or key in self._RAW_ATTRS
+
+    def __getitem__(self, key):
+        if key == ':short_id':
+            return self._id[:12]
+
+        try:
+            value = getattr(self, self._NORMALIZED_ATTRS[key])
+        except KeyError:
+            pass
+        else:
+            if value is None:
+                raise KeyError(key)
+
+            return value
+
+        attr = self._RAW_ATTRS[key]
+
+        return getattr(self, attr) if attr is not None else self._rawrepotags()
+
+    def __iter__(self):
+        for key in ( ':created_dt', ':id', ':parent_id', ':repo_tags', ':short_id' ):
+            yield key
+
+        if self._child_ids is not None:
+            yield ':child_ids'
+
+        for key in ( 'Created', 'Id', 'ParentId', 'RepoTags', 'Size', 'VirtualSize' ):
+            yield key
+
+    def __len__(self):
+        return 11 if self._child_ids is None else 12
+
+    def __repr__(self):
+        return '<{} {} (parent: {})>'.format(type(self).__name__, self._id[:12], self._parent_id[:12] or '-')
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, self._NORMALIZED_ATTRS[key], value)
+        except KeyError:
+            raise KeyError('{} does not support setting {!r}'.format(type(self).__name__, key))
+
+    # ---- Private methods -----------------------------------------------
+
+    def _rawrepotags(self):
+        # Undoes the short names added by normalizeimage (each immediately
+        # precedes its ":latest" counterpart)
+        repo_tags = self._repo_tags
+        raw_repo_tags = [ t for i, t in enumerate(repo_tags) if repo_tags[i + 1:i + 2] != ( t + ':latest', ) ]
+
+        return raw_repo_tags if raw_repo_tags else [ '<none>:<none>' ]
+
+# ========================================================================
+class LayerGraph(object):
+    """
+    An index over the parent/child relationships among :obj:`images`
+    (normalized descriptions or :class:`ImageRecord` objects, e.g., from
+    :func:`normalizeimages` or :func:`compactimages`) for answering
+    repeated queries without re-walking chains. Parents, depths (the
+    number of ancestors), and whether one image is an ancestor of
+    another are found in constant time (the latter by comparing
+    depth-first traversal intervals). Lowest common ancestors are found
+    in time logarithmic in the depth of the graph by binary lifting
+    (i.e., with each image's 2\\ :sup:`k`\\ -th ancestors precomputed).
+
+    Images are referred to by their (full) IDs. :meth:`matches` and
+    :meth:`resolve` find IDs from names or partial IDs.
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, images):
+        super().__init__()
+        images = list(images)
+        images_by_id, parents, order, _, first_child, next_sibling = _indexgraph(images)
+        num_images = len(images)
+        depths = array(str('l'), ( 0 for _ in range(num_images) ))
+
+        for i in order:
+            if parents[i] >= 0:
+                depths[i] = depths[parents[i]] + 1
+
+        # jumps[k][i] is the index of i's 2**k-th ancestor (or -1)
+        jumps = [ parents ]
+        max_depth = max(depths) if num_images else 0
+
+        while 1 << len(jumps) <= max_depth:
+            prev = jumps[-1]
+            jumps.append(array(str('l'), ( prev[prev[i]] if prev[i] >= 0 else -1 for i in range(num_images) )))
+
+        # i is an ancestor of j if entered[i] <= entered[j] < exited[i]
+        entered = array(str('l'), ( 0 for _ in range(num_images) ))
+        exited = array(str('l'), ( 0 for _ in range(num_images) ))
+        clock = 0
+
+        for root in ( i for i in range(num_images) if parents[i] < 0 ):
+            i = root
+
+            while i >= 0:
+                entered[i] = clock
+                clock += 1
+
+                if first_child[i] >= 0:
+                    i = first_child[i]
+                    continue
+
+                while True:
+                    exited[i] = clock
+
+                    if i == root:
+                        i = -1
+                        break
+
+                    if next_sibling[i] >= 0:
+                        i = next_sibling[i]
+                        break
+
+                    i = parents[i]
+
+        self._depths = depths
+        self._entered = entered
+        self._exited = exited
+        self._first_child = first_child
+        self._images = images
+        self._images_by_id = images_by_id
+        self._indexes_by_id = dict(( image[':id'], i ) for i, image in enumerate(images))
+        self._indexes_by_repo_tag = {}
+        self._jumps = jumps
+        self._next_sibling = next_sibling
+        self._parents = parents
+        self._sorted_ids = sorted(self._indexes_by_id)
+
+        for i, image in enumerate(images):
+            for repo_tag in image[':repo_tags']:
+                self._indexes_by_repo_tag.setdefault(repo_tag, []).append(i)
+
+    # ---- Public hooks --------------------------------------------------
+
+    def __contains__(self, image_id):
+        return image_id in self._indexes_by_id
+
+    def __getitem__(self, image_id):
+        return self._images_by_id[image_id]
+
+    def __iter__(self):
+        return iter(self._images_by_id)
+
+    def __len__(self):
+        return len(self._images)
+
+    # ---- Public methods ------------------------------------------------
+
+    @classmethod
+    def fromclient(cls, dc, compact=True):
+        """
+        :param dc: a |docker.Client|_
+
+        :param compact: if :const:`True`, describe images with
+            :class:`ImageRecord` objects (see :func:`compactimages`)
+
+        :returns: a new :class:`LayerGraph` over all of :obj:`dc`'s images
+
+        Creates a graph from a single call to |docker.Client.images|_.
+        """
+        images = logexception(_LOGGER, ERROR, 'unable to retrieve image summaries: {{e}}'.format(), dc.images, all=True)
+
+        return cls(compactimages(images) if compact else normalizeimages(images))
+
+    def ancestors(self, image_id):
+        """
+        Yields the IDs of :obj:`image_id`'s ancestors (from its parent to
+        its root).
+        """
+        i = self._parents[self._indexes_by_id[image_id]]
+
+        while i >= 0:
+            yield self._images[i][':id']
+            i = self._parents[i]
+
+    def chain(self, image_id):
+        """
+        Returns a :class:`list` of the descriptions of :obj:`image_id` and
+        each of its ancestors (in the same order as :func:`inspectlayers`'
+        :attr:`':layers'`).
+        """
+        layers = [ self._images_by_id[image_id] ]
+        layers.extend(self._images_by_id[ancestor_id] for ancestor_id in self.ancestors(image_id))
+
+        return layers
+
+    def children(self, image_id):
+        """
+        Returns a :class:`list` of the IDs of :obj:`image_id`'s children.
+        """
+        child_ids = []
+        child = self._first_child[self._indexes_by_id[image_id]]
+
+        while child >= 0:
+            child_ids.append(self._images[child][':id'])
+            child = self._next_sibling[child]
+
+        return child_ids
+
+    def depth(self, image_id):
+        """
+        Returns the number of :obj:`image_id`'s ancestors (i.e., ``0`` for
+        roots).
+        """
+        return self._depths[self._indexes_by_id[image_id]]
+
+    def descendants(self, image_id):
+        """
+        Yields the IDs of :obj:`image_id`'s descendants (nearest first).
+        """
+        pending = deque(( self._first_child[self._indexes_by_id[image_id]], ))
+
+        while pending:
+            child = pending.popleft()
+
+            while child >= 0:
+                yield self._images[child][':id']
+
+                if self._first_child[child] >= 0:
+                    pending.append(self._first_child[child])
+
+                child = self._next_sibling[child]
+
+    def isancestor(self, ancestor_id, image_id):
+        """
+        Returns :const:`True` if :obj:`ancestor_id` is :obj:`image_id` or
+        one of its ancestors.
+        """
+        i = self._indexes_by_id[ancestor_id]
+
+        return self._entered[i] <= self._entered[self._indexes_by_id[image_id]] < self._exited[i]
+
+    def lca(self, image_id_a, image_id_b):
+        """
+        Returns the ID of the lowest (i.e., newest) common ancestor of
+        :obj:`image_id_a` and :obj:`image_id_b` (which may be either of
+        them), or :const:`None` if they share no ancestor.
+        """
+        if self.isancestor(image_id_a, image_id_b):
+            return image_id_a
+
+        if self.isancestor(image_id_b, image_id_a):
+            return image_id_b
+
+        i = self._indexes_by_id[image_id_a]
+        j = self._indexes_by_id[image_id_b]
+        jumps = self._jumps
+
+        # Neither is an ancestor of the other, so raise i as far as
+        # possible without reaching a common ancestor
+        for k in range(len(jumps) - 1, -1, -1):
+            ancestor = jumps[k][i]
+
+            if ancestor >= 0 \
+                    and not ( self._entered[ancestor] <= self._entered[j] < self._exited[ancestor] ):
+                i = ancestor
+
+        i = self._parents[i]
+
+        return None if i < 0 else self._images[i][':id']
+
+    def matches(self, image_spec, within=None):
+        """
+        Returns a :class:`list` of the IDs of images that have the
+        name :obj:`image_spec` or whose IDs start with :obj:`image_spec`
+        (limited to :obj:`within` and its ancestors, if provided).
+        """
+        indexes = set(self._indexes_by_repo_tag.get(image_spec, ()))
+        image_spec_lower = image_spec.lower()
+        sorted_ids = self._sorted_ids
+        k = bisect_left(sorted_ids, image_spec_lower)
+
+        while k < len(sorted_ids) \
+                and sorted_ids[k].startswith(image_spec_lower):
+            indexes.add(self._indexes_by_id[sorted_ids[k]])
+            k += 1
+
+        image_ids = [ self._images[i][':id'] for i in sorted(indexes) ]
+
+        if within is not None:
+            image_ids = [ image_id for image_id in image_ids if self.isancestor(image_id, within) ]
+
+        return image_ids
+
+    def parent(self, image_id):
+        """
+        Returns the ID of :obj:`image_id`'s parent (or :const:`None`).
+        """
+        i = self._parents[self._indexes_by_id[image_id]]
+
+        return None if i < 0 else self._images[i][':id']
+
+    def resolve(self, image_spec, within=None):
+        """
+        Like :meth:`matches`, but returns the only matching ID.
+
+        :raises: :class:`RuntimeError` if :obj:`image_spec` does not
+            resolve to a single image
+        """
+        image_ids = self.matches(image_spec, within)
+
+        if not image_ids:
+            raise RuntimeError('{} not found among the layers retreieved for that image'.format(image_spec))
+
+        if len(image_ids) > 1:
+            raise RuntimeError('{} does not resolve to a single image'.format(image_spec))
+
+        return image_ids[0]
+
+# ========================================================================
+class _ChainComparison(object):
+    """
+    Compares the flattened trees of two images (identified by their IDs
+    in a :class:`LayerGraph`) by looking only at the layers above their
+    common ancestor (if any). The ancestor's (shared) tree is only read if
+    a path changed by one image wasn't changed by the other, or to
+    enumerate what one image hid (e.g., by a removal) that the other
+    didn't.
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, source, graph, image_id_a, image_id_b, digests=False):
+        super().__init__()
+        layers_a = graph.chain(image_id_a)
+        layers_b = graph.chain(image_id_b)
+        self.ancestor_id = graph.lca(image_id_a, image_id_b)
+
+        if self.ancestor_id is None:
+            ancestor_idx_a, ancestor_idx_b = len(layers_a), len(layers_b)
+        else:
+            ancestor_depth = graph.depth(self.ancestor_id)
+            ancestor_idx_a = len(layers_a) - 1 - ancestor_depth
+            ancestor_idx_b = len(layers_b) - 1 - ancestor_depth
+
+        self.base_layers = layers_a[ancestor_idx_a:]
+        self.digests = digests
+        self.source = source
+        self.upper_layers_a = layers_a[:ancestor_idx_a]
+        self.upper_layers_b = layers_b[:ancestor_idx_b]
+        self._base = None
+        self._upper_a = _flatview(source, self.upper_layers_a, digests)
+        self._upper_b = _flatview(source, self.upper_layers_b, digests)
+
+    # ---- Public methods ------------------------------------------------
+
+    def changes(self):
+        """
+        Yields ``( name, state_a, state_b )`` for each path that differs
+        between the two trees (in order by name), where each state is
+        :const:`None` (if the path is absent) or an ``( origin, info,
+        digest )`` tuple, and origin is ``'base'`` or ``'upper'``.
+        """
+        names = set(self._upper_a[0])
+        names.update(self._upper_b[0])
+
+        if self._hidesmore(self._upper_a, self._upper_b) \
+                or self._hidesmore(self._upper_b, self._upper_a):
+            # Removals (etc.) hide whatever was under them in the base
+            for name in self._basetree():
+                if _ishidden(name, *self._upper_a[1]) \
+                        or _ishidden(name, *self._upper_b[1]):
+                    names.add(name)
+
+        for name in sorted(names):
+            state_a = self._state(self._upper_a, name)
+            state_b = self._state(self._upper_b, name)
+
+            if state_a is None \
+                    and state_b is None:
+                continue
+
+            if state_a is not None \
+                    and state_b is not None \
+                    and not _entrychanges(state_a, state_b):
+                continue
+
+            yield name, state_a, state_b
+
+    def state_b(self, name):
+        """
+        Returns the state (see :meth:`changes`) of the path :obj:`name` in
+        the second image's tree.
+        """
+        return self._state(self._upper_b, name)
+
+    # ---- Private methods -----------------------------------------------
+
+    def _basetree(self):
+        if self._base is None:
+            self._base = _flatview(self.source, self.base_layers, self.digests)[0]
+
+        return self._base
+
+    @staticmethod
+    def _hidesmore(upper, other):
+        # Returns True if upper might hide something in the base that other
+        # doesn't (or replace with its own entry), which is the only way
+        # a path that neither changed can differ
+        other_entries, ( other_removed, other_covered ) = other
+        removed, covered = upper[1]
+
+        for root in removed:
+            if not _ishidden(root, other_removed, other_covered) \
+                    and not ( root in other_covered and root in other_entries ):
+                return True
+
+        for root in covered:
+            if root not in other_covered \
+                    and not _ishidden(root, other_removed, other_covered):
+                return True
+
+        return False
+
+    def _state(self, upper, name):
+        entries, hides = upper
+
+        try:
+            info, digest = entries[name]
+        except KeyError:
+            pass
+        else:
+            return 'upper', info, digest
+
+        if _ishidden(name, *hides):
+            return None
+
+        try:
+            info, digest = self._basetree()[name]
+        except KeyError:
+            return None
+
+        return 'base', info, digest
+
+# ========================================================================
+class _ChunkPipe(object):
+    """
+    A bounded conduit from a writer in one thread (e.g., a
+    :class:`~tarfile.TarFile` in stream mode) to an iterator of byte
+    chunks in another (e.g., a request body). If the reader abandons the
+    pipe, further writes raise :class:`IOError` (rather than blocking
+    forever), and any failure the writer reports is ignored in favor of
+    whatever made the reader stop.
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, max_chunks=16):
+        super().__init__()
+        from queue import Queue
+        self.failure = None
+        self._abandoned = False
+        self._queue = Queue(max_chunks)
+
+    # ---- Public hooks --------------------------------------------------
+
+    def __iter__(self):
+        while True:
+            chunk = self._queue.get()
+
+            if chunk is None:
+                return
+
+            yield chunk
+
+    # ---- Public methods ------------------------------------------------
+
+    def abandon(self):
+        from queue import Empty
+        self._abandoned = True
+
+        while True:
+            try:
+                self._queue.get_nowait()
+            except Empty:
+                break
+
+    def close(self, failure=None):
+        if not self._abandoned:
+            self.failure = failure
+            self._put(None)
+
+    def write(self, data):
+        if data:
+            self._put(bytes(data))
+
+    # ---- Private methods -----------------------------------------------
+
+    def _put(self, chunk):
+        from queue import Full
+
+        while not self._abandoned:
+            try:
+                self._queue.put(chunk, timeout=0.1)
+            except Full:
+                continue
+
+            return
+
+        if chunk is not None:
+            raise IOError(EPIPE, 'reader went away')
+
+# ========================================================================
+class _Deduplicator(object):
+    """
+    Writes regular files to an archive, writing any whose contents
+    duplicate a file already written as a hard link to it instead (see
+    :func:`extractlayers`). Files are only compared with those that share
+    their metadata (which hard links can't differ in), and each is hashed
+    as it is written, so a file is only read twice if one that shares its
+    metadata has already been written, but with different contents.
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self):
+        super().__init__()
+        self.linked_size = 0
+        self._names_by_digest_by_key = {}
+
+    # ---- Public methods ------------------------------------------------
+
+    def addfile(self, tar_file, info, layer_reader):
+        """
+        Writes :obj:`info` (with its contents from :obj:`layer_reader`) to
+        :obj:`tar_file`, or a hard link in its place.
+        """
+        if not info.isreg() \
+                or info.size == 0:
+            _addmember(tar_file, info, layer_reader.extractfile(info))
+
+            return
+
+        # Only the headers describing the file matter (not, e.g., the
+        # member's own name for a long path)
+        key = ( info.size, info.mode, info.uid, info.gid, info.uname, info.gname, info.mtime, tuple(sorted(_metadataheaders(info.pax_headers).items())) )
+        names_by_digest = self._names_by_digest_by_key.setdefault(key, {})
+
+        if names_by_digest:
+            digest = _sha256hexdigest(layer_reader.extractfile(info))
+
+            if digest in names_by_digest:
+                from tarfile import LNKTYPE
+                link_info = shallowcopy(info)
+                link_info.type = LNKTYPE
+                link_info.linkname = names_by_digest[digest]
+                link_info.size = 0
+                link_info.sparse = None
+                link_info.pax_headers = _metadataheaders(info.pax_headers)
+                _LOGGER.debug('writing "%s" as a link to its duplicate "%s"', info.name, link_info.linkname)
+                tar_file.addfile(link_info)
+                self.linked_size += info.size
+
+                return
+
+            _addmember(tar_file, info, layer_reader.extractfile(info))
+        elif info.sparse is not None:
+            # Only its data segments may be read as it is written, so it
+            # is hashed separately
+            digest = _sha256hexdigest(layer_reader.extractfile(info))
+            _addmember(tar_file, info, layer_reader.extractfile(info))
+        else:
+            digesting_reader = _DigestingReader(layer_reader.extractfile(info))
+            tar_file.addfile(info, digesting_reader)
+            digest = digesting_reader.hash_obj.hexdigest()
+
+        names_by_digest[digest] = info.name
+
+# ========================================================================
+class _DigestingReader(object):
+    """
+    Wraps a file-like object, computing the SHA-256 digest of what is
+    read from it.
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, fileobj):
+        super().__init__()
+        from hashlib import sha256
+        self.hash_obj = sha256()
+        self._fileobj = fileobj
+
+    # ---- Public methods ------------------------------------------------
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self.hash_obj.update(data)
+
+        return data
+
+# ========================================================================
+class _EntryReader(object):
+    """
+    Stands in for the reader of an entry that is rewritten before it is
+    written (e.g., under another name, or without the sparse encoding it
+    was read with; see :func:`_outputentries`), providing the original's
+    contents regardless of the entry asked for.
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, layer_reader, info):
+        super().__init__()
+        self.layer_reader = layer_reader
+        self.info = info
+
+    # ---- Public methods ------------------------------------------------
+
+    def extractfile(self, info):  # pylint: disable=unused-argument
+        return self.layer_reader.extractfile(self.info)
+
+# ========================================================================
+class _FlattenedReader(object):
+    """
+    A file-like object from which the flattened archive of :obj:`layers`
+    (exactly as :func:`extractlayers` would write it to a
+    :class:`~tarfile.TarFile` in the default format) can be read as it is
+    produced. :attr:`digest` is available once it has been read to the
+    end.
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, source, layers, path_filter=None, reproducible=False, clamp_mtime=None, sparse=False):
+        super().__init__()
+        from hashlib import sha256
+        self.hash_obj = sha256()
+        self._buf = bytearray()
+        self._chunks = _flattenedchunks(source, layers, path_filter, reproducible, clamp_mtime, sparse)
+
+    # ---- Public properties ---------------------------------------------
+
+    @property
+    def digest(self):
+        return 'sha256:' + self.hash_obj.hexdigest()
+
+    # ---- Public methods ------------------------------------------------
+
+    def read(self, size=-1):
+        buf = self._buf
+
+        while size is None \
+                or size < 0 \
+                or len(buf) < size:
+            chunk = next(self._chunks, None)
+
+            if chunk is None:
+                break
+
+            buf.extend(chunk)
+
+        if size is None \
+                or size < 0 \
+                or size > len(buf):
+            size = len(buf)
+
+        data = bytes(buf[:size])
+        del buf[:size]
+        self.hash_obj.update(data)
+
+        return data
+
+# ========================================================================
+class _PathFilter(object):
+    """
+    Selects paths by :obj:`include` and :obj:`exclude` patterns, each of
+    which is either a path prefix (e.g., ``'usr/lib'``) or a glob (e.g.,
+    ``'usr/lib/python*'``, where ``*``, ``?``, and ``[...]`` don't match
+    ``/``, but ``**`` does). A pattern matches a path if it matches the
+    path or one of its ancestors. A path is accepted if it is not matched
+    by any of :obj:`exclude`, and, if :obj:`include` is not empty, either
+    it is matched by one of :obj:`include`, or it is a directory that may
+    contain a path that is (so that it is still written along with its
+    metadata). The patterns are compiled into a single expression each
+    up front.
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, include=(), exclude=()):
+        super().__init__()
+        self.include = tuple(_filtername(pattern) for pattern in include)
+        self.exclude = tuple(_filtername(pattern) for pattern in exclude)
+        self._included = _subtreesre(self.include)
+        self._excluded = _subtreesre(self.exclude)
+        self._leading = None
+
+        if self.include:
+            leads = [ '' ]
+
+            for pattern in self.include:
+                parts = pattern.split(posixpath_sep)
+
+                for i in range(1, len(parts)):
+                    if '**' in parts[i - 1]:
+                        leads.append(_globre(posixpath_sep.join(parts[:i - 1])) + '/.*' if i > 1 else '.*')
+
+                        break
+
+                    leads.append(_globre(posixpath_sep.join(parts[:i])))
+
+            self._leading = re_compile(r'(?s)(?:{})\Z'.format('|'.join(leads)))
+
+    # ---- Public methods ------------------------------------------------
+
+    @classmethod
+    def fromargs(cls, include=None, exclude=None):
+        """
+        Returns a :class:`_PathFilter` for :obj:`include` and
+        :obj:`exclude`, or :const:`None` if neither has any patterns.
+        """
+        if not include \
+                and not exclude:
+            return None
+
+        return cls(include or (), exclude or ())
+
+    def accepts(self, name, isdir=False):
+        """
+        Returns :const:`True` if :obj:`name` is selected.
+        """
+        name = _filtername(name)
+
+        if self._excluded is not None \
+                and self._excluded.match(name):
+            return False
+
+        if self._included is None \
+                or self._included.match(name):
+            return True
+
+        return isdir \
+            and self._leading.match(name) is not None
+
+    def prunes(self, name):
+        """
+        Returns :const:`True` if nothing at or beneath :obj:`name` can be
+        selected (i.e., so that the subtree can be skipped altogether).
+        """
+        name = _filtername(name)
+
+        if self._excluded is not None \
+                and self._excluded.match(name):
+            return True
+
+        return self._included is not None \
+            and not self._included.match(name) \
+            and not self._leading.match(name)
+
+# ========================================================================
+class _PreviousSource(object):
+    """
+    Provides the layers of :obj:`source` (see
+    :func:`~_dimgx.sources.opensource`), along with the previously
+    flattened archive at :obj:`path` as the stand-in layer
+    :const:`_PREVIOUS_ID` (see :func:`extractlayers`).
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, source, path):
+        super().__init__()
+        self.path = path
+        self.source = source
+
+    # ---- Public methods ------------------------------------------------
+
+    def openlayer(self, layer_id):
+        if layer_id == _PREVIOUS_ID:
+            return TarLayerReader(open(self.path, 'rb'), layer_id)
+
+        return self.source.openlayer(layer_id)
 
 # ---- Functions ---------------------------------------------------------
 
+# ========================================================================
+def analyzeimages(dc, compact=True):
+    """
+    :param dc: a |docker.Client|_
+
+    :param compact: if :const:`True` (the default), describe images with
+        :class:`ImageRecord` objects (see :func:`compactimages`) rather
+        than normalized :class:`dict` objects
+
+    :returns: a :class:`dict` containing the analysis (see below)
+
+    :raises: :class:`docker.errors.APIError` or
+        :class:`docker.errors.DockerException` on failure interacting with
+        Docker
+
+    Retrieves every image on the host with a single call to
+    |docker.Client.images|_ and determines how layers are shared among
+    tagged images. This takes time linear in the number of images.
+
+    The returned :class:`dict` is as follows:
+
+    .. code-block:: python
+
+        {
+            ':all_images': { image_id: image_desc, ... },
+            ':layers': [ image_desc, ... ],  # ancestors before descendants
+            ':ref_counts': { image_id: num_tagged_images_using_it, ... },
+            ':exclusive_sizes': { tagged_image_id: num_bytes, ... },
+            ':dangling': [ ( untagged_leaf_id, num_bytes ), ... ],
+            ':total_size': num_bytes,
+            ':shared_size': num_bytes,
+            ':exclusive_size': num_bytes,
+            ':dangling_size': num_bytes,
+        }
+
+    A layer's reference count is the number of tagged images (including
+    itself) whose chains include it. Layers with a count of one are
+    exclusive to a single tagged image, and :attr:`':exclusive_sizes'`
+    maps each tagged image to the total size of those layers (i.e., what
+    would be reclaimed by removing just that tag). Layers with a count of
+    zero belong to no tagged image; :attr:`':dangling'` lists each
+    untagged leaf with the size of its unreferenced chain. (Dangling
+    chains may share layers, so the sum of those sizes can exceed
+    :attr:`':dangling_size'`.)
+    """
+    images = logexception(_LOGGER, ERROR, 'unable to retrieve image summaries: {{e}}'.format(), dc.images, all=True)
+    images = compactimages(images) if compact else normalizeimages(images)
+    images_by_id, parents, order, num_children, _, _ = _indexgraph(images)
+    num_images = len(images)
+    sizes = [ image.get('Size') or 0 for image in images ]
+    refs = array(str('l'), ( 1 if image[':repo_tags'] else 0 for image in images ))
+
+    # Descendants before ancestors
+    for i in reversed(order):
+        parent = parents[i]
+
+        if parent >= 0:
+            refs[parent] += refs[i]
+
+    # Ancestors before descendants (each chain's running total only
+    # continues while its layers have the same reference count)
+    exclusive_runs = [ 0 ] * num_images
+    dangling_runs = [ 0 ] * num_images
+
+    for i in order:
+        parent = parents[i]
+
+        if refs[i] == 1:
+            exclusive_runs[i] = sizes[i] + (exclusive_runs[parent] if parent >= 0 and refs[parent] == 1 else 0)
+        elif refs[i] == 0:
+            dangling_runs[i] = sizes[i] + (dangling_runs[parent] if parent >= 0 and refs[parent] == 0 else 0)
+
+    ref_counts = {}
+    exclusive_sizes = {}
+    dangling = []
+    shared_size = exclusive_size = dangling_size = 0
+
+    for i in order:
+        image = images[i]
+        image_id = image[':id']
+        ref_counts[image_id] = refs[i]
+
+        if refs[i] > 1:
+            shared_size += sizes[i]
+        elif refs[i] == 1:
+            exclusive_size += sizes[i]
+        else:
+            dangling_size += sizes[i]
+
+            if not num_children[i]:
+                dangling.append(( image_id, dangling_runs[i] ))
+
+        if image[':repo_tags']:
+            exclusive_sizes[image_id] = exclusive_runs[i]
+
+    return {
+        ':all_images': images_by_id,
+        ':layers': [ images[i] for i in order ],
+        ':ref_counts': ref_counts,
+        ':exclusive_sizes': exclusive_sizes,
+        ':dangling': dangling,
+        ':total_size': shared_size + exclusive_size + dangling_size,
+        ':shared_size': shared_size,
+        ':exclusive_size': exclusive_size,
+        ':dangling_size': dangling_size,
+    }
+
+# ========================================================================
+def catpath(dc, layers, path, out_file=None, top_most_layer=0, verify=False, spool=None):
+    """
+    :param dc: a |docker.Client|_
+
+    :param layers: see :func:`extractlayers`
+
+    :param path: the path of the entry to find in the flattened layers
+        (e.g., ``'etc/os-release'``)
+
+    :param out_file: if provided, a file-like object open for writing to
+        which to write the entry's contents (if it is a regular file, or a
+        hard link to one)
+
+    :param top_most_layer: see :func:`extractlayers`
+
+    :param verify: see :func:`extractlayers`
+
+    :param spool: see :func:`extractlayers`
+
+    :returns: a ``( layer_id, info )`` tuple, where ``info`` is the
+        :class:`~tarfile.TarInfo` of the entry at :obj:`path`, and
+        ``layer_id`` is the ID of the layer it came from, or :const:`None`
+        if the flattened layers have nothing at :obj:`path`
+
+    :raises: anything :func:`extractlayers` raises
+
+    Looks for :obj:`path` through :obj:`layers` from newest to oldest
+    (honoring whiteouts, opaque directories, and replaced directories
+    exactly as :func:`extractlayers` does), stopping as soon as a layer
+    provides (or hides) it. Only the entries leading to :obj:`path` are
+    considered, and only its contents are read. Where layers can be read
+    individually (e.g., from a :class:`SavedImageClient` or a
+    :class:`GraphDriverClient`), older layers aren't read at all.
+    """
+    image_spec = top_most_layer if not isinstance(top_most_layer, int) else layers[top_most_layer][':id']
+
+    with opensource(dc, ( image_spec, ), verify, spool, ( [ layer[':id'] for layer in layers ], )) as source:
+        found = _findpath(source, layers, path, out_file)
+
+        if found is not None \
+                and found[1].islnk() \
+                and out_file is not None:
+            # The contents are wherever the link's target ended up
+            target = _findpath(source, layers, found[1].linkname, out_file)
+
+            if target is None \
+                    or not target[1].isreg():
+                exc = IOError(ENOENT, 'hard link target "{}" is missing'.format(found[1].linkname))
+                logexception(_LOGGER, ERROR, 'unable to read "{}": {{e}}'.format(path), exc)
+
+    return found
+
+# ========================================================================
+def compactimages(image_descs):
+    """
+    :param image_descs: an iterable of image descriptions as returned from
+        |docker.Client.images|_, etc.
+
+    :returns: a :class:`list` of :class:`ImageRecord` objects
+
+    Like :func:`normalizeimages`, but produces compact records that hold
+    only what ``dimgx`` needs rather than normalizing the descriptions in
+    place. Each distinct ID string is kept once (i.e., a parent's ID and
+    its children's :attr:`':parent_id'` are the same object). Use this
+    (or :func:`inspectlayers` with :obj:`compact` set) when holding the
+    graph for a host with many images.
+    """
+    ids = {}
+    created_dts = {}
+    records = []
+
+    for image_desc in image_descs:
+        image_id = image_desc.get('Id', image_desc.get('id')).lower()
+        image_id = ids.setdefault(image_id, image_id)
+        parent_id = image_desc.get('ParentId', image_desc.get('Parent', image_desc.get('parent', ''))).lower()
+        parent_id = ids.setdefault(parent_id, parent_id)
+        image_created = image_desc.get('Created', image_desc.get('created'))
+
+        try:
+            created_dt = created_dts[image_created]
+        except KeyError:
+            created_dt = created_dts[image_created] = _createddt(image_created)
+
+        repo_tags = _repotags(image_desc)
+        size = image_desc.get('Size', 0)
+        virtual_size = image_desc.get('VirtualSize', size)
+        records.append(ImageRecord(image_id, parent_id, image_created, created_dt, tuple(repo_tags) if repo_tags else _NO_REPO_TAGS, size, virtual_size))
+
+    return records
+
 # ========================================================================
 def denormalizeimage(image_desc, copy=False):
     """
@@ -148,7 +1276,254 @@ def denormalizeimage(image_desc, copy=False):
     return image
 
 # ========================================================================
-def extractlayers(dc, layers, tar_file, top_most_layer=0):
+def diffimages(dc, image_spec_a, image_spec_b, digests=False, spool=None):
+    """
+    :param dc: a |docker.Client|_
+
+    :param image_spec_a: the name or ID of the first (e.g., older) image
+
+    :param image_spec_b: the name or ID of the second (e.g., newer) image
+
+    :param digests: if :const:`True`, also compare the SHA-256 digests of
+        regular files' contents (which requires reading them)
+
+    :param spool: see :func:`extractlayers`
+
+    :returns: a :class:`dict` describing the differences (see below)
+
+    :raises: anything :meth:`LayerGraph.resolve` or
+        :func:`extractlayers` raises
+
+    Compares the flattened trees of two images without extracting
+    either. Only the tar headers of the layers above the images' common
+    ancestor (if any) are read, plus those of the shared layers if needed
+    to tell (e.g.) an added path from a modified one. (If :obj:`dc` can't
+    open individual layers, like a Docker daemon's client, both images are
+    still retrieved and spooled in full first; see
+    :func:`~_dimgx.sources.opensource`.)
+
+    The returned :class:`dict` is as follows (with paths in order):
+
+    .. code-block:: python
+
+        {
+            ':ancestor_id': common_ancestor_id,  # or None
+            ':added': [ path, ... ],  # in image_spec_b only
+            ':removed': [ path, ... ],  # in image_spec_a only
+            ':modified': [ ( path, ( field, ... ) ), ... ],
+        }
+
+    Fields are ``'type'``, ``'size'``, ``'mode'``, ``'uid'``, ``'gid'``,
+    ``'mtime'``, ``'linkname'``, and ``'digest'``.
+    """
+    graph = LayerGraph.fromclient(dc)
+    image_id_a = graph.resolve(image_spec_a)
+    image_id_b = graph.resolve(image_spec_b)
+    added = []
+    removed = []
+    modified = []
+
+    with opensource(dc, ( image_spec_a, image_spec_b ), spool=spool) as source:
+        comparison = _ChainComparison(source, graph, image_id_a, image_id_b, digests)
+
+        for name, state_a, state_b in comparison.changes():
+            if state_a is None:
+                added.append(name)
+            elif state_b is None:
+                removed.append(name)
+            else:
+                modified.append(( name, _entrychanges(state_a, state_b) ))
+
+    return {
+        ':ancestor_id': comparison.ancestor_id,
+        ':added': added,
+        ':removed': removed,
+        ':modified': modified,
+    }
+
+# ========================================================================
+def extractdelta(dc, base_image_spec, image_spec, tar_file, digests=False, verify=False, spool=None):
+    """
+    :param dc: a |docker.Client|_
+
+    :param base_image_spec: the name or ID of the image the recipient
+        already has
+
+    :param image_spec: the name or ID of the image to deliver
+
+    :param tar_file: a :class:`~tarfile.TarFile` open for writing to which
+        to write the delta layer
+
+    :param digests: if :const:`True`, also compare the contents of regular
+        files whose headers match (see :func:`diffimages`)
+
+    :param verify: see :func:`extractlayers`
+
+    :param spool: see :func:`extractlayers`
+
+    :returns: the ID of the images' common ancestor (or :const:`None`)
+
+    :raises: anything :func:`diffimages` raises
+
+    Writes a single (squashed) layer to :obj:`tar_file` that, applied on
+    top of :obj:`base_image_spec`'s flattened tree, results in that of
+    :obj:`image_spec`. It contains each path that was added or modified
+    and a whiteout (``.wh.``) entry for each path that was removed (but
+    not for those inside removed or replaced directories). A hard link
+    whose target isn't otherwise in the delta is written as a regular file
+    with the target's contents. Only what changed is read from the layers
+    (but see :func:`diffimages` regarding clients that can't open
+    individual layers).
+    """
+    from tarfile import TarInfo
+    graph = LayerGraph.fromclient(dc)
+    base_image_id = graph.resolve(base_image_spec)
+    image_id = graph.resolve(image_spec)
+
+    with opensource(dc, ( base_image_spec, image_spec ), verify, spool) as source:
+        comparison = _ChainComparison(source, graph, base_image_id, image_id, digests)
+        names_by_origin = { 'base': set(), 'upper': set() }
+        links = []
+        replaced = set()
+
+        for name, _, state_b in comparison.changes():
+            if _hasancestorin(name, replaced):
+                continue
+
+            if state_b is None:
+                whiteout_info = TarInfo(posixpath_join(posixpath_dirname(name), _WHITEOUT_PFX + posixpath_basename(name)))
+                _LOGGER.debug('writing whiteout for "%s"', name)
+                tar_file.addfile(whiteout_info)
+                replaced.add(name)
+            else:
+                origin, info, _ = state_b
+                names_by_origin[origin].add(name)
+
+                if info.islnk():
+                    links.append(( origin, info ))
+
+                if not info.isdir():
+                    replaced.add(name)
+
+        # The recipient's copy of a link's target can't be linked to, so
+        # links to targets that aren't in the delta get their contents
+        written = names_by_origin['base'] | names_by_origin['upper']
+        targets_by_origin = { 'base': set(), 'upper': set() }
+        links_by_target = {}
+
+        for origin, info in links:
+            if info.linkname in written:
+                continue
+
+            target_state = comparison.state_b(info.linkname)
+
+            if target_state is None \
+                    or not target_state[1].isreg():
+                continue
+
+            targets_by_origin[target_state[0]].add(info.linkname)
+            links_by_target.setdefault(info.linkname, []).append(info.name)
+            names_by_origin[origin].discard(info.name)
+
+        for origin, layers in ( ( 'upper', comparison.upper_layers_b ), ( 'base', comparison.base_layers ) ):
+            names = names_by_origin[origin]
+            targets = targets_by_origin[origin]
+
+            if not names \
+                    and not targets:
+                continue
+
+            for layer_id, next_info, layer_reader in _flattenlayers(source, layers):
+                if next_info.name in names:
+                    _LOGGER.debug('writing "%s" from "%s" to delta', next_info.name, layer_id)
+                    _addmember(tar_file, _writableinfo(next_info), layer_reader.extractfile(next_info))
+
+                if next_info.name in targets:
+                    for link_name in links_by_target[next_info.name]:
+                        _LOGGER.debug('writing "%s" from "%s" to delta as a copy of "%s"', link_name, layer_id, next_info.name)
+                        file_info = shallowcopy(_writableinfo(next_info))
+                        file_info.name = link_name
+                        file_info.pax_headers = _metadataheaders(next_info.pax_headers)
+                        _addmember(tar_file, file_info, layer_reader.extractfile(next_info))
+
+    return comparison.ancestor_id
+
+# ========================================================================
+def extractimages(dc, jobs, num_workers=None, verify=False, include=None, exclude=None, reproducible=False, clamp_mtime=None, dedupe=False, sparse=False, spool=None):
+    """
+    :param dc: a |docker.Client|_
+
+    :param jobs: a sequence of ``( layers, tar_file, top_most_layer )``
+        tuples, each describing one flattened archive as would be passed
+        to :func:`extractlayers` (``top_most_layer`` may be omitted); in
+        place of a :class:`~tarfile.TarFile`, ``tar_file`` may be a
+        callable taking no arguments and returning a context manager that
+        provides one (e.g., so that each target is only opened when it is
+        needed)
+
+    :param num_workers: the number of threads on which to flatten images
+        (defaults to the number of jobs or CPUs, whichever is fewer)
+
+    :param verify: see :func:`extractlayers`
+
+    :param include: see :func:`extractlayers`
+
+    :param exclude: see :func:`extractlayers`
+
+    :param reproducible: see :func:`extractlayers`
+
+    :param clamp_mtime: see :func:`extractlayers`
+
+    :param dedupe: see :func:`extractlayers`
+
+    :param sparse: see :func:`extractlayers`
+
+    :param spool: see :func:`extractlayers`
+
+    :raises: anything :func:`extractlayers` raises
+
+    Like calling :func:`extractlayers` for each of :obj:`jobs`, but
+    retrieves each distinct layer only once (with a single ``docker save``
+    of several images where :obj:`dc` supports it) and then flattens the
+    images concurrently from the shared copy. Images whose layers are all
+    provided by other images in :obj:`jobs` are not retrieved at all.
+    """
+    jobs = [ ( job[0], job[1], job[2] if len(job) > 2 else 0, include, exclude, reproducible, clamp_mtime, dedupe, sparse ) for job in jobs ]
+
+    if not jobs:
+        return
+
+    if num_workers is None:
+        from multiprocessing import cpu_count
+        num_workers = min(len(jobs), cpu_count())
+
+    covering = _coveringspecs(jobs)
+
+    with opensource(dc, [ image_spec for image_spec, _ in covering ], verify, spool, [ layer_ids for _, layer_ids in covering ]) as source:
+        if num_workers <= 1:
+            for job in jobs:
+                _extractjob(source, job)
+
+            return
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(num_workers)
+
+        try:
+            failures = pool.map(lambda job: _trapexcinfo(_extractjob, source, job), jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    for failure in failures:
+        if failure is not None:
+            # Re-raise the first failure (with its original traceback) in
+            # the caller's thread
+            from future.utils import raise_
+            raise_(*failure)
+
+# ========================================================================
+def extractlayers(dc, layers, tar_file, top_most_layer=0, verify=False, include=None, exclude=None, previous=None, reproducible=False, clamp_mtime=None, dedupe=False, sparse=False, spool=None):
     """
     :param dc: a |docker.Client|_
 
@@ -163,6 +1538,49 @@ def extractlayers(dc, layers, tar_file, top_most_layer=0):
         indicating the most recent layer to retrieve (the default of ``0``
         references the first item in :obj:`layers`; see below)
 
+    :param verify: if :const:`True`, compute the SHA-256 digest of each
+        layer as it is retrieved and compare it with the one in the
+        image's configuration (where the export includes one)
+
+    :param include: if not empty, a sequence of path prefixes or globs
+        (e.g., ``[ 'etc', 'usr/lib/python*' ]``) selecting which files to
+        extract (along with everything beneath them, and the directories
+        leading to them)
+
+    :param exclude: a sequence of path prefixes or globs selecting which
+        files not to extract (along with everything beneath them), even if
+        they are selected by :obj:`include`
+
+    :param previous: a ``( path, layer_ids )`` tuple describing an archive
+        previously written by :func:`extractlayers` (with the same
+        :obj:`include`, :obj:`exclude`, :obj:`reproducible`, and
+        :obj:`clamp_mtime`) to build upon, where ``path``
+        is the archive's path (it may be compressed), and ``layer_ids``
+        are the IDs of the layers that were flattened into it (in the
+        same order as :obj:`layers`)
+
+    :param reproducible: if :const:`True`, write entries in sorted path
+        order with normalized metadata (see below)
+
+    :param clamp_mtime: with :obj:`reproducible`, the latest modification
+        time (in seconds since the epoch, e.g., from
+        ``SOURCE_DATE_EPOCH``) to write; later ones are replaced with it
+
+    :param dedupe: if :const:`True`, write regular files whose contents
+        and metadata duplicate those of one already written as hard links
+        to it (see below)
+
+    :param sparse: if :const:`True`, write sparse files (those the layers
+        store as such, or, where layers are read from a storage driver's
+        directories, those with holes) as sparse members (see below)
+
+    :param spool: a mapping of keyword arguments (``spool_dir``,
+        ``memory_limit``, ``size_limit``, ``persist``, and ``retries``)
+        for the :class:`~_dimgx.sources.LayerSpool` that holds the
+        retrieved layers (where :obj:`dc` can't read them individually);
+        with ``persist``, a retry after an interrupted transfer only
+        retrieves the layers still missing
+
     :raises docker.errors.APIError: on failure interacting with Docker
         (e.g., failed connection, Docker not running, etc.)
 
@@ -171,105 +1589,208 @@ def extractlayers(dc, layers, tar_file, top_most_layer=0):
 
     :raises UnsafeTarPath: - probably indicative of a bug in Docker
 
+    :raises LayerDigestMismatch: if :obj:`verify` is :const:`True` and a
+        layer's contents don't match its recorded digest
+
+    :raises SpoolLimitExceeded: if the retrieved layers would exceed the
+        ``size_limit`` in :obj:`spool`
+
     Retrieves the layers corresponding to the :obj:`layers` parameter and
     extracts them into :obj:`tar_file`. Changes from layers corresponding
     to smaller indexes in :obj:`layers` will overwrite or block those from
     larger ones.
 
+    Only the headers of entries excluded by :obj:`include` or
+    :obj:`exclude` are read (and, where layers are read from a storage
+    driver's directories, not even those of excluded subtrees), so
+    extracting a few paths takes time proportional to what is selected.
+    In ``*`` and ``?`` (and ``[...]``), ``/`` is never matched, but in
+    ``**``, it is (e.g., ``'**/*.pyc'`` matches ``.pyc`` files anywhere).
+
+    If :obj:`previous` is provided, and :obj:`layers` ends with its
+    layers (i.e., only newer layers have been added on top), only the
+    newer layers are read, and they are applied to the previous archive's
+    entries as if it were a single layer below them. The result is the
+    same as flattening all of :obj:`layers`, but takes time proportional
+    to the size of the newer layers plus that of writing out what is
+    reused. If :obj:`layers` doesn't end with the previous archive's
+    layers, it is ignored.
+
+    If :obj:`reproducible` is :const:`True`, the same layers always
+    produce the same archive, byte for byte (given a :obj:`tar_file` in
+    the same format), so that copies can be deduplicated by digest.
+    Entries are written in sorted path order (where that would put a hard
+    link before what it links to, the first of the linked names gets the
+    contents instead), with whole-second modification times (clamped to
+    :obj:`clamp_mtime`, if provided), numeric owners only (user and group
+    names are dropped), and only those PAX headers that describe the entry
+    itself (i.e., extended attributes, but not access or change times).
+    All the headers are read before any contents are, so every layer is
+    held open until the archive is finished.
+
+    If :obj:`dedupe` is :const:`True`, each regular file is hashed as it
+    is written, and any later one with the same contents, mode, owners,
+    modification time, and extended attributes is written as a hard link
+    to it rather than in full (files that differ in any of those can't
+    share an inode once extracted, so they are never linked). A file is
+    only hashed before it is written where an earlier one shares its
+    metadata. Such an archive shouldn't be used as :obj:`previous` if
+    newer layers might change or remove the files others are linked to.
+
+    If :obj:`sparse` is :const:`True`, sparse files keep their holes:
+    where :obj:`tar_file` is a :class:`~tarfile.TarFile` in PAX format
+    (the default since Python 3.8), each is written as a sparse member
+    (see :func:`~_dimgx.targets.sparsemember`); a
+    :class:`~_dimgx.targets.DirectoryWriter` leaves the holes unwritten;
+    and an :class:`~_dimgx.targets.OciLayoutWriter` writes sparse members
+    in its layer. Anything else (e.g., an
+    :class:`~_dimgx.targets.ArchiveIndexer`, or a
+    :class:`~tarfile.TarFile` in another format) gets the expanded
+    contents, as it does if :obj:`sparse` is :const:`False`.
+
     Callers will need to set the :obj:`top_most_layer` parameter if
     :obj:`layers` is not in descending order. It is always safe to provide
     the same value as the :obj:`image_spec` parameter to
     :func:`inspectlayers`, but this may be ineffecient if that layer does
     not appear in :obj:`layers`.
     """
-    if not layers:
-        _LOGGER.warning('nothing to extract')
+    if not layers:
+        _LOGGER.warning('nothing to extract')
+
+        return
+
+    image_spec = top_most_layer if not isinstance(top_most_layer, int) else layers[top_most_layer][':id']
+
+    # Formatting sizes and times for each entry is costly, so only do it
+    # if someone is listening
+    log_writes = _LOGGER.isEnabledFor(INFO)
+
+    if log_writes:
+        from humanize import naturalsize
+
+    path_filter = _PathFilter.fromargs(include, exclude)
+    previous_path = None
+
+    if previous is not None:
+        previous_path, previous_ids = previous
+        num_previous = len(previous_ids)
+
+        if 0 < num_previous <= len(layers) \
+                and [ layer[':id'] for layer in layers[-num_previous:] ] == list(previous_ids):
+            _LOGGER.debug('reusing "%s" for the bottom-most %d layer(s)', previous_path, num_previous)
+            layers = layers[:-num_previous] + [ { ':id': _PREVIOUS_ID } ]
+        else:
+            _LOGGER.info('layers don\'t extend those of "%s"; ignoring it', previous_path)
+            previous_path = None
+
+    def _extract(source):
+        if previous_path is not None:
+            source = _PreviousSource(source, previous_path)
+
+        deduplicator = _Deduplicator() if dedupe else None
+
+        for layer_id, next_info, layer_reader in _outputentries(source, layers, path_filter, reproducible, clamp_mtime, sparse):
+            if log_writes:
+                mtime = naturaltime(datetime.utcfromtimestamp(next_info.mtime).replace(tzinfo=TZ_UTC))
+                _LOGGER.info('writing "%s" from "%s" to archive (size: %s; mode: %o; mtime: %s)', next_info.name, layer_id, naturalsize(next_info.size), next_info.mode, mtime)
+
+            if deduplicator is None:
+                _addmember(tar_file, next_info, layer_reader.extractfile(next_info))
+            else:
+                deduplicator.addfile(tar_file, next_info, layer_reader)
+
+        if deduplicator is not None \
+                and deduplicator.linked_size:
+            _LOGGER.debug('linked %d bytes of duplicate files', deduplicator.linked_size)
+
+    if previous_path is not None \
+            and len(layers) == 1:
+        # Nothing new, so there's nothing to retrieve
+        _extract(None)
+
+        return
+
+    with opensource(dc, ( image_spec, ), verify, spool, ( [ layer[':id'] for layer in layers if layer[':id'] != _PREVIOUS_ID ], )) as source:
+        _extract(source)
+
+# ========================================================================
+def extractloadable(dc, layers, tar_file, repo_tags=(), top_most_layer=0, config=None, verify=False, include=None, exclude=None, reproducible=False, clamp_mtime=None, sparse=False, spool=None):
+    """
+    :param dc: a |docker.Client|_
 
-        return
+    :param layers: see :func:`extractlayers`
 
-    image_spec = top_most_layer if not isinstance(top_most_layer, int) else layers[top_most_layer][':id']
-    tmp_dir = path_realpath(mkdtemp())
+    :param tar_file: a :class:`~tarfile.TarFile` open for writing (in
+        stream mode, if desired) to which to write the image archive
 
-    try:
-        image = logexception(_LOGGER, ERROR, 'unable to retrieve image layers from "{}": {{e}}'.format(image_spec), dc.get_image, image_spec)
+    :param repo_tags: the names with which to tag the image (e.g.,
+        ``[ 'nifty-box:squashed' ]``)
 
-        with tarfile_open(mode='r|*', fileobj=image) as image_tar_file:
-            next_info = image_tar_file.next()
+    :param top_most_layer: see :func:`extractlayers`
 
-            while next_info:
-                next_path = path_realpath(path_join(tmp_dir, next_info.name))
+    :param config: see :func:`~_dimgx.targets.imageconfig`
 
-                if not next_path.startswith(tmp_dir):
-                    exc = UnsafeTarPath('unsafe path: "{}"'.format(next_info.name))
-                    logexception(_LOGGER, ERROR, 'unable to retrieve entry from export of "{}": {{e}}'.format(image_spec), exc)
+    :param verify: see :func:`extractlayers`
 
-                image_tar_file.extract(next_info, tmp_dir)
-                next_info = image_tar_file.next()
+    :param include: see :func:`extractlayers`
 
-        seen = set()
-        hides_subtrees = set()
+    :param exclude: see :func:`extractlayers`
 
-        # Look through each layer's archive (newest to oldest)
-        for layer in layers:
-            layer_id = layer[':id']
-            layer_tar_path = path_join(tmp_dir, layer_id, 'layer.tar')
+    :param reproducible: see :func:`extractlayers` (the archive's own
+        entries are also given fixed modification times of
+        :obj:`clamp_mtime` or ``0``)
 
-            with tarfile_open(layer_tar_path) as layer_tar_file:
-                next_info = layer_tar_file.next()
+    :param clamp_mtime: see :func:`extractlayers`
 
-                while next_info:
-                    next_dirname = posixpath_dirname(next_info.name)
-                    next_basename = posixpath_basename(next_info.name)
+    :param sparse: see :func:`extractlayers` (the flattened layer is
+        always written in the default format)
 
-                    if next_basename.startswith(_WHITEOUT_PFX):
-                        removed_path = posixpath_join(next_dirname, next_basename[_WHITEOUT_PFX_LEN:])
-                        hides_subtrees.add(( removed_path, 'removal' ))
+    :param spool: see :func:`extractlayers`
 
-                        if removed_path in seen:
-                            _LOGGER.debug('skipping removal "%s"', removed_path)
-                        else:
-                            _LOGGER.debug('hiding "%s" as removed', removed_path)
-                    elif next_info.name in seen:
-                        _LOGGER.debug('skipping "%s" as overwritten', next_info.name)
-                    else:
-                        next_name_len = len(next_info.name)
-                        hidden = None
-
-                        for h, deverbal in hides_subtrees:  # https://en.wikipedia.org/wiki/deverbal
-                            if len(h) > next_name_len:
-                                continue
-
-                            common_pfx = posixpath_commonprefix(( h, next_info.name ))
-                            common_pfx_len = len(common_pfx)
-
-                            if next_name_len == common_pfx_len \
-                                    or next_info.name[common_pfx_len:].startswith(posixpath_sep):
-                                hidden = deverbal, h
-                                break
-
-                        if hidden:
-                            _LOGGER.debug('skipping "%s" hidden by %s of %s', next_info.name, *hidden)
-                        else:
-                            mtime = naturaltime(datetime.utcfromtimestamp(next_info.mtime).replace(tzinfo=TZ_UTC))
-                            _LOGGER.info('writing "%s" from "%s" to archive (size: %s; mode: %o; mtime: %s)', next_info.name, layer_id, naturalsize(next_info.size), next_info.mode, mtime)
-
-                            if next_info.linkname:
-                                # TarFile.extractfile() tries to do
-                                # something weird when its parameter
-                                # represents a link (see the docs)
-                                fileobj = None
-                            else:
-                                fileobj = layer_tar_file.extractfile(next_info)
-
-                            tar_file.addfile(next_info, fileobj)
-                            seen.add(next_info.name)
-
-                            if not next_info.isdir():
-                                hides_subtrees.add(( next_info.name, 'presence' ))
-
-                    next_info = layer_tar_file.next()
-    finally:
-        rmtree(tmp_dir, ignore_errors=True)
+    :returns: the ID of the new image (e.g., ``'sha256:0123...'``)
+
+    :raises: anything :func:`extractlayers` raises
+
+    Writes an archive in the format produced by ``docker save`` (and
+    accepted by ``docker load`` since Docker 1.10) containing a single
+    image whose only layer is :obj:`layers` flattened. The layer is
+    produced in two passes: the first reads only the layers' headers to
+    compute the flattened layer's size (which its header in the archive
+    needs up front), and the second writes it, computing its digest as it
+    goes. The flattened layer is therefore never held in memory or
+    written anywhere else.
+    """
+    from hashlib import sha256
+    from json import dumps as json_dumps
+    from tarfile import TarInfo
+    image_spec = top_most_layer if not isinstance(top_most_layer, int) else layers[top_most_layer][':id']
+    layer_dir = sha256(' '.join(layer[':id'] for layer in layers).encode('utf-8')).hexdigest()
+    layer_name = posixpath_join(layer_dir, 'layer.tar')
+    mtime = int(time()) if not reproducible else int(clamp_mtime or 0)
+    path_filter = _PathFilter.fromargs(include, exclude)
+
+    with opensource(dc, ( image_spec, ), verify, spool, ( [ layer[':id'] for layer in layers ], )) as source:
+        layer_info = TarInfo(layer_name)
+        layer_info.mode = 0o644
+        layer_info.mtime = mtime
+        layer_info.size = _flattenedsize(source, layers, path_filter, reproducible, clamp_mtime, sparse)
+        layer_file = _FlattenedReader(source, layers, path_filter, reproducible, clamp_mtime, sparse)
+        _LOGGER.debug('writing %d-byte flattened layer as "%s"', layer_info.size, layer_name)
+        tar_file.addfile(layer_info, layer_file)
+
+    image_config = json_dumps(imageconfig(( layer_file.digest, ), config), separators=( ',', ':' ), sort_keys=True).encode('utf-8')
+    image_id = sha256(image_config).hexdigest()
+    config_name = image_id + '.json'
+    manifest = json_dumps([ { 'Config': config_name, 'RepoTags': list(repo_tags), 'Layers': [ layer_name ] } ]).encode('utf-8')
+
+    for name, data in ( ( config_name, image_config ), ( 'manifest.json', manifest ) ):
+        info = TarInfo(name)
+        info.mode = 0o644
+        info.mtime = mtime
+        info.size = len(data)
+        tar_file.addfile(info, BytesIO(data))
+
+    return 'sha256:' + image_id
 
 # ========================================================================
 def imagekey(image):
@@ -296,12 +1817,16 @@ def imagekey(image):
     return _imagekey(image)  # pylint: disable=no-value-for-parameter
 
 # ========================================================================
-def inspectlayers(dc, image_spec):
+def inspectlayers(dc, image_spec, compact=False):
     """
     :param dc: a |docker.Client|_
 
     :param image_spec: the name or ID of the image to inspect
 
+    :param compact: if :const:`True`, describe images with
+        :class:`ImageRecord` objects (see :func:`compactimages`) rather than
+        normalized :class:`dict` objects
+
     :returns: a :class:`dict` containing the descriptions (see below)
 
     :raises: :class:`docker.errors.APIError` or
@@ -329,7 +1854,7 @@ def inspectlayers(dc, image_spec):
     :class:`list`.
     """
     images = logexception(_LOGGER, ERROR, 'unable to retrieve image summaries: {{e}}'.format(), dc.images, all=True)
-    images = sorted(( normalizeimage(i) for i in images ), key=imagekey, reverse=True)
+    images = sorted(compactimages(images) if compact else normalizeimages(images), key=imagekey, reverse=True)
     image_spec_len = len(image_spec)
     images_by_id = {}
     children = {}
@@ -396,6 +1921,62 @@ def inspectlayers(dc, image_spec):
 
     return layers_by_id
 
+# ========================================================================
+def loadlayers(dc, layers, repo_tags=(), top_most_layer=0, config=None, verify=False, load_dc=None, include=None, exclude=None, reproducible=False, clamp_mtime=None, sparse=False, spool=None):
+    """
+    :param dc: a |docker.Client|_
+
+    :param load_dc: the |docker.Client|_ into which to load the image
+        (defaults to :obj:`dc`)
+
+    :returns: the ID of the new image
+
+    :raises: anything :func:`extractloadable` or
+        |docker.Client.load_image|_ raises
+
+    Like :func:`extractloadable` (which describes the other parameters),
+    but streams the archive to |docker.Client.load_image|_ as it is
+    produced, so nothing is written to disk (beyond any spooling of the
+    original layers).
+
+    .. |docker.Client.load_image| replace:: :func:`docker.Client.load_image`
+    .. _`docker.Client.load_image`: https://docker-py.readthedocs.org/en/latest/api/#load_image
+    """
+    from tarfile import open as tarfile_open
+    from threading import Thread
+    load_dc = dc if load_dc is None else load_dc
+    pipe = _ChunkPipe()
+    image_ids = []
+
+    def _produce():
+        try:
+            with tarfile_open(mode='w|', fileobj=pipe) as tar_file:
+                image_ids.append(extractloadable(dc, layers, tar_file, repo_tags, top_most_layer, config, verify, include, exclude, reproducible, clamp_mtime, sparse, spool))
+        except BaseException:  # pylint: disable=broad-except
+            pipe.close(exc_info())
+        else:
+            pipe.close()
+
+    producer = Thread(target=_produce)
+    producer.daemon = True
+    producer.start()
+
+    try:
+        load_failure = _trapexcinfo(logexception, _LOGGER, ERROR, 'unable to load image: {e}', load_dc.load_image, iter(pipe))
+    finally:
+        pipe.abandon()
+        producer.join()
+
+    # Prefer the producer's failure (which probably caused the load's)
+    for failure in ( pipe.failure, load_failure ):
+        if failure is not None:
+            from future.utils import raise_
+            raise_(*failure)
+
+    _LOGGER.debug('loaded image "%s"', image_ids[0])
+
+    return image_ids[0]
+
 # ========================================================================
 def normalizeimage(image_desc, copy=False):
     """
@@ -418,7 +1999,9 @@ def normalizeimage(image_desc, copy=False):
     * :attr:`':parent_id'` - a normalized :attr:`'ParentId'` or
       :attr:`'Parent'`
     * :attr:`':created_dt'` - a timezone-aware :class:`datetime` object
-      representing :attr:`'Created'`
+      representing :attr:`'Created'` (RFC 3339 strings like those emitted
+      by Docker are parsed directly and normalized to UTC; anything else
+      is handed to :func:`dateutil.parser.parse`)
     * :attr:`':repo_tags'` - a normalized :attr:`'RepoTags'`, including
       any short names (i.e., those implying ``:latest``)
     """
@@ -427,36 +2010,37 @@ def normalizeimage(image_desc, copy=False):
     else:
         image = image_desc
 
-    image_id = image.get('Id', image.get('id')).lower()
-    image[':id'] = image_id
-    image[':parent_id'] = image.get('ParentId', image.get('Parent', image.get('parent', ''))).lower()
-    image_short_id = image_id[:12]
-    image[':short_id'] = image_short_id
-    image_created = image.get('Created', image.get('created'))
+    return _normalizeimage(image, _createddt(image.get('Created', image.get('created'))))
 
-    if isinstance(image_created, int):
-        # Work-around for
-        # <https://github.com/PythonCharmers/python-future/issues/144> and
-        # <https://bitbucket.org/pypy/pypy/issue/2048/datetimeutcfromtimestamp-barfs-when>
-        image_created = native(image_created)
-        image[':created_dt'] = datetime.utcfromtimestamp(image_created).replace(tzinfo=TZ_UTC)
-    else:
-        image[':created_dt'] = dateutil_parse(image_created)
+# ========================================================================
+def normalizeimages(image_descs, copy=False):
+    """
+    :param image_descs: an iterable of image descriptions as returned from
+        |docker.Client.images|_, etc.
 
-    image[':repo_tags'] = []
+    :param copy: if :const:`True`, copy each description before
+        normalizing it
 
-    for repo_tag in image.get('RepoTags', ()):
-        if repo_tag == '<none>:<none>':
-            continue
+    :returns: a :class:`list` of the normalized image descriptions
 
-        repo, tag = repo_tag.split(':')
+    Calls :func:`normalizeimage` on each of :obj:`image_descs`. Identical
+    :attr:`'Created'` values (common among images built together) are only
+    parsed once.
+    """
+    created_dts = {}
+    images = []
 
-        if tag == 'latest':
-            image[':repo_tags'].append(repo)
+    for image_desc in image_descs:
+        image_created = image_desc.get('Created', image_desc.get('created'))
 
-        image[':repo_tags'].append(repo_tag)
+        try:
+            created_dt = created_dts[image_created]
+        except KeyError:
+            created_dt = created_dts[image_created] = _createddt(image_created)
 
-    return image
+        images.append(_normalizeimage(deepcopy(image_desc) if copy else image_desc, created_dt))
+
+    return images
 
 # ========================================================================
 def patch_broken_tarfile_29760():
@@ -474,6 +2058,10 @@ def patch_broken_tarfile_29760():
     multiple times. (It will not attempt to apply the patch more than
     once.) Applying this patch may cause additional seeks and possibly
     redundant reads, even when reading a tape archive linearly.
+
+    The result of the detection is recorded per interpreter (see
+    :func:`_dimgx.cachedprobe`), so the probe archive is only built the
+    first time a given Python runs this function.
     """
     # See <http://bugs.python.org/issue29760>
     from sys import version as sys_version
@@ -497,7 +2085,7 @@ def patch_broken_tarfile_29760():
         return False
 
     if was_patched \
-            or not _is_broken():
+            or not cachedprobe('tarfile_29760', '{} {}'.format(sys_version, tarfile.__file__), _is_broken):
         # Nothing more to do
         return
 
@@ -519,6 +2107,69 @@ def patch_broken_tarfile_29760():
     tarfile.TarFile._patched_29760 = True  # pylint: disable=protected-access
     assert not _is_broken()
 
+# ========================================================================
+def _addmember(tar_file, info, fileobj=None):
+    # Adds info (see _outputentries) to tar_file, as a sparse member if
+    # it has data segments and tar_file is a TarFile in PAX format (other
+    # writers either preserve holes themselves or fill them in)
+    from tarfile import PAX_FORMAT
+
+    if info.sparse is not None \
+            and getattr(tar_file, 'format', None) == PAX_FORMAT:
+        info, fileobj = sparsemember(info, fileobj)
+
+    tar_file.addfile(info, fileobj)
+
+# ========================================================================
+def _coveringspecs(jobs):
+    # Returns ( image_spec, layer_ids ) tuples for the images to retrieve
+    # for jobs, skipping those whose layers are all provided by retrieving
+    # others (largest first)
+    covered_ids = set()
+    covering = []
+
+    for layers, _, top_most_layer, _, _, _, _, _, _ in sorted(jobs, key=lambda job: len(job[0]), reverse=True):
+        layer_ids = set(layer[':id'] for layer in layers)
+
+        if not layers \
+                or layer_ids <= covered_ids:
+            continue
+
+        covering.append(( top_most_layer if not isinstance(top_most_layer, int) else layers[top_most_layer][':id'], layer_ids ))
+        covered_ids.update(layer_ids)
+
+    return covering
+
+# ========================================================================
+def _createddt(image_created):
+    if isinstance(image_created, int):
+        # Work-around for
+        # <https://github.com/PythonCharmers/python-future/issues/144> and
+        # <https://bitbucket.org/pypy/pypy/issue/2048/datetimeutcfromtimestamp-barfs-when>
+        from future.utils import native
+        image_created = native(image_created)
+
+        return datetime.utcfromtimestamp(image_created).replace(tzinfo=TZ_UTC)
+
+    match = _RFC3339_RE.match(image_created)
+
+    if match is None:
+        from dateutil.parser import parse as dateutil_parse
+
+        return dateutil_parse(image_created)
+
+    year, month, day, hour, minute, second, frac, zulu, sign, off_hours, off_minutes = match.groups()
+    # Docker uses nanoseconds; datetime only goes to microseconds (this
+    # truncates, which is what dateutil does)
+    microsecond = int((frac + '00000')[:6]) if frac else 0
+    created_dt = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), microsecond, TZ_UTC)
+
+    if not zulu:
+        offset = timedelta(hours=int(off_hours), minutes=int(off_minutes))
+        created_dt = created_dt - offset if sign == '+' else created_dt + offset
+
+    return created_dt
+
 # ========================================================================
 @cmp_to_key
 def _imagekey(i, j):
@@ -542,6 +2193,631 @@ def _imagekey(i, j):
     # granular creation times
     return created_diff if created_diff else -(j[':parent_id'] == i[':id']) or +(i[':parent_id'] == j[':id'])
 
+# ========================================================================
+def _entrychanges(state_a, state_b):
+    # Returns the names of the fields that differ between two states (see
+    # _ChainComparison.changes)
+    _, info_a, digest_a = state_a
+    _, info_b, digest_b = state_b
+    changes = []
+
+    if _entrytype(info_a) != _entrytype(info_b):
+        changes.append('type')
+
+    for field in ( 'size', 'mode', 'uid', 'gid', 'mtime', 'linkname' ):
+        if getattr(info_a, field) != getattr(info_b, field):
+            changes.append(field)
+
+    if digest_a != digest_b:
+        changes.append('digest')
+
+    return tuple(changes)
+
+# ========================================================================
+def _entrytype(info):
+    # Normalizes equivalent types (e.g., REGTYPE and AREGTYPE)
+    if info.isreg():
+        return 'file'
+
+    if info.isdir():
+        return 'dir'
+
+    return info.type
+
+# ========================================================================
+def _extractjob(source, job):
+    # Performs a single job (see extractimages) from source
+    layers, tar_file, top_most_layer, include, exclude, reproducible, clamp_mtime, dedupe, sparse = job
+
+    if not callable(tar_file):
+        extractlayers(source, layers, tar_file, top_most_layer, include=include, exclude=exclude, reproducible=reproducible, clamp_mtime=clamp_mtime, dedupe=dedupe, sparse=sparse)
+
+        return
+
+    with tar_file() as opened_tar_file:
+        extractlayers(source, layers, opened_tar_file, top_most_layer, include=include, exclude=exclude, reproducible=reproducible, clamp_mtime=clamp_mtime, dedupe=dedupe, sparse=sparse)
+
+# ========================================================================
+def _filtername(name):
+    # Normalizes name (an entry's name or a pattern) for _PathFilter
+    # (e.g., "./usr/lib/" becomes "usr/lib", and "." becomes "")
+    name = name.strip(posixpath_sep)
+
+    while name.startswith('./'):
+        name = name[2:].lstrip(posixpath_sep)
+
+    return '' if name == '.' else name
+
+# ========================================================================
+def _findpath(source, layers, path, out_file=None):
+    # Returns ( layer_id, info ) for path in the flattened layers (or None
+    # if it's not there), writing its contents to out_file if it's a
+    # regular file (see catpath)
+    path = _filtername(path)
+    path_filter = _PathFilter(( path, ))
+    hides_subtrees = set()
+
+    # One layer at a time, so that the search can stop once path is
+    # hidden (which yields nothing)
+    for layer in layers:
+        for layer_id, next_info, layer_reader in _flattenlayers(source, ( layer, ), hides_subtrees, path_filter):
+            if _filtername(next_info.name) != path:
+                continue
+
+            _LOGGER.debug('found "%s" in "%s"', next_info.name, layer_id)
+
+            if out_file is not None \
+                    and next_info.isreg():
+                copyfileobj(layer_reader.extractfile(next_info), out_file, _CHUNK_SIZE)
+
+            return layer_id, next_info
+
+        if _ishidden(path, *_hideroots(hides_subtrees)):
+            _LOGGER.debug('"%s" is hidden by "%s"', path, layer[':id'])
+
+            return None
+
+    return None
+
+# ========================================================================
+def _flatview(source, layers, digests=False):
+    # Returns the flattened entries of layers (as a dict of names to
+    # ( info, digest ) tuples, where digest is None unless digests is
+    # True) and what they hide from older layers (see _hideroots)
+    entries = {}
+    hides_subtrees = set()
+
+    for _, info, layer_reader in _flattenlayers(source, layers, hides_subtrees):
+        digest = None
+
+        if digests \
+                and info.isreg():
+            digest = _sha256hexdigest(layer_reader.extractfile(info))
+
+        entries[info.name] = ( info, digest )
+
+    return entries, _hideroots(hides_subtrees)
+
+# ========================================================================
+def _flattenedchunks(source, layers, path_filter=None, reproducible=False, clamp_mtime=None, sparse=False):
+    # Yields the flattened archive of layers in chunks (exactly as
+    # extractlayers would write it with a TarFile in the default format;
+    # see _flattenedsize)
+    from tarfile import (
+        BLOCKSIZE,
+        DEFAULT_FORMAT,
+        ENCODING,
+        PAX_FORMAT,
+        RECORDSIZE,
+    )
+    offset = 0
+
+    for _, next_info, layer_reader in _outputentries(source, layers, path_filter, reproducible, clamp_mtime, sparse):
+        fileobj = layer_reader.extractfile(next_info) if next_info.isreg() else None
+
+        if next_info.sparse is not None \
+                and DEFAULT_FORMAT == PAX_FORMAT:
+            next_info, fileobj = sparsemember(next_info, fileobj)
+
+        buf = next_info.tobuf(DEFAULT_FORMAT, ENCODING, _TAR_ERRORS)
+        offset += len(buf)
+
+        yield buf
+
+        if not next_info.isreg():
+            continue
+
+        remaining = next_info.size
+
+        while remaining > 0:
+            buf = fileobj.read(min(remaining, _CHUNK_SIZE))
+
+            if not buf:
+                raise IOError('unexpected end of data for "{}"'.format(next_info.name))
+
+            remaining -= len(buf)
+
+            yield buf
+
+        offset += next_info.size
+        _, remainder = divmod(next_info.size, BLOCKSIZE)
+
+        if remainder > 0:
+            offset += BLOCKSIZE - remainder
+
+            yield b'\0' * (BLOCKSIZE - remainder)
+
+    offset += 2 * BLOCKSIZE
+    _, remainder = divmod(offset, RECORDSIZE)
+
+    yield b'\0' * (2 * BLOCKSIZE + (RECORDSIZE - remainder if remainder > 0 else 0))
+
+# ========================================================================
+def _flattenedsize(source, layers, path_filter=None, reproducible=False, clamp_mtime=None, sparse=False):
+    # Returns the size of the flattened archive of layers (as
+    # _flattenedchunks produces it) by reading only the layers' headers
+    from tarfile import (
+        BLOCKSIZE,
+        DEFAULT_FORMAT,
+        ENCODING,
+        PAX_FORMAT,
+        RECORDSIZE,
+    )
+    size = 0
+
+    for _, next_info, _ in _outputentries(source, layers, path_filter, reproducible, clamp_mtime, sparse):
+        if next_info.sparse is not None \
+                and DEFAULT_FORMAT == PAX_FORMAT:
+            next_info, _ = sparsemember(next_info)
+
+        size += len(next_info.tobuf(DEFAULT_FORMAT, ENCODING, _TAR_ERRORS))
+
+        if next_info.isreg():
+            size += -(-next_info.size // BLOCKSIZE) * BLOCKSIZE
+
+    size += 2 * BLOCKSIZE
+
+    return -(-size // RECORDSIZE) * RECORDSIZE
+
+# ========================================================================
+def _flattenlayers(source, layers, hides_subtrees=None, path_filter=None, open_readers=None):
+    # Yields ( layer_id, info, layer_reader ) for each entry from layers
+    # (newest to oldest) that survives into the flattened archive, where
+    # layer_reader is the open reader from which info came; if provided,
+    # hides_subtrees (a set) is populated with ( path, deverbal ) tuples
+    # describing what the layers hide from any older ones; if provided,
+    # path_filter (a _PathFilter) is consulted before anything else, so
+    # that entries it rejects are never hide-checked or read (and readers
+    # that can skip whole subtrees are told which ones to skip); if
+    # provided, open_readers (a list) is appended with each reader, which
+    # is left open for the caller to close (rather than being closed once
+    # its layer is done)
+    seen = set()
+
+    if hides_subtrees is None:
+        hides_subtrees = set()
+
+    # Each hidden path maps to why (https://en.wikipedia.org/wiki/deverbal),
+    # so that an entry is checked against its own ancestors rather than
+    # against everything hidden so far
+    deverbals_by_path = {}
+
+    for h, deverbal in hides_subtrees:
+        deverbals_by_path.setdefault(h, deverbal)
+
+    def _hide(path, deverbal):
+        hides_subtrees.add(( path, deverbal ))
+        deverbals_by_path.setdefault(path, deverbal)
+
+    # Look through each layer's archive (newest to oldest)
+    for layer in layers:
+        layer_id = layer[':id']
+
+        # An opaque directory hides the contents of older layers, but not
+        # its own, so those are applied once the layer is done
+        opaque_dirs = []
+
+        with _openlayer(source, layer_id, open_readers) as layer_reader:
+            if path_filter is not None \
+                    and hasattr(layer_reader, 'prune'):
+                layer_reader.prune = path_filter.prunes
+
+            for next_info in layer_reader:
+                next_dirname = posixpath_dirname(next_info.name)
+                next_basename = posixpath_basename(next_info.name)
+
+                if next_basename == _OPAQUE_WHITEOUT:
+                    if path_filter is None \
+                            or not path_filter.prunes(next_dirname):
+                        opaque_dirs.append(next_dirname)
+
+                    continue
+
+                if next_basename.startswith(_WHITEOUT_PFX):
+                    removed_path = posixpath_join(next_dirname, next_basename[_WHITEOUT_PFX_LEN:])
+
+                    if path_filter is not None \
+                            and path_filter.prunes(removed_path):
+                        continue
+
+                    _hide(removed_path, 'removal')
+
+                    if removed_path in seen:
+                        _LOGGER.debug('skipping removal "%s"', removed_path)
+                    else:
+                        _LOGGER.debug('hiding "%s" as removed', removed_path)
+
+                    continue
+
+                # Whatever replaced a directory hides what was in it, so
+                # a non-directory that the filter doesn't select, but that
+                # leads to what it does, is still considered (but not
+                # yielded)
+                accepted = path_filter is None \
+                    or path_filter.accepts(next_info.name, next_info.isdir())
+
+                if not accepted \
+                        and ( next_info.isdir() or path_filter.prunes(next_info.name) ):
+                    continue
+
+                if next_info.name in seen:
+                    _LOGGER.debug('skipping "%s" as overwritten', next_info.name)
+                else:
+                    hidden_path = next_info.name
+
+                    while hidden_path not in deverbals_by_path:
+                        parent = posixpath_dirname(hidden_path)
+                        hidden_path = parent if parent != hidden_path else ''
+
+                        if not hidden_path:
+                            break
+
+                    if hidden_path:
+                        _LOGGER.debug('skipping "%s" hidden by %s of %s', next_info.name, deverbals_by_path[hidden_path], hidden_path)
+                    else:
+                        if accepted:
+                            yield layer_id, next_info, layer_reader
+
+                        seen.add(next_info.name)
+
+                        if not next_info.isdir():
+                            _hide(next_info.name, 'presence')
+
+        for opaque_dir in opaque_dirs:
+            _LOGGER.debug('hiding the contents of "%s" as opaque', opaque_dir)
+            _hide(opaque_dir, 'opacity')
+
+# ========================================================================
+def _globre(pattern):
+    # Translates pattern (see _PathFilter) into a regular expression
+    # where "*", "?", and "[...]" don't match "/", but "**" does (and
+    # "**/" also matches nothing at all)
+    parts = []
+    i = 0
+    pattern_len = len(pattern)
+
+    while i < pattern_len:
+        c = pattern[i]
+        i += 1
+
+        if c == '*':
+            if pattern.startswith('**/', i - 1):
+                i += 2
+                parts.append('(?:.*/)?')
+            elif pattern.startswith('*', i):
+                i += 1
+                parts.append('.*')
+            else:
+                parts.append('[^/]*')
+        elif c == '?':
+            parts.append('[^/]')
+        elif c == '[':
+            j = i + 1 if pattern.startswith('!', i) else i
+            j = pattern.find(']', j + 1 if pattern.startswith(']', j) else j)
+
+            if j < 0:
+                parts.append(re_escape(c))
+            else:
+                chars = pattern[i:j]
+                negated = chars.startswith('!')
+                chars = chars[1:] if negated else chars
+
+                for special in ( '\\', '[', ']', '^' ):
+                    chars = chars.replace(special, '\\' + special)
+
+                parts.append('[^/' + chars + ']' if negated else '(?!/)[' + chars + ']')
+                i = j + 1
+        else:
+            parts.append(re_escape(c))
+
+    return ''.join(parts)
+
+# ========================================================================
+def _hasancestorin(name, paths):
+    # Returns True if any (proper) ancestor of name is in paths
+    parent = posixpath_dirname(name)
+
+    while parent:
+        if parent in paths:
+            return True
+
+        parent = posixpath_dirname(parent)
+
+    return False
+
+# ========================================================================
+def _hideroots(hides_subtrees):
+    # Splits hides_subtrees (see _flattenlayers) into the paths that are
+    # hidden along with their contents (removals) and those whose contents
+    # only are hidden (opaque directories and non-directories)
+    removed = set()
+    covered = set()
+
+    for path, deverbal in hides_subtrees:
+        ( removed if deverbal == 'removal' else covered ).add(path)
+
+    return removed, covered
+
+# ========================================================================
+def _indexgraph(images):
+    # Returns images_by_id, parent indexes (-1 for roots and orphans), an
+    # ordering of indexes where ancestors precede descendants, the number
+    # of children of each image, and each image's first child and next
+    # sibling (-1 for none) by which its children can be enumerated
+    num_images = len(images)
+    images_by_id = {}
+    indexes_by_id = {}
+
+    for i, image in enumerate(images):
+        images_by_id[image[':id']] = image
+        indexes_by_id[image[':id']] = i
+
+    parents = array(str('l'), ( indexes_by_id.get(image[':parent_id'], -1) for image in images ))
+    num_children = array(str('l'), ( 0 for _ in range(num_images) ))
+    first_child = array(str('l'), ( -1 for _ in range(num_images) ))
+    next_sibling = array(str('l'), ( -1 for _ in range(num_images) ))
+
+    for i in range(num_images):
+        parent = parents[i]
+
+        if parent >= 0:
+            num_children[parent] += 1
+            next_sibling[i] = first_child[parent]
+            first_child[parent] = i
+
+    order = array(str('l'), ( i for i in range(num_images) if parents[i] < 0 ))
+    j = 0
+
+    while j < len(order):
+        child = first_child[order[j]]
+
+        while child >= 0:
+            order.append(child)
+            child = next_sibling[child]
+
+        j += 1
+
+    return images_by_id, parents, order, num_children, first_child, next_sibling
+
+# ========================================================================
+def _ishidden(name, removed, covered):
+    # Returns True if name is hidden by a removal of it (or of one of its
+    # ancestors) or by one of its ancestors being covered (see _hideroots)
+    if name in removed:
+        return True
+
+    parent = posixpath_dirname(name)
+
+    while parent:
+        if parent in removed \
+                or parent in covered:
+            return True
+
+        parent = posixpath_dirname(parent)
+
+    return False
+
+# ========================================================================
+def _metadataheaders(pax_headers):
+    # Returns (in order) those of pax_headers that describe the file
+    # itself rather than how it's stored as a member (i.e., not its names,
+    # stored size, or sparse encoding), which a copy written under
+    # another name (or as a link) must not carry over
+    return OrderedDict(( k, v ) for k, v in pax_headers.items() if k not in _PAX_MEMBER_KEYS and not k.startswith(_SPARSE_PAX_PFX))
+
+# ========================================================================
+def _normalizedinfo(info, clamp_mtime=None):
+    # Returns a copy of info with only what a reproducible archive keeps:
+    # a whole-second mtime no later than clamp_mtime (if provided),
+    # numeric owners, and (in sorted order) only those PAX headers that
+    # describe the entry itself (i.e., extended attributes, rather than
+    # access times and the like)
+    normalized_info = shallowcopy(info)
+    mtime = int(info.mtime)
+    normalized_info.mtime = mtime if clamp_mtime is None else min(mtime, int(clamp_mtime))
+    normalized_info.uname = ''
+    normalized_info.gname = ''
+    normalized_info.pax_headers = OrderedDict(( k, info.pax_headers[k] ) for k in sorted(info.pax_headers) if k.startswith(_PAX_XATTR_PFXS))
+
+    return normalized_info
+
+# ========================================================================
+def _normalizeimage(image, created_dt):
+    image_id = image.get('Id', image.get('id')).lower()
+    image[':id'] = image_id
+    image[':parent_id'] = image.get('ParentId', image.get('Parent', image.get('parent', ''))).lower()
+    image_short_id = image_id[:12]
+    image[':short_id'] = image_short_id
+    image[':created_dt'] = created_dt
+    image[':repo_tags'] = _repotags(image)
+
+    return image
+
+# ========================================================================
+@contextmanager
+def _openlayer(source, layer_id, open_readers=None):
+    # Provides the reader for layer_id from source, which is closed on
+    # exit unless open_readers (a list) is provided, in which case it is
+    # appended to it instead (see _flattenlayers)
+    if open_readers is None:
+        with source.openlayer(layer_id) as layer_reader:
+            yield layer_reader
+
+        return
+
+    layer_reader = source.openlayer(layer_id)
+    open_readers.append(layer_reader)
+
+    yield layer_reader
+
+# ========================================================================
+def _orderedentries(source, layers, path_filter=None, reproducible=False, clamp_mtime=None):
+    # See _outputentries
+    from tarfile import LNKTYPE
+
+    if not reproducible:
+        for entry in _flattenlayers(source, layers, path_filter=path_filter):
+            yield entry
+
+        return
+
+    # Sorting requires every header up front, so the readers are kept
+    # open to provide the contents afterward
+    open_readers = []
+
+    try:
+        entries = sorted(_flattenlayers(source, layers, path_filter=path_filter, open_readers=open_readers), key=lambda entry: entry[1].name)
+        entries_by_name = dict(( entry[1].name, entry ) for entry in entries)
+
+        # A hard link can't precede what it links to, so where sorting
+        # puts one first, it gets the contents, and the rest of the names
+        # (including the original) link to it
+        firsts_by_target = {}
+
+        for _, info, _ in entries:
+            if info.islnk() \
+                    and info.linkname in entries_by_name \
+                    and info.name < firsts_by_target.get(info.linkname, info.linkname):
+                firsts_by_target[info.linkname] = info.name
+
+        for layer_id, info, layer_reader in entries:
+            normalized_info = _normalizedinfo(info, clamp_mtime)
+
+            if info.islnk() \
+                    and info.linkname in firsts_by_target:
+                first = firsts_by_target[info.linkname]
+
+                if info.name == first:
+                    layer_id, target_info, target_reader = entries_by_name[info.linkname]
+                    normalized_info = _normalizedinfo(target_info, clamp_mtime)
+                    normalized_info.name = info.name
+                    layer_reader = _EntryReader(target_reader, target_info)
+                else:
+                    normalized_info.linkname = first
+            elif info.name in firsts_by_target:
+                normalized_info.type = LNKTYPE
+                normalized_info.linkname = firsts_by_target[info.name]
+                normalized_info.size = 0
+
+            yield layer_id, normalized_info, layer_reader
+    finally:
+        for layer_reader in open_readers:
+            layer_reader.close()
+
+# ========================================================================
+def _outputentries(source, layers, path_filter=None, reproducible=False, clamp_mtime=None, sparse=False):
+    # Yields ( layer_id, info, layer_reader ) for each entry to write to
+    # the flattened archive of layers (see _flattenlayers), in the order
+    # the layers provide them, or (if reproducible is True) in sorted path
+    # order with normalized metadata (see _normalizedinfo); sparse files
+    # are described as they are to be written (see _writableinfo)
+    for layer_id, info, layer_reader in _orderedentries(source, layers, path_filter, reproducible, clamp_mtime):
+        if info.sparse is not None:
+            layer_reader = _EntryReader(layer_reader, info)
+            info = _writableinfo(info, sparse)
+
+        yield layer_id, info, layer_reader
+
+# ========================================================================
+def _repotags(image):
+    repo_tags = []
+
+    for repo_tag in image.get('RepoTags', ()):
+        if repo_tag == '<none>:<none>':
+            continue
+
+        repo, tag = repo_tag.split(':')
+
+        if tag == 'latest':
+            repo_tags.append(repo)
+
+        repo_tags.append(repo_tag)
+
+    return repo_tags
+
+# ========================================================================
+def _sha256hexdigest(fileobj):
+    from hashlib import sha256
+    hash_obj = sha256()
+
+    if fileobj is not None:
+        for buf in iter(lambda: fileobj.read(1 << 20), b''):
+            hash_obj.update(buf)
+
+    return hash_obj.hexdigest()
+
+# ========================================================================
+def _subtreesre(patterns):
+    # Returns a compiled regular expression matching any path that one of
+    # patterns (see _PathFilter) matches, or any of its descendants (or
+    # None if there are no patterns)
+    if not patterns:
+        return None
+
+    globs = '|'.join(_globre(pattern) if pattern else '.*' for pattern in patterns)
+
+    return re_compile(r'(?s)(?:{})(?:/.*)?\Z'.format(globs))
+
+# ========================================================================
+def _trapexcinfo(f, *args):
+    # Calls f with args, returning None on success and the exception info
+    # on failure. Anything escaping from a multiprocessing.pool worker
+    # other than an Exception (e.g., SystemExit, which the command line
+    # tool uses to abort) would otherwise leave the pool waiting forever.
+    try:
+        f(*args)
+    except BaseException:  # pylint: disable=broad-except
+        return exc_info()
+
+    return None
+
+# ========================================================================
+def _writableinfo(info, sparse=False):
+    # Returns info, or, if it was read as a sparse file, a copy of it
+    # without the encoding it was read with (i.e., as a plain regular
+    # file, without the placeholder name and stored size from its PAX
+    # headers), keeping its data segments only if sparse is True (so
+    # that its holes are otherwise filled in when it is written)
+    from tarfile import (
+        GNUTYPE_SPARSE,
+        REGTYPE,
+    )
+
+    if info.sparse is None:
+        return info
+
+    writable_info = shallowcopy(info)
+    writable_info.pax_headers = _metadataheaders(info.pax_headers)
+
+    if info.type == GNUTYPE_SPARSE:
+        writable_info.type = REGTYPE
+
+    if not sparse \
+            or not writable_info.isreg():
+        writable_info.sparse = None
+
+    return writable_info
+
 # ---- Initialization ----------------------------------------------------
 
 if __name__ == '__main__':
@@ -0,0 +1,29 @@
+#!/usr/bin/env sh
+# -*- encoding: utf-8; grammar-ext: sh; mode: shell-script -*-
+
+# ========================================================================
+# Copyright and other protections apply. Please see the accompanying
+# ``LICENSE`` and ``CREDITS`` files for rights and restrictions governing
+# use of this software. All rights not expressly waived or licensed are
+# reserved. If those files are missing or appear to be modified from their
+# originals, then please contact the author before viewing or using this
+# software in any capacity.
+# ========================================================================
+
+# Reports how long it takes to start the command line tool (without
+# talking to Docker), and which of our imports dominate. Set PYTHON to
+# benchmark a different interpreter and RUNS to change the sample size.
+
+_MY_DIR="$( cd "$( dirname "${0}" )" && pwd )"
+set -e
+[ -d "${_MY_DIR}" ]
+[ "${_MY_DIR}/benchstartup.sh" -ef "${0}" ]
+cd "${_MY_DIR}/.."
+PYTHON="${PYTHON:-python}"
+RUNS="${RUNS:-20}"
+"${PYTHON}" -m timeit -n 1 -r "${RUNS}" \
+    -s 'import subprocess, sys' \
+    'subprocess.check_call((sys.executable, "-c", "from _dimgx.cmd import main"))'
+"${PYTHON}" -X importtime -c 'from _dimgx.cmd import main' 2>&1 \
+    | sort -t '|' -k 2 -n \
+    | tail -n 10
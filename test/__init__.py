@@ -19,6 +19,7 @@ from future.builtins.disabled import *  # noqa: F401,F403; pylint: disable=redef
 
 # ---- Imports -----------------------------------------------------------
 
+from atexit import register as atexit_register
 from hashlib import sha256
 from io import BytesIO
 from os import environ
@@ -28,6 +29,8 @@ from logging import (
     getLevelName as logging_getLevelName,
     getLogger,
 )
+from shutil import rmtree
+from tempfile import mkdtemp
 
 from dimgx import patch_broken_tarfile_29760
 from _dimgx.cmd import _DEFAULT_LOG_FMT
@@ -71,5 +74,11 @@ class HashedBytesIo(BytesIO):
 logging_basicConfig(format=_LOG_FMT)
 getLogger('dimgx').setLevel(_LOG_LVL)
 
+# Keep probe results (see _dimgx.cachedprobe) out of the user's cache
+# (including those of the command line tool run in other processes)
+_CACHE_DIR = mkdtemp(prefix='dimgx-test-cache-')
+environ['DIMGX_CACHE_DIR'] = _CACHE_DIR
+atexit_register(rmtree, _CACHE_DIR, True)
+
 # Make sure tarfile.TarFile.next is patched for testing
 patch_broken_tarfile_29760()
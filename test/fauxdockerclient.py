@@ -29,6 +29,7 @@ from inspect import (
     getframeinfo,
 )
 from io import BytesIO
+from json import dumps as json_dumps
 from os import stat
 from os.path import (
     dirname,
@@ -53,6 +54,7 @@ from dimgx import (
 
 __all__ = (
     'FauxDockerClient',
+    'FlakyFauxDockerClient',
 )
 
 _EPOCH = datetime(1970, 1, 1, 0, 0, 0).replace(tzinfo=TZ_UTC)
@@ -103,6 +105,7 @@ class FauxDockerClient(object):
         self._my_dir = dirname(getframeinfo(currentframe()).filename)
         self.layers = []
         self.layers_by_id = {}
+        self.loaded = []
         self.layers_by_tag = {}
         num_paths = len(FauxDockerClient.SHORT_IDS_BY_PATH)  # should not exceed 0x100
         path_depth = len(FauxDockerClient.SHORT_IDS_BY_PATH[0])  # should not exceed 0x100
@@ -185,6 +188,18 @@ class FauxDockerClient(object):
                 ti_dir.type = DIRTYPE
                 image_tar_file.addfile(ti_dir)
 
+                layer_json = json_dumps({
+                    'created': layer['Created'],
+                    'id': layer[':id'],
+                    'parent': layer[':parent_id'],
+                    'Size': layer['Size'],
+                }).encode('utf-8')
+                ti_json = TarInfo('{}/json'.format(layer[':id']))
+                ti_json.mtime = mtime
+                ti_json.mode = 0o644
+                ti_json.size = len(layer_json)
+                image_tar_file.addfile(ti_json, fileobj=BytesIO(layer_json))
+
                 layer_tar_src_path = ospath_join(self._my_dir, 'data', layer[':short_id'], 'layer.tar')
 
                 with open(layer_tar_src_path, 'rb') as layer_tar_src_file:
@@ -196,6 +211,20 @@ class FauxDockerClient(object):
                     ti_layer.uname = ti_layer.gname = ''
                     image_tar_file.addfile(ti_layer, fileobj=layer_tar_src_file)
 
+            repositories = {}
+
+            for repo_tag in layers[0]['RepoTags']:
+                if repo_tag != '<none>:<none>':
+                    repo, tag = repo_tag.split(':')
+                    repositories.setdefault(repo, {})[tag] = layers[0][':id']
+
+            repositories = json_dumps(repositories).encode('utf-8')
+            ti_repositories = TarInfo('repositories')
+            ti_repositories.mtime = mtime
+            ti_repositories.mode = 0o644
+            ti_repositories.size = len(repositories)
+            image_tar_file.addfile(ti_repositories, fileobj=BytesIO(repositories))
+
         image_file.seek(0)
 
         return image_file
@@ -239,6 +268,12 @@ class FauxDockerClient(object):
     def inspect_image(self, image_id):
         raise NotImplementedError()
 
+    @_checkandraise.__func__
+    def load_image(self, data):
+        # Keeps what was loaded (for inspection by tests) rather than
+        # loading it
+        self.loaded.append(data if isinstance(data, bytes) else b''.join(data))
+
     # ---- Protected methods ---------------------------------------------
 
     @_checkandraise.__func__
@@ -250,3 +285,59 @@ class FauxDockerClient(object):
             return self.layers_by_tag[image_id]
 
         raise APIError(HTTPError('404 Client Error: Not Found'), None, explanation='No such image: {}'.format(image_id))
+
+# ========================================================================
+class FlakyFauxDockerClient(FauxDockerClient):
+    """
+    Faux client whose first :obj:`num_failures` image streams are cut off
+    (raising :class:`IOError`) after :obj:`fail_after` bytes.
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, fail_after, num_failures=1):
+        super().__init__()
+        self.fail_after = fail_after
+        self.num_failures = num_failures
+        self.retrieved = []
+
+    # ---- Public hooks --------------------------------------------------
+
+    def get_image(self, image):
+        image_file = super().get_image(image)
+        self.retrieved.append(image)
+
+        if len(self.retrieved) > self.num_failures:
+            return image_file
+
+        return _CutOffFile(image_file, self.fail_after)
+
+# ========================================================================
+class _CutOffFile(object):
+    """
+    A stream that fails after providing the first :obj:`size` bytes of
+    :obj:`fileobj`.
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, fileobj, size):
+        super().__init__()
+        self._fileobj = fileobj
+        self._remaining = size
+
+    # ---- Public methods ------------------------------------------------
+
+    def read(self, size=-1):
+        if self._remaining <= 0:
+            raise IOError('connection reset by faux peer')
+
+        if size is None \
+                or size < 0 \
+                or size > self._remaining:
+            size = self._remaining
+
+        buf = self._fileobj.read(size)
+        self._remaining -= len(buf)
+
+        return buf
@@ -20,17 +20,66 @@ from future.builtins.disabled import *  # noqa: F401,F403; pylint: disable=redef
 # ---- Imports -----------------------------------------------------------
 
 from argparse import ArgumentParser
-from io import StringIO
-from os import linesep
+from hashlib import sha256
+from io import (
+    BytesIO,
+    StringIO,
+)
+from os import (
+    linesep,
+    listdir,
+    lstat,
+)
+from os.path import (
+    basename,
+    dirname,
+    isdir,
+    isfile,
+    join as ospath_join,
+)
+from shutil import (
+    copyfileobj,
+    rmtree,
+)
+from subprocess import (
+    STDOUT,
+    CalledProcessError,
+    check_output,
+)
+from sys import executable
+from tarfile import (
+    TarFile,
+    TarInfo,
+    open as tarfile_open,
+)
+from tempfile import mkdtemp
 from unittest import TestCase
+from json import (
+    dumps as json_dumps,
+    loads as json_loads,
+)
 from _dimgx.cmd import (
     buildparser,
+    printanalysis,
+    printdiff,
     printlayerinfo,
+    readrecord,
+    runwithclient,
     selectlayers,
+    targetpath,
 )
 from _dimgx.version import __release__
-from dimgx import inspectlayers
-from test.fauxdockerclient import FauxDockerClient
+from dimgx import (
+    SpoolLimitExceeded,
+    analyzeimages,
+    catpath,
+    diffimages,
+    inspectlayers,
+)
+from test.fauxdockerclient import (
+    FauxDockerClient,
+    FlakyFauxDockerClient,
+)
 
 # ---- Constants ---------------------------------------------------------
 
@@ -191,6 +240,480 @@ class CommandTestCase(TestCase):
             outfile.seek(0)
             self.assertEqual([ l.strip() for l in outfile ], layer_ids)
 
+    def test_analysis(self):
+        analysis = analyzeimages(self._dc)
+        all_ids = FauxDockerClient.SHORT_IDS_BY_PATH[0] + FauxDockerClient.SHORT_IDS_BY_PATH[1]
+
+        args = self._parser.parse_args(( '-a', '-q' ))
+        self.assertIsNone(args.image)
+        outfile = StringIO()
+        printanalysis(args, analysis, outfile)
+        self.assertEqual(sorted(l.strip() for l in outfile.getvalue().splitlines()), sorted(all_ids))
+
+        args = self._parser.parse_args(( '-a', '--json' ))
+        outfile = StringIO()
+        printanalysis(args, analysis, outfile)
+        summary = json_loads(outfile.getvalue())
+        self.assertEqual(len(summary['layers']), len(all_ids))
+        self.assertEqual(summary['total_size'], analysis[':total_size'])
+        self.assertEqual(set(l['ref_count'] for l in summary['layers']), { 1 })
+        self.assertEqual(sorted(l['id'][:12] for l in summary['layers'] if l['exclusive_size'] is not None), sorted(( all_ids[0], all_ids[16] )))
+
+        args = self._parser.parse_args(( '-a', ))
+        outfile = StringIO()
+        printanalysis(args, analysis, outfile)
+        lines = outfile.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('REPO TAG'))
+        self.assertEqual(len(lines), len(all_ids) + 3)
+        self.assertTrue(lines[-1].startswith('total: '))
+
+    def test_archive(self):
+        path_ids = FauxDockerClient.SHORT_IDS_BY_PATH[1]
+        tmp_dir = mkdtemp()
+
+        try:
+            archive_path = ospath_join(tmp_dir, 'saved.tar')
+
+            with open(archive_path, 'wb') as archive_file:
+                copyfileobj(self._dc.get_image('greatest:hits'), archive_file)
+
+            args = self._parser.parse_args(( '--archive', archive_path, '-q', 'greatest:hits' ))
+            self.assertEqual(args.archive, archive_path)
+
+            # Reading from an archive should not need docker-py at all
+            code = 'import sys; sys.argv = {!r}; from _dimgx.cmd import main; main(); sys.stdout.flush(); assert "docker" not in sys.modules'.format([ 'dimgx' ] + [ '--archive', archive_path, '-q', 'greatest:hits' ])
+            out = check_output(( executable, '-c', code ), cwd=dirname(dirname(__file__)))
+            self.assertEqual([ l.strip() for l in out.decode('utf-8').splitlines() ], path_ids)
+
+            # --verify reports the digest of what was written (after
+            # warning that this archive has nothing to verify the layers
+            # against)
+            target_path = ospath_join(tmp_dir, 'flat.tar')
+            code = 'import sys; sys.argv = {!r}; sys.stderr = sys.stdout; from _dimgx.cmd import main; main()'.format([ 'dimgx' ] + [ '--archive', archive_path, '--verify', '-t', target_path, 'greatest:hits' ])
+            out = check_output(( executable, '-c', code ), cwd=dirname(dirname(__file__)))
+
+            with open(target_path, 'rb') as target_file:
+                lines = out.decode('utf-8').strip().splitlines()
+                self.assertEqual(lines[-1], '{}  {}'.format(sha256(target_file.read()).hexdigest(), target_path))
+                self.assertEqual(len(lines), 2)
+                self.assertIn('has no manifest', lines[0])
+
+            # Docker's storage has nothing to verify against
+            with self.assertRaises(CalledProcessError):
+                _runmain([ 'dimgx', '--graph-root', tmp_dir, '--verify', '-t', target_path, 'greatest:hits' ], stderr=STDOUT)
+        finally:
+            rmtree(tmp_dir, ignore_errors=True)
+
+    def test_cache(self):
+        tmp_dir = mkdtemp()
+
+        try:
+            cache_dir = ospath_join(tmp_dir, 'cache')
+            targets = [ ospath_join(tmp_dir, 'target{}.tar'.format(i)) for i in range(3) ]
+            runwithclient(self._dc, self._parser.parse_args(( '--cache', cache_dir, '-t', targets[0], 'greatest:hits' )))
+            self.assertEqual(len(listdir(cache_dir)), 1)
+
+            # The same archive again comes from the cache without
+            # retrieving anything
+            def _getimage(image):
+                raise AssertionError('retrieved "{}" instead of using the cache'.format(image))
+
+            get_image = self._dc.get_image
+            self._dc.get_image = _getimage
+            runwithclient(self._dc, self._parser.parse_args(( '--cache', cache_dir, '-t', targets[1], 'greatest:hits' )))
+
+            with open(targets[0], 'rb') as target_file0, \
+                    open(targets[1], 'rb') as target_file1:
+                self.assertEqual(target_file1.read(), target_file0.read())
+
+            # Different options make for a different archive
+            self._dc.get_image = get_image
+            runwithclient(self._dc, self._parser.parse_args(( '--cache', cache_dir, '--include', 'tmp/c.dir', '-t', targets[2], 'greatest:hits' )))
+            self.assertEqual(len(listdir(cache_dir)), 2)
+
+            # Overwriting a target linked to the cache leaves the cached
+            # archive alone
+            linked_target = ospath_join(tmp_dir, 'linked.tar')
+            runwithclient(self._dc, self._parser.parse_args(( '--cache', cache_dir, '--cache-link', '-t', linked_target, 'greatest:hits' )))
+            self.assertEqual(lstat(linked_target).st_nlink, 2)
+            runwithclient(self._dc, self._parser.parse_args(( '-w', '--include', 'tmp/c.dir', '-t', linked_target, 'greatest:hits' )))
+            self.assertEqual(lstat(linked_target).st_nlink, 1)
+
+            for cached_name in listdir(cache_dir):
+                with open(ospath_join(cache_dir, cached_name), 'rb') as cached_file:
+                    cached_data = cached_file.read()
+
+                for target in targets:
+                    with open(target, 'rb') as target_file:
+                        if target_file.read() == cached_data:
+                            break
+                else:
+                    self.fail('cached archive "{}" was modified'.format(cached_name))
+        finally:
+            rmtree(tmp_dir, ignore_errors=True)
+
+    def test_cat(self):
+        layers = inspectlayers(self._dc, 'greatest:hits')[':layers']
+        expected = BytesIO()
+        catpath(self._dc, layers, 'tmp/c.dir/f.file', expected)
+        tmp_dir = mkdtemp()
+
+        try:
+            archive_path = ospath_join(tmp_dir, 'saved.tar')
+
+            with open(archive_path, 'wb') as archive_file:
+                copyfileobj(self._dc.get_image('greatest:hits'), archive_file)
+
+            for path, ok in ( ( 'tmp/c.dir/f.file', True ), ( 'tmp/c.dir', False ), ( 'tmp/a.dir/c.file', False ) ):
+                argv = [ 'dimgx', '--archive', archive_path, '--cat', path, 'greatest:hits' ]
+
+                if ok:
+                    self.assertEqual(_runmain(argv), expected.getvalue())
+                else:
+                    with self.assertRaises(CalledProcessError, msg=path):
+                        _runmain(argv, stderr=STDOUT)
+        finally:
+            rmtree(tmp_dir, ignore_errors=True)
+
+    def test_dedupe(self):
+        tmp_dir = mkdtemp()
+
+        try:
+            data = []
+
+            for args in ( (), ( '--dedupe', ) ):
+                target = ospath_join(tmp_dir, 'target{}.tar'.format(len(data)))
+                runwithclient(self._dc, self._parser.parse_args(args + ( '-t', target, 'greatest:hits' )))
+
+                with TarFile(target, mode='r') as tar_file:
+                    data.append(dict(( i.name, tar_file.extractfile(i).read() if i.isreg() or i.islnk() else None ) for i in tar_file))
+
+            self.assertEqual(data[1], data[0])
+        finally:
+            rmtree(tmp_dir, ignore_errors=True)
+
+    def test_multipleimages(self):
+        args = self._parser.parse_args(( '-t', '{image}-{short_id}.tar', 'getto:dachoppa', 'library/greatest:hits' ))
+        self.assertEqual(args.image, 'getto:dachoppa')
+        self.assertEqual(args.more_images, [ 'library/greatest:hits' ])
+        self.assertEqual(targetpath(args.target, args.more_images[0], '05883322010f' + '0' * 52), 'library_greatest:hits-05883322010f.tar')
+        self.assertEqual(targetpath('{0}/{}/{image}-{x}.tar', 'nifty-box', None), '{0}/{}/nifty-box-{x}.tar')
+
+        tmp_dir = mkdtemp()
+
+        try:
+            archive_path = ospath_join(tmp_dir, 'saved.tar')
+
+            # Combine both images into a single archive (like "docker save
+            # getto:dachoppa greatest:hits")
+            with TarFile(archive_path, mode='w') as archive_tar_file:
+                names = set()
+                repositories = {}
+
+                for image_spec in ( 'getto:dachoppa', 'greatest:hits' ):
+                    with tarfile_open(mode='r|', fileobj=self._dc.get_image(image_spec)) as image_tar_file:
+                        for info in image_tar_file:
+                            if info.name == 'repositories':
+                                repositories.update(json_loads(image_tar_file.extractfile(info).read().decode('utf-8')))
+                            elif info.name not in names:
+                                names.add(info.name)
+                                archive_tar_file.addfile(info, image_tar_file.extractfile(info) if info.isreg() else None)
+
+                repositories_bytes = json_dumps(repositories).encode('utf-8')
+                info = TarInfo('repositories')
+                info.size = len(repositories_bytes)
+                archive_tar_file.addfile(info, BytesIO(repositories_bytes))
+
+            target = ospath_join(tmp_dir, '{image}.tar')
+            argv = [ 'dimgx', '--archive', archive_path, '--workers', '2', '-t', target, 'getto:dachoppa', 'greatest:hits' ]
+            _runmain(argv)
+
+            for image_spec in ( 'getto:dachoppa', 'greatest:hits' ):
+                with TarFile(target.format(image=image_spec), mode='r') as tar_file:
+                    self.assertTrue(tar_file.getnames())
+        finally:
+            rmtree(tmp_dir, ignore_errors=True)
+
+    def test_diff(self):
+        base_spec = FauxDockerClient.SHORT_IDS_BY_PATH[1][0xb]
+        args = self._parser.parse_args(( '-d', base_spec, 'greatest:hits' ))
+        self.assertEqual(args.diff, base_spec)
+        diff = diffimages(self._dc, args.diff, args.image)
+        outfile = StringIO()
+        printdiff(args, diff, outfile)
+        lines = outfile.getvalue().splitlines()
+        self.assertEqual(len(lines), len(diff[':added']) + len(diff[':removed']) + len(diff[':modified']))
+        self.assertIn('A\ttmp/b.dir', lines)
+        self.assertIn('M\ttmp/c.dir\tmtime', lines)
+
+        args = self._parser.parse_args(( '-d', base_spec, '--json', 'greatest:hits' ))
+        outfile = StringIO()
+        printdiff(args, diff, outfile)
+        summary = json_loads(outfile.getvalue())
+        self.assertEqual(summary['removed'], diff[':removed'])
+        self.assertEqual(summary['ancestor_id'][:12], base_spec)
+
+        # With a target, write a delta layer instead
+        tmp_dir = mkdtemp()
+
+        try:
+            archive_path = ospath_join(tmp_dir, 'saved.tar')
+
+            with open(archive_path, 'wb') as archive_file:
+                copyfileobj(self._dc.get_image('greatest:hits'), archive_file)
+
+            target = ospath_join(tmp_dir, 'delta.tar')
+            argv = [ 'dimgx', '--archive', archive_path, '-d', base_spec, '-t', target, 'greatest:hits' ]
+            _runmain(argv)
+
+            with TarFile(target, mode='r') as tar_file:
+                self.assertEqual(sorted(tar_file.getnames()), sorted(diff[':added'] + [ p for p, _ in diff[':modified'] ]))
+        finally:
+            rmtree(tmp_dir, ignore_errors=True)
+
+    def test_filters(self):
+        tmp_dir = mkdtemp()
+
+        try:
+            target = ospath_join(tmp_dir, 'filtered.tar')
+            args = self._parser.parse_args(( '--include', 'tmp/*.dir', '--exclude', 'tmp/c.dir/g.*', '-t', target, 'greatest:hits' ))
+            self.assertEqual(args.includes, [ 'tmp/*.dir' ])
+            self.assertEqual(args.excludes, [ 'tmp/c.dir/g.*' ])
+            runwithclient(self._dc, args)
+
+            with TarFile(target, mode='r') as tar_file:
+                self.assertEqual(sorted(tar_file.getnames()), [ 'tmp', 'tmp/b.dir', 'tmp/c.dir', 'tmp/c.dir/f.file' ])
+
+            # Filters only make sense when something is extracted
+            argv = [ 'dimgx', '--include', 'tmp', 'greatest:hits' ]
+
+            with self.assertRaises(CalledProcessError):
+                _runmain(argv, stderr=STDOUT)
+        finally:
+            rmtree(tmp_dir, ignore_errors=True)
+
+    def test_index(self):
+        tmp_dir = mkdtemp()
+
+        try:
+            for compression_args in ( (), ( '-z', ) ):
+                target = ospath_join(tmp_dir, 'indexed.tar' + ( '.gz' if compression_args else '' ))
+                args = self._parser.parse_args(compression_args + ( '--index', '-t', target, 'greatest:hits' ))
+                runwithclient(self._dc, args)
+
+                with open(target + '.index.json', 'rb') as index_file:
+                    index = json_loads(index_file.read().decode('utf-8'))
+
+                with tarfile_open(target, mode='r') as tar_file:
+                    self.assertEqual([ name for name, _, _, _, _ in index['members'] ], tar_file.getnames(), msg=target)
+
+                self.assertEqual('blocks' in index, bool(compression_args), msg=target)
+
+            # There's nowhere to write an index for STDOUT
+            argv = [ 'dimgx', '--index', '-t', '-', 'greatest:hits' ]
+
+            with self.assertRaises(CalledProcessError):
+                _runmain(argv, stderr=STDOUT)
+        finally:
+            rmtree(tmp_dir, ignore_errors=True)
+
+    def test_lazyimports(self):
+        # Importing the command line tool should not drag in anything
+        # expensive; those are deferred until they are actually needed
+        heavy = ( 'dateutil', 'docker', 'humanize', 'requests' )
+        code = 'import sys; import _dimgx.cmd; print(" ".join(m for m in {!r} if m in sys.modules))'.format(heavy)
+        out = check_output(( executable, '-c', code ), cwd=dirname(dirname(__file__)))
+        self.assertEqual(out.strip(), b'')
+
+    def test_load(self):
+        args = self._parser.parse_args(( '--load', '--tag', 'greatest:squashed', 'greatest:hits' ))
+        runwithclient(self._dc, args)
+        loaded, = self._dc.loaded
+
+        with TarFile(mode='r', fileobj=BytesIO(loaded)) as loaded_tar_file:
+            manifest, = json_loads(loaded_tar_file.extractfile('manifest.json').read().decode('utf-8'))
+            config = loaded_tar_file.extractfile(manifest['Config']).read()
+
+        self.assertEqual(manifest['RepoTags'], [ 'greatest:squashed' ])
+        self.assertEqual(manifest['Config'], sha256(config).hexdigest() + '.json')
+
+        tmp_dir = mkdtemp()
+
+        try:
+            archive_path = ospath_join(tmp_dir, 'saved.tar')
+
+            with open(archive_path, 'wb') as archive_file:
+                copyfileobj(self._dc.get_image('greatest:hits'), archive_file)
+
+            target_path = ospath_join(tmp_dir, 'squashed.tar')
+            argv = [ 'dimgx', '--archive', archive_path, '--loadable', '--tag', 'greatest:squashed', '-t', target_path, 'greatest:hits' ]
+            _runmain(argv)
+
+            with TarFile(target_path, mode='r') as loadable_tar_file:
+                manifest, = json_loads(loadable_tar_file.extractfile('manifest.json').read().decode('utf-8'))
+                self.assertEqual(manifest['RepoTags'], [ 'greatest:squashed' ])
+                self.assertIsNotNone(loadable_tar_file.extractfile(manifest['Layers'][0]))
+        finally:
+            rmtree(tmp_dir, ignore_errors=True)
+
+    def test_previous(self):
+        tmp_dir = mkdtemp()
+
+        try:
+            previous = ospath_join(tmp_dir, 'previous.tar')
+            target = ospath_join(tmp_dir, 'target.tar')
+            runwithclient(self._dc, self._parser.parse_args(( '--record', '-t', previous, 'greatest:hits' )))
+
+            with open(previous + '.layers.json', 'rb') as record_file:
+                record = json_loads(record_file.read().decode('utf-8'))
+
+            self.assertEqual(record['layers'], [ layer[':id'] for layer in inspectlayers(self._dc, 'greatest:hits')[':layers'] ])
+            runwithclient(self._dc, self._parser.parse_args(( '--previous', previous, '-t', target, 'greatest:hits' )))
+
+            with open(previous, 'rb') as previous_file, \
+                    open(target, 'rb') as target_file:
+                self.assertEqual(target_file.read(), previous_file.read())
+
+            # A previous archive written differently isn't used
+            reproducible = ospath_join(tmp_dir, 'reproducible.tar')
+            runwithclient(self._dc, self._parser.parse_args(( '--record', '--reproducible', '--clamp-mtime', '1431216000', '-t', reproducible, 'greatest:hits' )))
+
+            for options, usable in (
+                    ( ( '--reproducible', '--clamp-mtime', '1431216000' ), True ),
+                    ( (), False ),
+                    ( ( '--reproducible', ), False ),
+                    ( ( '--reproducible', '--clamp-mtime', '1431216000', '--sparse' ), False ),
+            ):
+                args = self._parser.parse_args(options + ( '--previous', reproducible, '-t', target, 'greatest:hits' ))
+                self.assertEqual(readrecord(args) is not None, usable, msg=options)
+
+            # Nor is a deduplicated one
+            deduped = ospath_join(tmp_dir, 'deduped.tar')
+            runwithclient(self._dc, self._parser.parse_args(( '--record', '--dedupe', '-t', deduped, 'greatest:hits' )))
+
+            with open(deduped + '.layers.json', 'rb') as record_file:
+                self.assertTrue(json_loads(record_file.read().decode('utf-8'))['dedupe'])
+
+            self.assertIsNone(readrecord(self._parser.parse_args(( '--previous', deduped, '-t', target, 'greatest:hits' ))))
+        finally:
+            rmtree(tmp_dir, ignore_errors=True)
+
+    def test_reproducible(self):
+        tmp_dir = mkdtemp()
+
+        try:
+            target_values = []
+
+            for name in ( 'a.tar.gz', 'b.tar.gz' ):
+                target = ospath_join(tmp_dir, name)
+                runwithclient(self._dc, self._parser.parse_args(( '--reproducible', '--clamp-mtime', '1431216000', '-z', '-t', target, 'greatest:hits' )))
+
+                with open(target, 'rb') as target_file:
+                    target_values.append(target_file.read())
+
+            self.assertEqual(target_values[0], target_values[1])
+            self.assertEqual(target_values[0][4:8], b'\0\0\0\0')  # gzip's mtime
+
+            with TarFile.open(ospath_join(tmp_dir, 'a.tar.gz'), mode='r:gz') as tar_file:
+                infos = list(tar_file)
+
+            self.assertEqual([ i.name for i in infos ], sorted(i.name for i in infos))
+            self.assertTrue(all(i.mtime <= 1431216000 for i in infos))
+        finally:
+            rmtree(tmp_dir, ignore_errors=True)
+
+    def test_sparse(self):
+        tmp_dir = mkdtemp()
+
+        try:
+            # Without sparse files, nothing changes
+            targets = [ ospath_join(tmp_dir, 'target{}.tar'.format(i)) for i in range(2) ]
+            runwithclient(self._dc, self._parser.parse_args(( '-t', targets[0], 'greatest:hits' )))
+            runwithclient(self._dc, self._parser.parse_args(( '--sparse', '-t', targets[1], 'greatest:hits' )))
+
+            with open(targets[0], 'rb') as target_file0, \
+                    open(targets[1], 'rb') as target_file1:
+                self.assertEqual(target_file1.read(), target_file0.read())
+
+            # The index would describe the sparse members' encoded data
+            argv = [ 'dimgx', '--sparse', '--index', '-t', ospath_join(tmp_dir, 'indexed.tar'), 'greatest:hits' ]
+
+            with self.assertRaises(CalledProcessError):
+                _runmain(argv, stderr=STDOUT)
+        finally:
+            rmtree(tmp_dir, ignore_errors=True)
+
+    def test_spool(self):
+        tmp_dir = mkdtemp()
+
+        try:
+            # Where layers are spooled doesn't change what is written
+            targets = [ ospath_join(tmp_dir, 'target{}.tar'.format(i)) for i in range(4) ]
+            runwithclient(self._dc, self._parser.parse_args(( '-t', targets[0], 'greatest:hits' )))
+            runwithclient(self._dc, self._parser.parse_args(( '--spool-dir', tmp_dir, '-t', targets[1], 'greatest:hits' )))
+            runwithclient(self._dc, self._parser.parse_args(( '--spool-memory', '64', '--spool-limit', '64', '-t', targets[2], 'greatest:hits' )))
+
+            # A cut-off transfer is resumed
+            spool_dir = ospath_join(tmp_dir, 'spool')
+            dc = FlakyFauxDockerClient(len(self._dc.get_image('greatest:hits').read()) // 2)
+            runwithclient(dc, self._parser.parse_args(( '--spool-dir', spool_dir, '--spool-persist', '--retries', '1', '-t', targets[3], 'greatest:hits' )))
+            self.assertEqual(len(dc.retrieved), 2)
+            self.assertTrue(isfile(ospath_join(spool_dir, 'spool.json')))
+            rmtree(spool_dir)
+
+            for target in targets[1:]:
+                with open(targets[0], 'rb') as target_file0, \
+                        open(target, 'rb') as target_file:
+                    self.assertEqual(target_file.read(), target_file0.read(), msg=target)
+
+            self.assertEqual(sorted(listdir(tmp_dir)), sorted(basename(t) for t in targets))
+
+            with self.assertRaises(SpoolLimitExceeded):
+                runwithclient(self._dc, self._parser.parse_args(( '--spool-limit', '0', '-t', ospath_join(tmp_dir, 'limited.tar'), 'greatest:hits' )))
+        finally:
+            rmtree(tmp_dir, ignore_errors=True)
+
+    def test_targetdir(self):
+        tmp_dir = mkdtemp()
+
+        try:
+            archive_path = ospath_join(tmp_dir, 'saved.tar')
+
+            with open(archive_path, 'wb') as archive_file:
+                copyfileobj(self._dc.get_image('getto:dachoppa'), archive_file)
+
+            target_dir = ospath_join(tmp_dir, 'root')
+            argv = [ 'dimgx', '--archive', archive_path, '--target-dir', target_dir, 'getto:dachoppa' ]
+            _runmain(argv)
+            self.assertTrue(isdir(ospath_join(target_dir, 'tmp')))
+
+            # Refuse to write into a non-empty directory without -w
+            with self.assertRaises(CalledProcessError):
+                _runmain(argv, stderr=STDOUT)
+
+            argv.insert(1, '-w')
+            _runmain(argv)
+
+            # An existing OCI image layout can be added to, but the
+            # non-layout directory above can't be written to without -w
+            oci_dir = ospath_join(tmp_dir, 'oci')
+
+            for target_dir, should_fail in ( ( oci_dir, False ), ( oci_dir, False ), ( ospath_join(tmp_dir, 'root'), True ) ):
+                argv = [ 'dimgx', '--archive', archive_path, '--oci-dir', target_dir, 'getto:dachoppa' ]
+
+                if should_fail:
+                    with self.assertRaises(CalledProcessError):
+                        _runmain(argv, stderr=STDOUT)
+                else:
+                    _runmain(argv)
+
+            self.assertTrue(isfile(ospath_join(oci_dir, 'oci-layout')))
+
+            with open(ospath_join(oci_dir, 'index.json'), 'rb') as index_file:
+                self.assertEqual(len(json_loads(index_file.read().decode('utf-8'))['manifests']), 1)
+        finally:
+            rmtree(tmp_dir, ignore_errors=True)
+
     def test_version(self):
         try:
             self._parser.parse_args(( '-V', ))
@@ -206,6 +729,16 @@ class CommandTestCase(TestCase):
         else:
             self.assertFail('--version did not cause exit')
 
+# ---- Functions ---------------------------------------------------------
+
+# ========================================================================
+def _runmain(argv, **kw):
+    # Runs the command line tool with argv in a separate process (so that
+    # it can exit), returning its output
+    code = 'import sys; sys.argv = {!r}; from _dimgx.cmd import main; main()'.format(argv)
+
+    return check_output(( executable, '-c', code ), cwd=dirname(dirname(__file__)), **kw)
+
 # ---- Initialization ----------------------------------------------------
 
 if __name__ == '__main__':
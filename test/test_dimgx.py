@@ -21,23 +21,61 @@ from future.utils import iteritems
 # ---- Imports -----------------------------------------------------------
 
 from copy import deepcopy
-from datetime import datetime
+from datetime import (
+    datetime,
+    timedelta,
+)
+from functools import partial
+from hashlib import sha256
+from io import BytesIO
+from json import loads as json_loads
 from operator import itemgetter
-from os import curdir
+from os import (
+    curdir,
+    environ,
+)
 from os.path import (
     expanduser,
     expandvars,
     join as ospath_join,
 )
-from tarfile import TarFile
+from posixpath import (
+    join as posixpath_join,
+    split as posixpath_split,
+)
+from shutil import rmtree
+from tarfile import (
+    DIRTYPE,
+    LNKTYPE,
+    PAX_FORMAT,
+    TarFile,
+    TarInfo,
+)
+from tempfile import mkdtemp
 from unittest import TestCase
 from docker.errors import APIError
-from _dimgx import TZ_UTC
+import _dimgx
+from _dimgx import (
+    TZ_UTC,
+    cachedprobe,
+)
+from _dimgx.sources import TarLayerReader
+from _dimgx.targets import sparsemember
 from dimgx import (
+    ImageRecord,
+    LayerGraph,
+    analyzeimages,
+    catpath,
+    compactimages,
     denormalizeimage,
+    diffimages,
+    extractdelta,
+    extractimages,
     extractlayers,
     inspectlayers,
+    loadlayers,
     normalizeimage,
+    normalizeimages,
 )
 from test import HashedBytesIo
 from test.fauxdockerclient import FauxDockerClient
@@ -50,6 +88,109 @@ _EMTPY_TAR_SHA256 = '84ff92691f909a05b224e1c56abb4864f01b4f8e3c854e4bb4c7baf1d3f
 
 # ---- Classes -----------------------------------------------------------
 
+# ========================================================================
+class GuardedLayersClient(object):
+    """
+    Faux client that lists images with :obj:`listing_dc` and opens their
+    layers with :obj:`source`, except for those in :obj:`guarded_ids`,
+    which fail if opened.
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, listing_dc, source, guarded_ids):
+        super().__init__()
+        self.guarded_ids = frozenset(guarded_ids)
+        self._listing_dc = listing_dc
+        self._source = source
+
+    # ---- Public hooks --------------------------------------------------
+
+    def images(self, all=False):  # pylint: disable=redefined-builtin
+        return self._listing_dc.images(all)
+
+    def openlayer(self, layer_id):
+        if layer_id in self.guarded_ids:
+            raise AssertionError('opened guarded layer {}'.format(layer_id[:12]))
+
+        return self._source.openlayer(layer_id)
+
+# ========================================================================
+class ListingDockerClient(object):
+    """
+    Faux client that only knows how to list images (built from a compact
+    spec of ( name, parent_name, size, repo_tags ) tuples).
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, spec):
+        super().__init__()
+        self.ids = dict(( name, '{:064x}'.format(ord(name)) ) for name, _, _, _ in spec)
+        self._images = [ {
+            'Created': 1431216000 + i,
+            'Id': self.ids[name],
+            'ParentId': self.ids[parent] if parent else '',
+            'RepoTags': repo_tags if repo_tags else [ '<none>:<none>' ],
+            'Size': size,
+            'VirtualSize': size,
+        } for i, ( name, parent, size, repo_tags ) in enumerate(spec) ]
+
+    # ---- Public hooks --------------------------------------------------
+
+    def images(self, all=False):  # pylint: disable=redefined-builtin
+        assert all
+
+        return deepcopy(self._images)
+
+# ========================================================================
+class TarLayersSource(object):
+    """
+    Faux source of layers, each built from a sequence of ( name, data,
+    linkname ) tuples (where data is None for a directory), or ( name,
+    data, linkname, sparse ) tuples for sparse files (where sparse is a
+    list of the data segments in data).
+    """
+
+    # ---- Constructor ---------------------------------------------------
+
+    def __init__(self, entries_by_layer_id):
+        super().__init__()
+        self._layer_tars_by_id = {}
+
+        for layer_id, entries in iteritems(entries_by_layer_id):
+            layer_file = BytesIO()
+
+            with TarFile(mode='w', fileobj=layer_file, format=PAX_FORMAT) as tar_file:
+                for entry in entries:
+                    name, data, linkname = entry[:3]
+                    info = TarInfo(name)
+                    info.mtime = 1431216000
+                    info.uname = 'nobody'
+
+                    if linkname is not None:
+                        info.type = LNKTYPE
+                        info.linkname = linkname
+                        tar_file.addfile(info)
+                    elif data is None:
+                        info.type = DIRTYPE
+                        info.mode = 0o755
+                        tar_file.addfile(info)
+                    elif len(entry) > 3:
+                        info.size = len(data)
+                        info.sparse = entry[3]
+                        tar_file.addfile(*sparsemember(info, BytesIO(data)))
+                    else:
+                        info.size = len(data)
+                        tar_file.addfile(info, BytesIO(data))
+
+            self._layer_tars_by_id[layer_id] = layer_file.getvalue()
+
+    # ---- Public methods ------------------------------------------------
+
+    def openlayer(self, layer_id):
+        return TarLayerReader(BytesIO(self._layer_tars_by_id[layer_id]), layer_id)
+
 # ========================================================================
 class DimgxTestCase(TestCase):
 
@@ -61,6 +202,208 @@ class DimgxTestCase(TestCase):
         self.maxDiff = None
         self._dc = FauxDockerClient()
 
+    def test_analyzeimages(self):
+        dc = ListingDockerClient((
+            ( 'r', None, 10, None ),
+            ( 'a', 'r', 20, [ 'a:1' ] ),
+            ( 'b', 'a', 30, [ 'b:1' ] ),
+            ( 'c', 'a', 5, None ),
+            ( 'd', 'r', 7, None ),
+            ( 'e', 'd', 3, [ 'e:1', 'e:latest' ] ),
+            ( 'f', None, 100, None ),
+        ))
+        ids = dc.ids
+
+        for compact in ( True, False ):
+            analysis = analyzeimages(dc, compact=compact)
+            self.assertEqual(len(analysis[':all_images']), 7)
+            order = [ l[':id'] for l in analysis[':layers'] ]
+
+            for layer in analysis[':layers']:
+                if layer[':parent_id']:
+                    self.assertLess(order.index(layer[':parent_id']), order.index(layer[':id']))
+
+            self.assertEqual(analysis[':ref_counts'], {
+                ids['r']: 3, ids['a']: 2, ids['b']: 1, ids['c']: 0, ids['d']: 1, ids['e']: 1, ids['f']: 0,
+            })
+            self.assertEqual(analysis[':exclusive_sizes'], { ids['a']: 0, ids['b']: 30, ids['e']: 10 })
+            self.assertEqual(sorted(analysis[':dangling']), sorted([ ( ids['c'], 5 ), ( ids['f'], 100 ) ]))
+            self.assertEqual(analysis[':shared_size'], 30)
+            self.assertEqual(analysis[':exclusive_size'], 40)
+            self.assertEqual(analysis[':dangling_size'], 105)
+            self.assertEqual(analysis[':total_size'], 175)
+
+        analysis = analyzeimages(self._dc)
+        self.assertEqual(set(analysis[':ref_counts'].values()), { 1 })
+        self.assertEqual(analysis[':dangling'], [])
+        self.assertEqual(analysis[':total_size'], sum(l['Size'] for l in self._dc.layers))
+
+    def test_cachedprobe(self):
+        calls = []
+
+        def _probe():
+            calls.append(None)
+
+            return len(calls)
+
+        cache_dir = mkdtemp()
+        old_cache_dir = environ.get('DIMGX_CACHE_DIR')
+        environ['DIMGX_CACHE_DIR'] = cache_dir
+
+        try:
+            self.assertEqual(cachedprobe('test_probe', 'a', _probe), 1)
+            self.assertEqual(cachedprobe('test_probe', 'a', _probe), 1)
+            self.assertEqual(cachedprobe('test_probe', 'b', _probe), 2)
+
+            # Forget what this process knows, and make sure it's read back
+            # from disk
+            del _dimgx._PROBES['test_probe']  # pylint: disable=protected-access
+            self.assertEqual(cachedprobe('test_probe', 'a', _probe), 1)
+            self.assertEqual(cachedprobe('test_probe', 'b', _probe), 2)
+            self.assertEqual(len(calls), 2)
+        finally:
+            if old_cache_dir is None:
+                del environ['DIMGX_CACHE_DIR']
+            else:
+                environ['DIMGX_CACHE_DIR'] = old_cache_dir
+
+            rmtree(cache_dir, ignore_errors=True)
+
+    def test_catpath(self):
+        for image_spec in ( 'getto:dachoppa', 'greatest:hits' ):
+            layers = inspectlayers(self._dc, image_spec)[':layers']
+            target_file = BytesIO()
+
+            with TarFile(mode='w', fileobj=target_file) as tar_file:
+                extractlayers(self._dc, layers, tar_file)
+
+            target_file.seek(0)
+            names = set()
+
+            with TarFile(mode='r', fileobj=target_file) as tar_file:
+                for info in tar_file:
+                    names.add(info.name)
+                    out_file = BytesIO()
+                    _, found_info = catpath(self._dc, layers, info.name, out_file)
+                    self.assertEqual(( found_info.name, found_info.type, found_info.mode, found_info.mtime, found_info.size ), ( info.name, info.type, info.mode, info.mtime, info.size ), msg=info.name)
+
+                    if info.isreg():
+                        self.assertEqual(out_file.getvalue(), tar_file.extractfile(info).read(), msg=info.name)
+
+            # Names that only older layers provide are hidden
+            for layer in layers:
+                layer_file = BytesIO()
+
+                with TarFile(mode='w', fileobj=layer_file) as tar_file:
+                    extractlayers(self._dc, [ layer ], tar_file)
+
+                layer_file.seek(0)
+
+                with TarFile(mode='r', fileobj=layer_file) as tar_file:
+                    for name in set(tar_file.getnames()) - names:
+                        self.assertIsNone(catpath(self._dc, layers, name), msg=name)
+
+            # The search stops at the layer providing (or hiding) the path,
+            # so a bogus layer below it is never opened
+            self.assertIsNotNone(catpath(self._dc, layers + [ { ':id': '0' * 64 } ], 'tmp'))
+
+            with self.assertRaises(Exception):
+                catpath(self._dc, layers + [ { ':id': '0' * 64 } ], 'tmp/nonexistent')
+
+    def test_compactimages(self):
+        images = self._dc.images(all=True)
+        records = compactimages(images)
+        normalized_images = normalizeimages(images, copy=True)
+        records_by_id = {}
+
+        for image, record, normalized_image in zip(images, records, normalized_images):
+            self.assertIsInstance(record, ImageRecord)
+            self.assertFalse(hasattr(record, '__dict__'))
+            self.assertEqual(record.raw, image)
+            record_dict = dict(record)
+            record_dict[':repo_tags'] = list(record_dict[':repo_tags'])
+            self.assertEqual(record_dict, normalized_image)
+            self.assertEqual(len(record), len(normalized_image))
+            records_by_id[record[':id']] = record
+
+            for key, value in image.items():
+                self.assertIn(key, record)
+                self.assertEqual(record[key], value, msg=key)
+
+            self.assertNotIn(':child_ids', record)
+            self.assertNotIn('Labels', record)
+
+            with self.assertRaises(KeyError):
+                record['Labels']  # pylint: disable=pointless-statement
+
+            with self.assertRaises(KeyError):
+                record[':child_ids']  # pylint: disable=pointless-statement
+
+            with self.assertRaises(KeyError):
+                record['Id'] = 'nope'
+
+        for record in records:
+            if record[':parent_id']:
+                self.assertIs(record[':parent_id'], records_by_id[record[':parent_id']][':id'])
+
+        layers_dict = inspectlayers(self._dc, 'greatest:hits')
+        compact_layers_dict = inspectlayers(self._dc, 'greatest:hits', compact=True)
+        self.assertEqual([ l[':id'] for l in compact_layers_dict[':layers'] ], [ l[':id'] for l in layers_dict[':layers'] ])
+        self.assertEqual([ l[':child_ids'] for l in compact_layers_dict[':layers'] ], [ l[':child_ids'] for l in layers_dict[':layers'] ])
+
+        for layers in ( layers_dict[':layers'], compact_layers_dict[':layers'] ):
+            self.assertEqual(self._get_hash_tar('greatest:hits', slice(None), 0, layers=layers).hash_obj.hexdigest(), self._get_hash_tar('greatest:hits', slice(None), 0).hash_obj.hexdigest())
+
+    def test_diffimages(self):
+        getto_ids = [ l[':id'] for l in inspectlayers(self._dc, 'getto:dachoppa')[':layers'] ]
+        hits_ids = [ l[':id'] for l in inspectlayers(self._dc, 'greatest:hits')[':layers'] ]
+        image_ids = [ getto_ids[i] for i in ( 0x0, 0xd, 0xe, 0xf ) ] + [ hits_ids[i] for i in ( 0x0, 0xb, 0xd, 0xf ) ]
+        trees = dict(( image_id, self._get_tree(image_id) ) for image_id in image_ids)
+
+        for image_id_a in image_ids:
+            for image_id_b in image_ids:
+                tree_a = trees[image_id_a]
+                tree_b = trees[image_id_b]
+                msg = '{} -> {}'.format(image_id_a[:12], image_id_b[:12])
+
+                for digests in ( False, True ):
+                    diff = diffimages(self._dc, image_id_a, image_id_b, digests)
+                    self.assertEqual(diff[':added'], sorted(set(tree_b).difference(tree_a)), msg=msg)
+                    self.assertEqual(diff[':removed'], sorted(set(tree_a).difference(tree_b)), msg=msg)
+                    expected_modified = []
+
+                    for name in sorted(set(tree_a).intersection(tree_b)):
+                        fields = tuple(f for f, v_a, v_b in zip(( 'type', 'size', 'mode', 'uid', 'gid', 'mtime', 'linkname', 'digest' ), tree_a[name], tree_b[name]) if v_a != v_b and ( digests or f != 'digest' ))
+
+                        if fields:
+                            expected_modified.append(( name, fields ))
+
+                    self.assertEqual(diff[':modified'], expected_modified, msg=msg)
+
+                    if image_id_a in getto_ids and image_id_b in getto_ids:
+                        self.assertEqual(diff[':ancestor_id'], max(( image_id_a, image_id_b ), key=getto_ids.index), msg=msg)
+                    elif ( image_id_a in getto_ids ) != ( image_id_b in getto_ids ):
+                        self.assertIsNone(diff[':ancestor_id'], msg=msg)
+
+        # When both images change the same paths and neither removes any,
+        # the shared layers are never opened
+        listing_dc = ListingDockerClient(( ( 'a', None, 0, None ), ( 'b', 'a', 0, [ 'b:latest' ] ), ( 'c', 'a', 0, [ 'c:latest' ] ) ))
+        ids = listing_dc.ids
+        source = TarLayersSource({ ids['a']: (), ids['b']: ( ( 'x', b'bb', None ), ), ids['c']: ( ( 'x', b'c', None ), ) })
+        dc = GuardedLayersClient(listing_dc, source, ( ids['a'], ))
+        diff = diffimages(dc, 'b:latest', 'c:latest')
+        self.assertEqual(diff[':ancestor_id'], ids['a'])
+        self.assertEqual(diff[':modified'], [ ( 'x', ( 'size', ) ) ])
+        target_file = BytesIO()
+
+        with TarFile(mode='w', fileobj=target_file) as tar_file:
+            extractdelta(dc, 'b:latest', 'c:latest', tar_file)
+
+        target_file.seek(0)
+
+        with TarFile(mode='r', fileobj=target_file) as tar_file:
+            self.assertEqual([ ( i.name, tar_file.extractfile(i).read() ) for i in tar_file ], [ ( 'x', b'c' ) ])
+
     def test_extractall(self):
         specs = (
             ( 'getto:dachoppa', slice(None), 'ffd384a2a277c9c1183e5f28da244cc0f4fe92d45e273eaf142dcc4e8fd0e5ef', 0 ),
@@ -71,6 +414,164 @@ class DimgxTestCase(TestCase):
 
         self._check_specs(specs)
 
+    def test_extractimages(self):
+        get_image = self._dc.get_image
+        get_image_calls = []
+
+        def _getimage(image):
+            get_image_calls.append(image)
+
+            return get_image(image)
+
+        def _broken():
+            raise ValueError('broken')
+
+        self._dc.get_image = _getimage
+        getto_layers = inspectlayers(self._dc, 'getto:dachoppa')[':layers']
+        hits_layers = inspectlayers(self._dc, 'greatest:hits')[':layers']
+        specs = (
+            ( getto_layers, 0 ),
+            ( hits_layers, 0 ),
+            ( getto_layers[4:], 0 ),  # provided by getto:dachoppa
+            ( getto_layers[::-1], -1 ),  # provided by getto:dachoppa
+        )
+        expected_hexdigests = [ self._get_hash_tar(None, slice(None), top_most_layer, layers).hash_obj.hexdigest() for layers, top_most_layer in specs ]
+
+        for num_workers in ( None, 1, 3 ):
+            del get_image_calls[:]
+            target_files = [ HashedBytesIo() for _ in specs ]
+            jobs = [ ( layers, partial(TarFile, mode='w', fileobj=target_file), top_most_layer ) for ( layers, top_most_layer ), target_file in zip(specs, target_files) ]
+            extractimages(self._dc, jobs, num_workers)
+            self.assertEqual(len(get_image_calls), 2, msg='num_workers: {}'.format(num_workers))
+            self.assertEqual([ target_file.hash_obj.hexdigest() for target_file in target_files ], expected_hexdigests, msg='num_workers: {}'.format(num_workers))
+
+        with self.assertRaises(ValueError):
+            extractimages(self._dc, [ ( getto_layers, _broken ), ( hits_layers, _broken ) ], 2)
+
+    def test_extractdeduped(self):
+        source = TarLayersSource({
+            'top': ( ( 'a', b'same', None ), ( 'b', b'same', None ), ( 'c', b'diff', None ), ( 'e', b'', None ), ( 'f', b'', None ) ),
+            'bottom': ( ( 'b', b'hidden', None ), ( 'd', b'same', None ), ( 'g', b'diff', None ) ),
+        })
+        layers = [ { ':id': 'top' }, { ':id': 'bottom' } ]
+
+        for reproducible in ( False, True ):
+            msg = 'reproducible: {}'.format(reproducible)
+            target_file = BytesIO()
+
+            with TarFile(mode='w', fileobj=target_file) as tar_file:
+                extractlayers(source, layers, tar_file, reproducible=reproducible, dedupe=True)
+
+            target_file.seek(0)
+
+            with TarFile(mode='r', fileobj=target_file) as tar_file:
+                entries = dict(( i.name, ( tar_file.extractfile(i).read(), i.linkname or None ) ) for i in tar_file)
+
+            self.assertEqual(entries, {
+                'a': ( b'same', None ),
+                'b': ( b'same', 'a' ),
+                'c': ( b'diff', None ),
+                'd': ( b'same', 'a' ),
+                'e': ( b'', None ),
+                'f': ( b'', None ),
+                'g': ( b'diff', 'c' ),
+            }, msg=msg)
+
+        # Names too long for a plain header don't keep duplicates apart
+        long_names = [ 'long/' + c * 120 for c in 'ab' ]
+        source = TarLayersSource({ 'top': ( ( 'long', None, None ), ( long_names[0], b'same', None ), ( long_names[1], b'same', None ) ) })
+        target_file = BytesIO()
+
+        with TarFile(mode='w', fileobj=target_file) as tar_file:
+            extractlayers(source, [ { ':id': 'top' } ], tar_file, dedupe=True)
+
+        target_file.seek(0)
+
+        with TarFile(mode='r', fileobj=target_file) as tar_file:
+            entries = dict(( i.name, ( tar_file.extractfile(i).read(), i.linkname or None, i.pax_headers.get('size') ) ) for i in tar_file if not i.isdir())
+
+        self.assertEqual(entries, { long_names[0]: ( b'same', None, None ), long_names[1]: ( b'same', long_names[0], None ) })
+
+        # Linked or not, the contents are the same
+        for image_spec in ( 'getto:dachoppa', 'greatest:hits' ):
+            layers = inspectlayers(self._dc, image_spec)[':layers']
+            data = []
+
+            for dedupe in ( False, True ):
+                target_file = BytesIO()
+
+                with TarFile(mode='w', fileobj=target_file) as tar_file:
+                    extractlayers(self._dc, layers, tar_file, dedupe=dedupe)
+
+                target_file.seek(0)
+
+                with TarFile(mode='r', fileobj=target_file) as tar_file:
+                    data.append(dict(( i.name, tar_file.extractfile(i).read() if i.isreg() or i.islnk() else None ) for i in tar_file))
+
+            self.assertEqual(data[1], data[0], msg=image_spec)
+
+    def test_extractdelta(self):
+        getto_ids = [ l[':id'] for l in inspectlayers(self._dc, 'getto:dachoppa')[':layers'] ]
+        hits_ids = [ l[':id'] for l in inspectlayers(self._dc, 'greatest:hits')[':layers'] ]
+        image_ids = [ getto_ids[i] for i in ( 0x0, 0xd, 0xe, 0xf ) ] + [ hits_ids[i] for i in ( 0x0, 0xb, 0xd, 0xf ) ]
+        trees = dict(( image_id, self._get_tree(image_id) ) for image_id in image_ids)
+
+        for image_id_a in image_ids:
+            for image_id_b in image_ids:
+                msg = '{} -> {}'.format(image_id_a[:12], image_id_b[:12])
+                target_file = BytesIO()
+
+                with TarFile(mode='w', fileobj=target_file) as tar_file:
+                    extractdelta(self._dc, image_id_a, image_id_b, tar_file)
+
+                target_file.seek(0)
+                tree = dict(trees[image_id_a])
+
+                # Apply the delta like Docker would
+                with TarFile(mode='r', fileobj=target_file) as tar_file:
+                    for info in tar_file:
+                        dir_name, base_name = posixpath_split(info.name)
+
+                        if base_name.startswith('.wh.'):
+                            removed = posixpath_join(dir_name, base_name[4:])
+                            self.assertIn(removed, tree, msg=msg)
+                            tree = dict(( k, v ) for k, v in tree.items() if k != removed and not k.startswith(removed + '/'))
+                        else:
+                            if not info.isdir():
+                                tree = dict(( k, v ) for k, v in tree.items() if not k.startswith(info.name + '/'))
+
+                            content = tar_file.extractfile(info).read() if info.isreg() else b''
+                            entry_type = 'file' if info.isreg() else 'dir' if info.isdir() else info.type
+                            tree[info.name] = ( entry_type, info.size, info.mode, info.uid, info.gid, info.mtime, info.linkname, sha256(content).hexdigest() if info.isreg() else None )
+
+                self.assertEqual(tree, trees[image_id_b], msg=msg)
+
+                if image_id_a == image_id_b:
+                    self.assertEqual(target_file.getvalue().strip(b'\0'), b'', msg=msg)
+
+        # A new hard link to a file the base already has gets its contents
+        # (under its own name, even where that's too long for a plain
+        # header), and sparse files are written out in full
+        long_target = 'long/' + 't' * 120
+        long_link = 'long/' + 'l' * 120
+        sparse_data = b'data' + b'\0' * 8188 + b'more'
+        listing_dc = ListingDockerClient(( ( 'a', None, 0, None ), ( 'b', 'a', 0, [ 'b:latest' ] ), ( 'c', 'b', 0, [ 'c:latest' ] ) ))
+        ids = listing_dc.ids
+        source = TarLayersSource({
+            ids['a']: ( ( 'long', None, None ), ( long_target, b'target', None ) ),
+            ids['b']: ( ( 'u', b'upper', None ), ),
+            ids['c']: ( ( long_link, None, long_target ), ( 'm', None, 'u' ), ( 's', sparse_data, None, [ ( 0, 4 ), ( 8192, 4 ) ] ) ),
+        })
+        target_file = BytesIO()
+
+        with TarFile(mode='w', fileobj=target_file) as tar_file:
+            extractdelta(GuardedLayersClient(listing_dc, source, ()), 'b:latest', 'c:latest', tar_file)
+
+        target_file.seek(0)
+
+        with TarFile(mode='r', fileobj=target_file) as tar_file:
+            self.assertEqual(sorted(( i.name, i.isreg(), tar_file.extractfile(i).read() ) for i in tar_file), [ ( long_link, True, b'target' ), ( 'm', True, b'upper' ), ( 's', True, sparse_data ) ])
+
     def test_extractempty(self):
         specs = (
             ( 'getto:dachoppa', ( 0x0, 0x1, 0x2, 0x3, 0x4, 0x5, 0x6, 0x7, 0x8, 0x9, 0xa, 0xb, 0xc ), _EMTPY_TAR_SHA256, 0 ),
@@ -174,6 +675,207 @@ class DimgxTestCase(TestCase):
 
         self._check_specs(specs)
 
+    def test_extractfiltered(self):
+        layers = inspectlayers(self._dc, 'greatest:hits')[':layers']
+        full_file = BytesIO()
+
+        with TarFile(mode='w', fileobj=full_file) as tar_file:
+            extractlayers(self._dc, layers, tar_file)
+
+        full_file.seek(0)
+
+        with TarFile(mode='r', fileobj=full_file) as tar_file:
+            full_infos = dict(( i.name, i.get_info() ) for i in tar_file)
+
+        for include, exclude, expected_names in (
+                ( [ 'tmp/c.dir' ], None, [ 'tmp', 'tmp/c.dir', 'tmp/c.dir/f.file', 'tmp/c.dir/g.file' ] ),
+                ( [ 'tmp/?.dir' ], [ '**/g.*' ], [ 'tmp', 'tmp/b.dir', 'tmp/c.dir', 'tmp/c.dir/f.file' ] ),
+                ( [ '**/*.file', 'tmp/e.link' ], None, [ 'tmp', 'tmp/c.dir', 'tmp/c.dir/f.file', 'tmp/c.dir/g.file', 'tmp/e.link' ] ),
+                ( None, [ 'tmp/[!b].dir' ], [ 'tmp', 'tmp/b.dir', 'tmp/e.link' ] ),
+                ( [ 'tmp/c' ], None, [ 'tmp' ] ),
+                ( None, [ 'tmp' ], [] ),
+        ):
+            msg = 'include: {}; exclude: {}'.format(include, exclude)
+            target_file = BytesIO()
+
+            with TarFile(mode='w', fileobj=target_file) as tar_file:
+                extractlayers(self._dc, layers, tar_file, include=include, exclude=exclude)
+
+            target_file.seek(0)
+
+            with TarFile(mode='r', fileobj=target_file) as tar_file:
+                infos = dict(( i.name, i.get_info() ) for i in tar_file)
+
+            self.assertEqual(sorted(infos), expected_names, msg=msg)
+            self.assertEqual(infos, dict(( name, full_infos[name] ) for name in expected_names), msg=msg)
+            loadlayers(self._dc, layers, include=include, exclude=exclude)
+
+            with TarFile(mode='r', fileobj=BytesIO(self._dc.loaded[-1])) as loaded_tar_file:
+                layer_info, = [ i for i in loaded_tar_file if i.name.endswith('/layer.tar') ]
+                self.assertEqual(loaded_tar_file.extractfile(layer_info).read(), target_file.getvalue(), msg=msg)
+
+        # A non-directory that replaced one leading to what's included
+        # (e.g., a link in place of usr/lib) still hides what was in it
+        source = TarLayersSource({
+            'top': ( ( 'usr', None, None ), ( 'usr/lib', b'replaced', None ) ),
+            'bottom': ( ( 'usr', None, None ), ( 'usr/lib', None, None ), ( 'usr/lib/python3', None, None ), ( 'usr/lib/python3/site.py', b'hidden', None ) ),
+        })
+        target_file = BytesIO()
+
+        with TarFile(mode='w', fileobj=target_file) as tar_file:
+            extractlayers(source, [ { ':id': 'top' }, { ':id': 'bottom' } ], tar_file, include=[ 'usr/lib/python*' ])
+
+        target_file.seek(0)
+
+        with TarFile(mode='r', fileobj=target_file) as tar_file:
+            self.assertEqual([ i.name for i in tar_file ], [ 'usr' ])
+
+    def test_extractprevious(self):
+        tmp_dir = mkdtemp()
+
+        try:
+            for image_spec in ( 'getto:dachoppa', 'greatest:hits' ):
+                layers = inspectlayers(self._dc, image_spec)[':layers']
+                expected_file = BytesIO()
+
+                with TarFile(mode='w', fileobj=expected_file) as tar_file:
+                    extractlayers(self._dc, layers, tar_file)
+
+                for i in ( 0, 1, 2, len(layers) // 2, len(layers) - 1 ):
+                    msg = '{}: {}'.format(image_spec, i)
+                    previous_path = ospath_join(tmp_dir, 'previous.tar')
+                    previous_ids = [ layer[':id'] for layer in layers[i:] ]
+
+                    with TarFile(previous_path, mode='w') as tar_file:
+                        extractlayers(self._dc, layers[i:], tar_file)
+
+                    # With nothing new, there's no need for the client at
+                    # all
+                    target_file = BytesIO()
+
+                    with TarFile(mode='w', fileobj=target_file) as tar_file:
+                        extractlayers(self._dc if i else None, layers, tar_file, previous=( previous_path, previous_ids ))
+
+                    self.assertEqual(target_file.getvalue(), expected_file.getvalue(), msg=msg)
+
+                # A previous archive of a different chain is ignored
+                target_file = BytesIO()
+
+                with TarFile(mode='w', fileobj=target_file) as tar_file:
+                    extractlayers(self._dc, layers, tar_file, previous=( previous_path, previous_ids[:-1] ))
+
+                self.assertEqual(target_file.getvalue(), expected_file.getvalue(), msg=image_spec)
+        finally:
+            rmtree(tmp_dir, ignore_errors=True)
+
+    def test_extractreproducible(self):
+        clamp_mtime = 1431216000
+
+        for image_spec in ( 'getto:dachoppa', 'greatest:hits' ):
+            layers = inspectlayers(self._dc, image_spec)[':layers']
+            plain_file = BytesIO()
+
+            with TarFile(mode='w', fileobj=plain_file) as tar_file:
+                extractlayers(self._dc, layers, tar_file)
+
+            plain_file.seek(0)
+
+            with TarFile(mode='r', fileobj=plain_file) as tar_file:
+                plain_data = dict(( i.name, tar_file.extractfile(i).read() if i.isreg() else None ) for i in tar_file)
+
+            target_values = []
+
+            for _ in range(2):
+                target_file = BytesIO()
+
+                with TarFile(mode='w', fileobj=target_file) as tar_file:
+                    extractlayers(self._dc, layers, tar_file, reproducible=True, clamp_mtime=clamp_mtime)
+
+                target_values.append(target_file.getvalue())
+
+            self.assertEqual(target_values[0], target_values[1], msg=image_spec)
+
+            with TarFile(mode='r', fileobj=BytesIO(target_values[0])) as tar_file:
+                infos = list(tar_file)
+                data = dict(( i.name, tar_file.extractfile(i).read() if i.isreg() else None ) for i in infos)
+
+            names = [ i.name for i in infos ]
+            self.assertEqual(names, sorted(names), msg=image_spec)
+            self.assertEqual(data, plain_data, msg=image_spec)
+
+            for info in infos:
+                self.assertEqual(( info.uname, info.gname ), ( '', '' ), msg=info.name)
+                self.assertLessEqual(info.mtime, clamp_mtime, msg=info.name)
+
+            # The loadable layer is the same archive
+            loadlayers(self._dc, layers, reproducible=True, clamp_mtime=clamp_mtime)
+
+            with TarFile(mode='r', fileobj=BytesIO(self._dc.loaded[-1])) as loaded_tar_file:
+                layer_info, = [ i for i in loaded_tar_file if i.name.endswith('/layer.tar') ]
+                self.assertEqual(loaded_tar_file.extractfile(layer_info).read(), target_values[0], msg=image_spec)
+                self.assertEqual(layer_info.mtime, clamp_mtime, msg=image_spec)
+
+        # Hard links that sort before what they link to get its contents
+        source = TarLayersSource({
+            'top': ( ( 'z', None, None ), ( 'z/file', b'linked', None ), ( 'a', None, None ), ( 'a/link', None, 'z/file' ), ( 'm', None, None ), ( 'm/link', None, 'z/file' ) ),
+            'bottom': ( ( 'b', b'unlinked', None ), ),
+        })
+        target_file = BytesIO()
+
+        with TarFile(mode='w', fileobj=target_file) as tar_file:
+            extractlayers(source, [ { ':id': 'top' }, { ':id': 'bottom' } ], tar_file, reproducible=True)
+
+        target_file.seek(0)
+
+        with TarFile(mode='r', fileobj=target_file) as tar_file:
+            entries = [ ( i.name, tar_file.extractfile(i).read() if i.isreg() else None, i.linkname or None ) for i in tar_file ]
+
+        self.assertEqual(entries, [
+            ( 'a', None, None ),
+            ( 'a/link', b'linked', None ),
+            ( 'b', b'unlinked', None ),
+            ( 'm', None, None ),
+            ( 'm/link', None, 'a/link' ),
+            ( 'z', None, None ),
+            ( 'z/file', None, 'a/link' ),
+        ])
+
+    def test_extractsparse(self):
+        data = b'head' + b'\0' * 8188 + b'tail' + b'\0' * 8188
+        source = TarLayersSource({
+            'top': ( ( 'var', None, None ), ( 'var/db.img', data, None, [ ( 0, 4 ), ( 8192, 4 ) ] ) ),
+            'bottom': ( ( 'var/db.img', b'hidden', None ), ),
+        })
+        layers = [ { ':id': 'top' }, { ':id': 'bottom' } ]
+
+        for sparse, reproducible in ( ( False, False ), ( True, False ), ( True, True ) ):
+            msg = 'sparse: {}; reproducible: {}'.format(sparse, reproducible)
+            target_file = BytesIO()
+
+            with TarFile(mode='w', fileobj=target_file, format=PAX_FORMAT) as tar_file:
+                extractlayers(source, layers, tar_file, reproducible=reproducible, sparse=sparse)
+
+            target_file.seek(0)
+
+            with TarFile(mode='r', fileobj=target_file) as tar_file:
+                _, member = list(tar_file)
+                self.assertEqual(( member.name, member.size ), ( 'var/db.img', len(data) ), msg=msg)
+                self.assertEqual(tar_file.extractfile(member).read(), data, msg=msg)
+
+                if sparse:
+                    self.assertEqual(member.sparse, [ ( 0, 512 ), ( 8192, 512 ), ( len(data), 0 ) ], msg=msg)
+                    self.assertLess(len(target_file.getvalue()), len(data), msg=msg)
+                else:
+                    self.assertIsNone(member.sparse, msg=msg)
+                    self.assertEqual([ k for k in member.pax_headers if k.startswith('GNU.sparse.') ], [], msg=msg)
+
+            # The loadable layer is the same archive
+            loadlayers(source, layers, load_dc=self._dc, reproducible=reproducible, sparse=sparse)
+
+            with TarFile(mode='r', fileobj=BytesIO(self._dc.loaded[-1])) as loaded_tar_file:
+                layer_info, = [ i for i in loaded_tar_file if i.name.endswith('/layer.tar') ]
+                self.assertEqual(loaded_tar_file.extractfile(layer_info).read(), target_file.getvalue(), msg=msg)
+
     def test_fauxclientsanity(self):
         self.assertEqual(self._dc.images('<does not exist>', all=True), [])
 
@@ -191,6 +893,79 @@ class DimgxTestCase(TestCase):
         dc = FauxDockerClient(exc)
         self.assertRaises(exc, dc.get_image, None)
 
+    def test_layergraph(self):
+        dc = ListingDockerClient((
+            ( 'r', None, 10, None ),
+            ( 'a', 'r', 20, [ 'a:1' ] ),
+            ( 'b', 'a', 30, [ 'b:1' ] ),
+            ( 'c', 'a', 5, None ),
+            ( 'd', 'r', 7, None ),
+            ( 'e', 'd', 3, [ 'e:1', 'e:latest' ] ),
+            ( 'f', None, 100, None ),
+        ))
+        ids = dc.ids
+        graph = LayerGraph.fromclient(dc)
+        self.assertEqual(len(graph), 7)
+        self.assertEqual(graph.depth(ids['b']), 2)
+        self.assertEqual(graph.parent(ids['b']), ids['a'])
+        self.assertIsNone(graph.parent(ids['f']))
+        self.assertEqual(sorted(graph.children(ids['r'])), sorted([ ids['a'], ids['d'] ]))
+        self.assertEqual(set(graph.descendants(ids['r'])), set(ids[n] for n in 'abcde'))
+        self.assertEqual(list(graph.ancestors(ids['e'])), [ ids['d'], ids['r'] ])
+        self.assertEqual([ l[':id'] for l in graph.chain(ids['c']) ], [ ids['c'], ids['a'], ids['r'] ])
+        self.assertEqual(graph.lca(ids['b'], ids['c']), ids['a'])
+        self.assertEqual(graph.lca(ids['b'], ids['e']), ids['r'])
+        self.assertEqual(graph.lca(ids['b'], ids['a']), ids['a'])
+        self.assertIsNone(graph.lca(ids['b'], ids['f']))
+        self.assertEqual(graph.resolve('e:1'), ids['e'])
+        self.assertEqual(graph.matches(ids['c'], within=ids['b']), [])
+        self.assertEqual(sorted(graph.matches(ids['c'][:12], within=ids['b'])), sorted([ ids['r'], ids['a'], ids['b'] ]))
+
+        with self.assertRaises(RuntimeError):
+            graph.resolve('nope:1')
+
+        # Check against walking chains
+        graph = LayerGraph(normalizeimages(self._dc.images(all=True)))
+        chains = dict(( image_id, [ image_id ] + list(graph.ancestors(image_id)) ) for image_id in graph)
+
+        for image_id_a, chain_a in iteritems(chains):
+            self.assertEqual(graph.depth(image_id_a), len(chain_a) - 1)
+
+            for image_id_b, chain_b in iteritems(chains):
+                self.assertEqual(graph.isancestor(image_id_a, image_id_b), image_id_a in chain_b)
+                expected_lca = next(( i for i in chain_a if i in chain_b ), None)
+                self.assertEqual(graph.lca(image_id_a, image_id_b), expected_lca)
+
+    def test_loadlayers(self):
+        for image_spec in ( 'getto:dachoppa', 'greatest:hits' ):
+            layers = inspectlayers(self._dc, image_spec)[':layers']
+            expected_file = BytesIO()
+
+            with TarFile(mode='w', fileobj=expected_file) as tar_file:
+                extractlayers(self._dc, layers, tar_file)
+
+            image_id = loadlayers(self._dc, layers, [ 'squashed:latest' ])
+
+            with TarFile(mode='r', fileobj=BytesIO(self._dc.loaded[-1])) as loaded_tar_file:
+                members = dict(( i.name, loaded_tar_file.extractfile(i).read() ) for i in loaded_tar_file)
+
+            manifest, = json_loads(members.pop('manifest.json').decode('utf-8'))
+            self.assertEqual(manifest['RepoTags'], [ 'squashed:latest' ])
+            self.assertEqual(manifest['Config'], image_id.split(':')[1] + '.json')
+            config = members.pop(manifest['Config'])
+            self.assertEqual(image_id, 'sha256:' + sha256(config).hexdigest())
+            layer_name, = manifest['Layers']
+            layer = members.pop(layer_name)
+            self.assertEqual(members, {})
+            self.assertEqual(layer, expected_file.getvalue(), msg=image_spec)
+            self.assertEqual(json_loads(config.decode('utf-8'))['rootfs']['diff_ids'], [ 'sha256:' + sha256(layer).hexdigest() ])
+
+        # A failed load shouldn't leave the producer waiting forever
+        load_dc = FauxDockerClient(IOError('no space left on device'))
+
+        with self.assertRaises(IOError):
+            loadlayers(self._dc, layers, load_dc=load_dc)
+
     def test_normalizeimage(self):
         images = [
             {
@@ -243,6 +1018,38 @@ class DimgxTestCase(TestCase):
         self.assertIs(normalizeimage(image), image)
         self.assertIs(denormalizeimage(image), image)
 
+    def test_normalizecreated(self):
+        from dateutil.parser import parse as dateutil_parse
+
+        specs = (
+            ( '2015-05-01T12:34:56Z', datetime(2015, 5, 1, 12, 34, 56, 0, TZ_UTC) ),
+            ( '2015-05-01T12:34:56.5Z', datetime(2015, 5, 1, 12, 34, 56, 500000, TZ_UTC) ),
+            ( '2015-05-01T12:34:56.123456789Z', datetime(2015, 5, 1, 12, 34, 56, 123456, TZ_UTC) ),
+            ( '2015-05-01t12:34:56.9999999z', datetime(2015, 5, 1, 12, 34, 56, 999999, TZ_UTC) ),
+            ( '2015-05-01T12:34:56.25+02:00', datetime(2015, 5, 1, 10, 34, 56, 250000, TZ_UTC) ),
+            ( '2015-05-01 12:34:56-0130', datetime(2015, 5, 1, 14, 4, 56, 0, TZ_UTC) ),
+            ( 'May 1 2015 12:34:56 UTC', datetime(2015, 5, 1, 12, 34, 56, 0, TZ_UTC) ),  # dateutil
+        )
+
+        for created, expected in specs:
+            created_dt = normalizeimage({ 'Created': created, 'Id': '0' * 64 })[':created_dt']
+            self.assertEqual(created_dt, expected, msg=created)
+            self.assertEqual(created_dt.utcoffset(), timedelta(0), msg=created)
+            self.assertEqual(created_dt, dateutil_parse(created), msg=created)
+
+    def test_normalizeimages(self):
+        images = self._dc.images(all=True)
+        normalized_images = normalizeimages(images, copy=True)
+        self.assertEqual(len(normalized_images), len(images))
+
+        for image, normalized_image in zip(images, normalized_images):
+            self.assertIsNot(normalized_image, image)
+            self.assertNotIn(':id', image)
+            self.assertEqual(normalized_image, normalizeimage(image, copy=True))
+
+        self.assertEqual(normalizeimages([]), [])
+        self.assertIs(normalizeimages(images)[0], images[0])
+
     # --- Protected methods ----------------------------------------------
 
     def _check_specs(self, specs):
@@ -274,11 +1081,30 @@ class DimgxTestCase(TestCase):
             for k, v in iteritems(hashes_to_indexes):
                 print('# {} -> {}'.format(k, v), file=dump_py_file)
 
-    def _get_hash_tar(self, image_id, indexes, top_most_layer):
+    def _get_tree(self, image_id):
+        # Returns the flattened tree of image_id as a dict of names to
+        # ( type, size, mode, uid, gid, mtime, linkname, digest ) tuples
+        target_file = BytesIO()
+
+        with TarFile(mode='w', fileobj=target_file) as tar_file:
+            extractlayers(self._dc, inspectlayers(self._dc, image_id)[':layers'], tar_file)
+
+        target_file.seek(0)
+        tree = {}
+
+        with TarFile(mode='r', fileobj=target_file) as tar_file:
+            for info in tar_file:
+                content = tar_file.extractfile(info).read() if info.isreg() else b''
+                entry_type = 'file' if info.isreg() else 'dir' if info.isdir() else info.type
+                tree[info.name] = ( entry_type, info.size, info.mode, info.uid, info.gid, info.mtime, info.linkname, sha256(content).hexdigest() if info.isreg() else None )
+
+        return tree
+
+    def _get_hash_tar(self, image_id, indexes, top_most_layer, layers=None):
         target_file = HashedBytesIo()
 
         with TarFile(mode='w', fileobj=target_file) as tar_file:
-            layers_dict = inspectlayers(self._dc, image_id)
+            layers_dict = { ':layers': layers } if layers is not None else inspectlayers(self._dc, image_id)
 
             if isinstance(indexes, slice):
                 layers = layers_dict[':layers'][indexes]
@@ -0,0 +1,611 @@
+# -*- encoding: utf-8; mode: python; grammar-ext: py -*-
+
+# ========================================================================
+"""
+Copyright and other protections apply. Please see the accompanying
+:doc:`LICENSE <LICENSE>` and :doc:`CREDITS <CREDITS>` file(s) for rights
+and restrictions governing use of this software. All rights not expressly
+waived or licensed are reserved. If those files are missing or appear to
+be modified from their originals, then please contact the author before
+viewing or using this software in any capacity.
+"""
+# ========================================================================
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals,
+)
+from builtins import *  # noqa: F401,F403; pylint: disable=redefined-builtin,unused-wildcard-import,useless-suppression,wildcard-import
+from future.builtins.disabled import *  # noqa: F401,F403; pylint: disable=redefined-builtin,unused-wildcard-import,useless-suppression,wildcard-import
+
+# ---- Imports -----------------------------------------------------------
+
+from gzip import GzipFile
+from hashlib import sha256
+from io import BytesIO
+from json import dumps as json_dumps
+from os import (
+    link,
+    listdir,
+    lstat,
+    makedirs,
+    mknod,
+)
+from os.path import (
+    dirname,
+    join as ospath_join,
+)
+from stat import S_IFCHR
+from shutil import (
+    copyfileobj,
+    rmtree,
+)
+from tarfile import (
+    SYMTYPE,
+    TarFile,
+    TarInfo,
+    open as tarfile_open,
+)
+from tempfile import mkdtemp
+from threading import (
+    Event,
+    Thread,
+)
+from time import time
+from unittest import TestCase
+from _dimgx.sources import (
+    DirectoryLayerReader,
+    LayerSpool,
+)
+from _dimgx.targets import sparsemember
+from dimgx import (
+    GraphDriverClient,
+    LayerDigestMismatch,
+    PrefetchingClient,
+    SavedImageClient,
+    SpoolLimitExceeded,
+    extractlayers,
+    inspectlayers,
+)
+from test import HashedBytesIo
+from test.fauxdockerclient import (
+    FauxDockerClient,
+    FlakyFauxDockerClient,
+)
+
+# ---- Constants ---------------------------------------------------------
+
+__all__ = ()
+
+# ---- Classes -----------------------------------------------------------
+
+# ========================================================================
+class SourcesTestCase(TestCase):
+
+    # ---- Public hooks --------------------------------------------------
+
+    def setUp(self):
+        super().setUp()
+        self.longMessage = True
+        self.maxDiff = None
+        self._dc = FauxDockerClient()
+        self._tmp_dir = mkdtemp()
+
+    def tearDown(self):
+        super().tearDown()
+        rmtree(self._tmp_dir, ignore_errors=True)
+
+    def test_graphdriver_aufs(self):
+        root = self._makegraph('aufs', {
+            '.wh..wh.plnk': None,
+            'etc/.wh.b.txt': b'',
+            'opt/x/.wh..wh..opq': b'',
+        })
+        self._checkgraph(root, 'aufs')
+
+    def test_graphdriver_filter(self):
+        # Removing opt/xy must not hide opt/x's contents
+        root = self._makegraph('aufs', { 'etc/.wh.b.txt': b'', 'opt/.wh.xy': b'' })
+
+        with GraphDriverClient(root, 'aufs') as dc:
+            layers = inspectlayers(dc, 'fab:latest')[':layers']
+
+            for include, exclude, expected_names in (
+                    ( None, None, [ 'etc', 'etc/a.txt', 'etc/a2', 'etc/c.txt', 'opt', 'opt/x', 'opt/x/1', 'opt/x/2', 'opt/x/3' ] ),
+                    ( [ 'opt/x/[12]' ], [ '**/2' ], [ 'opt', 'opt/x', 'opt/x/1' ] ),
+                    ( [ '/etc/' ], [ 'etc/a*' ], [ 'etc', 'etc/c.txt' ] ),
+                    ( None, [ 'opt' ], [ 'etc', 'etc/a.txt', 'etc/a2', 'etc/c.txt' ] ),
+            ):
+                target_file = BytesIO()
+
+                with TarFile(mode='w', fileobj=target_file) as tar_file:
+                    extractlayers(dc, layers, tar_file, include=include, exclude=exclude)
+
+                target_file.seek(0)
+
+                with TarFile(mode='r', fileobj=target_file) as tar_file:
+                    self.assertEqual(sorted(i.name for i in tar_file), expected_names, msg='include: {}; exclude: {}'.format(include, exclude))
+
+        with DirectoryLayerReader(ospath_join(root, 'aufs', 'diff', 'cache0'), 'cache0', 'aufs') as layer_reader:
+            pruned = []
+            layer_reader.prune = lambda name: pruned.append(name) or name == 'opt'
+            self.assertEqual([ i.name for i in layer_reader ], [ 'etc', 'etc/a.txt', 'etc/a2', 'etc/b.txt', 'opt' ])
+            self.assertEqual(pruned, [ 'etc', 'opt' ])
+
+        # Files from extractfile are independent of one another
+        with DirectoryLayerReader(ospath_join(root, 'aufs', 'diff', 'cache0'), 'cache0', 'aufs') as layer_reader:
+            infos = dict(( i.name, i ) for i in layer_reader)
+            a_file = layer_reader.extractfile(infos['etc/a.txt'])
+            b_file = layer_reader.extractfile(infos['etc/b.txt'])
+            self.assertEqual(( a_file.read(), b_file.read() ), ( b'a', b'b' ))
+
+        self.assertTrue(a_file.closed)
+        self.assertTrue(b_file.closed)
+
+    def test_graphdriver_sparse(self):
+        layer_dir = ospath_join(self._tmp_dir, 'sparse')
+        makedirs(layer_dir)
+        path = ospath_join(layer_dir, 'db.img')
+        size = 1 << 22
+
+        with open(path, 'wb') as f:
+            f.write(b'head')
+            f.seek(size >> 1)
+            f.write(b'tail')
+            f.truncate(size)
+
+        if lstat(path).st_blocks * 512 >= size:
+            self.skipTest('unable to create sparse files here')
+
+        with DirectoryLayerReader(layer_dir, 'sparse') as layer_reader:
+            info, = list(layer_reader)
+            self.assertEqual(info.size, size)
+            self.assertIsNotNone(info.sparse)
+            self.assertLess(sum(length for _, length in info.sparse), size)
+            self.assertEqual([ offset for offset, _ in info.sparse ], [ 0, size >> 1 ])
+
+            with open(path, 'rb') as f:
+                expected_data = f.read()
+
+            # Only the data segments are stored
+            target_file = BytesIO()
+
+            with TarFile(mode='w', fileobj=target_file) as tar_file:
+                tar_file.addfile(*sparsemember(info, layer_reader.extractfile(info)))
+
+        self.assertLess(len(target_file.getvalue()), 1 << 16)
+        target_file.seek(0)
+
+        with TarFile(mode='r', fileobj=target_file) as tar_file:
+            member, = list(tar_file)
+            self.assertEqual(( member.name, member.size ), ( 'db.img', size ))
+            self.assertEqual(tar_file.extractfile(member).read(), expected_data)
+
+    def test_graphdriver_overlay2(self):
+        root = self._makegraph('overlay2', {})
+        diff_dir = ospath_join(root, 'overlay2', 'cache1', 'diff')
+
+        try:
+            mknod(ospath_join(diff_dir, 'etc', 'b.txt'), S_IFCHR | 0o600, 0)
+        except (AttributeError, EnvironmentError):
+            self.skipTest('unable to create overlay whiteouts (character devices) here')
+
+        try:
+            from os import setxattr
+        except ImportError:
+            self.skipTest('extended attributes not supported')
+
+        for xattr in ( 'trusted.overlay.opaque', 'user.overlay.opaque' ):
+            try:
+                setxattr(ospath_join(diff_dir, 'opt', 'x'), xattr, b'y')
+            except EnvironmentError:
+                continue
+            else:
+                break
+        else:
+            self.skipTest('unable to mark overlay directories opaque here')
+
+        self._checkgraph(root, 'overlay2')
+        self._checkgraph(root, None)
+
+    def test_prefetch(self):
+        layers = inspectlayers(self._dc, 'greatest:hits')[':layers']
+        expected_file = BytesIO()
+
+        with TarFile(mode='w', fileobj=expected_file) as tar_file:
+            extractlayers(self._dc, layers, tar_file)
+
+        with PrefetchingClient(self._dc, 'greatest:hits') as dc:
+            self.assertEqual([ l[':id'] for l in inspectlayers(dc, 'greatest:hits')[':layers'] ], [ l[':id'] for l in layers ])
+            target_file = BytesIO()
+
+            with TarFile(mode='w', fileobj=target_file) as tar_file:
+                extractlayers(dc, layers, tar_file)
+
+        self.assertEqual(target_file.getvalue(), expected_file.getvalue())
+
+        # Failures are raised where the layers are needed
+        with PrefetchingClient(FlakyFauxDockerClient(1024), 'greatest:hits') as dc:
+            with self.assertRaises(IOError):
+                dc.openlayer(layers[0][':id'])
+
+        # Closing doesn't wait (long) on a stalled retrieval
+        release = Event()
+        stalled_dc = FauxDockerClient()
+        get_image = stalled_dc.get_image
+
+        def _getimage(image):
+            release.wait()
+
+            return get_image(image)
+
+        stalled_dc.get_image = _getimage
+
+        try:
+            started = time()
+
+            with PrefetchingClient(stalled_dc, 'greatest:hits', abandon_timeout=0.1):
+                pass
+
+            self.assertLess(time() - started, 5)
+        finally:
+            release.set()
+
+    def test_savedimage(self):
+        for image_spec in ( 'getto:dachoppa', 'greatest:hits' ):
+            expected_ids = [ l[':id'] for l in inspectlayers(self._dc, image_spec)[':layers'] ]
+            expected_hexdigest = self._hexdigest(self._dc, image_spec)
+            archive_path = ospath_join(self._tmp_dir, 'saved.tar')
+
+            with open(archive_path, 'wb') as archive_file:
+                copyfileobj(self._dc.get_image(image_spec), archive_file)
+
+            gz_archive_path = ospath_join(self._tmp_dir, 'saved.tar.gz')
+
+            with GzipFile(gz_archive_path, 'wb') as gz_archive_file:
+                copyfileobj(self._dc.get_image(image_spec), gz_archive_file)
+
+            for path in ( archive_path, gz_archive_path ):
+                with SavedImageClient(path) as dc:
+                    self.assertEqual(len(dc.images(all=True)), len(expected_ids), msg=path)
+                    self.assertEqual(len(dc.images()), 1, msg=path)
+                    self.assertEqual(sorted(dc.images(all=True, quiet=True)), sorted(expected_ids), msg=path)
+                    self.assertEqual(dc.images(quiet=True, filters={ 'dangling': True }), [], msg=path)
+                    self.assertEqual(len(dc.images(all=True, filters={ 'dangling': True })), len(expected_ids) - 1, msg=path)
+                    self.assertEqual(dc.images(quiet=True, filters={ 'dangling': 'false' }), [ expected_ids[0] ], msg=path)
+
+                    with self.assertRaises(ValueError):
+                        dc.images(filters={ 'label': 'nifty' })
+
+                    self.assertEqual([ l[':id'] for l in inspectlayers(dc, image_spec)[':layers'] ], expected_ids, msg=path)
+                    self.assertEqual(self._hexdigest(dc, image_spec), expected_hexdigest, msg=path)
+
+        # Concurrent readers of a compressed archive share a single spool
+        spool_dir = mkdtemp(dir=self._tmp_dir)
+
+        with SavedImageClient(gz_archive_path, { 'spool_dir': spool_dir }) as dc:
+            threads = [ Thread(target=dc.openlayer, args=( expected_ids[0], )) for _ in range(4) ]
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(len(listdir(spool_dir)), 1)
+
+        self.assertEqual(listdir(spool_dir), [])
+
+    def test_spoolverify(self):
+        for corrupt in ( False, True ):
+            image_file = self._dc.get_image('greatest:hits')
+            modern_file = BytesIO()
+            layer_names = []
+            diff_ids = []
+
+            with tarfile_open(mode='r', fileobj=image_file) as image_tar_file, \
+                    TarFile(mode='w', fileobj=modern_file) as modern_tar_file:
+                for info in image_tar_file:
+                    content = image_tar_file.extractfile(info).read() if info.isreg() else None
+
+                    if info.name.endswith('/layer.tar'):
+                        layer_names.append(info.name)
+                        diff_ids.append('sha256:' + sha256(content).hexdigest())
+
+                    modern_tar_file.addfile(info, BytesIO(content) if content is not None else None)
+
+                if corrupt:
+                    diff_ids[-1] = 'sha256:' + '0' * 64
+
+                # Exports list layers from the top down; configurations and
+                # manifests from the root up (and after the layers)
+                config = json_dumps({ 'rootfs': { 'type': 'layers', 'diff_ids': diff_ids[::-1] } }).encode('utf-8')
+                config_name = sha256(config).hexdigest() + '.json'
+                manifest = json_dumps([ { 'Config': config_name, 'Layers': layer_names[::-1] } ]).encode('utf-8')
+
+                for name, content in ( ( config_name, config ), ( 'manifest.json', manifest ) ):
+                    info = TarInfo(name)
+                    info.size = len(content)
+                    modern_tar_file.addfile(info, BytesIO(content))
+
+            modern_file.seek(0)
+
+            with LayerSpool(verify=True) as spool:
+                if corrupt:
+                    with self.assertRaises(LayerDigestMismatch):
+                        spool.addstream(modern_file, 'greatest:hits')
+                else:
+                    spool.addstream(modern_file, 'greatest:hits')
+                    self.assertEqual(sorted(spool.layer_digests.values()), sorted(diff_ids))
+
+            # Saved archives are verified as their layers are opened
+            archive_path = ospath_join(self._tmp_dir, 'modern.tar')
+            gz_archive_path = ospath_join(self._tmp_dir, 'modern.tar.gz')
+
+            with open(archive_path, 'wb') as archive_file:
+                archive_file.write(modern_file.getvalue())
+
+            with GzipFile(gz_archive_path, 'wb') as gz_archive_file:
+                gz_archive_file.write(modern_file.getvalue())
+
+            for path in ( archive_path, gz_archive_path ):
+                with SavedImageClient(path, verify=True) as dc:
+                    corrupt_id = layer_names[-1].split('/')[0]
+
+                    if corrupt:
+                        with self.assertRaises(LayerDigestMismatch, msg=path):
+                            dc.openlayer(corrupt_id).close()
+                    else:
+                        for layer_name in layer_names:
+                            dc.openlayer(layer_name.split('/')[0]).close()
+
+    def test_spoolaliases(self):
+        # Newer versions of Docker replace duplicate layers with links
+        image_file = self._dc.get_image('getto:dachoppa')
+        layer_ids = FauxDockerClient.SHORT_IDS_BY_PATH[0]
+        aliased_file = BytesIO()
+
+        with tarfile_open(mode='r', fileobj=image_file) as image_tar_file, \
+                TarFile(mode='w', fileobj=aliased_file) as aliased_tar_file:
+            for info in image_tar_file:
+                if info.name.startswith(layer_ids[1]) and info.name.endswith('/layer.tar'):
+                    target_info = info
+                    continue
+
+                aliased_tar_file.addfile(info, image_tar_file.extractfile(info) if info.isreg() else None)
+
+            alias_info = TarInfo(target_info.name)
+            alias_info.type = SYMTYPE
+            alias_info.linkname = '../{}/layer.tar'.format(inspectlayers(self._dc, layer_ids[0])[':layers'][0][':id'])
+            aliased_tar_file.addfile(alias_info)
+
+        aliased_file.seek(0)
+
+        with LayerSpool() as spool:
+            spool.addstream(aliased_file, 'aliased')
+
+            with spool.openlayer(target_info.name.split('/')[0]) as aliased_reader, \
+                    spool.openlayer(alias_info.linkname.split('/')[1]) as target_reader:
+                self.assertEqual([ i.name for i in aliased_reader ], [ i.name for i in target_reader ])
+
+    def test_spoolresume(self):
+        layer_ids = [ l[':id'] for l in inspectlayers(self._dc, 'greatest:hits')[':layers'] ]
+        stream_size = len(self._dc.get_image('greatest:hits').read())
+        dc = FlakyFauxDockerClient(stream_size // 2)
+        spool_dir = ospath_join(self._tmp_dir, 'spool')
+
+        with LayerSpool(spool_dir=spool_dir, persist=True) as spool:
+            with self.assertRaises(IOError):
+                spool.addimage(dc, 'greatest:hits', layer_ids)
+
+            held_ids = set(spool.layer_ids)
+
+        self.assertTrue(held_ids)
+        self.assertLess(len(held_ids), len(layer_ids))
+        stats = dict(( layer_id, lstat(ospath_join(spool_dir, layer_id, 'layer.tar')) ) for layer_id in held_ids)
+
+        # A later spool resumes with the completed layers (without writing
+        # them again)
+        with LayerSpool(spool_dir=spool_dir, persist=True) as spool:
+            self.assertEqual(spool.layer_ids, held_ids)
+            spool.addimage(dc, 'greatest:hits', layer_ids)
+            self.assertEqual(spool.layer_ids, set(layer_ids))
+
+            for layer_id, st in stats.items():
+                new_st = lstat(ospath_join(spool_dir, layer_id, 'layer.tar'))
+                self.assertEqual(( new_st.st_ino, new_st.st_mtime ), ( st.st_ino, st.st_mtime ), msg=layer_id)
+
+        # Once everything is held, nothing is retrieved
+        with LayerSpool(spool_dir=spool_dir, persist=True) as spool, \
+                LayerSpool() as expected_spool:
+            spool.addimage(dc, 'greatest:hits', layer_ids)
+            expected_spool.addimage(self._dc, 'greatest:hits')
+
+            for layer_id in layer_ids:
+                with spool.openlayer(layer_id) as layer_reader, \
+                        expected_spool.openlayer(layer_id) as expected_reader:
+                    self.assertEqual([ i.name for i in layer_reader ], [ i.name for i in expected_reader ], msg=layer_id)
+
+        self.assertEqual(dc.retrieved, [ 'greatest:hits' ] * 2)
+
+        # When verifying, resumed layers are hashed again (dropping any
+        # that changed), and ones never checked against the image's
+        # configuration mean retrieving it again
+        verify_dir = ospath_join(self._tmp_dir, 'verified-spool')
+
+        with LayerSpool(verify=True, spool_dir=verify_dir, persist=True) as spool:
+            spool.addimage(self._dc, 'greatest:hits', layer_ids)
+            digests = dict(spool.layer_digests)
+
+        with open(ospath_join(verify_dir, layer_ids[0], 'layer.tar'), 'r+b') as tampered_file:
+            data = tampered_file.read()
+            tampered_file.seek(0)
+            tampered_file.write(data[:-1] + ( b'\1' if data[-1:] == b'\0' else b'\0' ))
+
+        dc = FlakyFauxDockerClient(0, num_failures=0)
+
+        with LayerSpool(verify=True, spool_dir=verify_dir, persist=True) as spool:
+            self.assertEqual(spool.layer_ids, set(layer_ids[1:]))
+            spool.addimage(dc, 'greatest:hits', layer_ids)
+            self.assertEqual(spool.layer_digests, digests)
+
+        self.assertEqual(dc.retrieved, [ 'greatest:hits' ])
+
+        # With retries, a spool carries on from where the stream was cut off
+        for retries in ( 0, 1 ):
+            dc = FlakyFauxDockerClient(stream_size // 2)
+
+            with LayerSpool(retries=retries) as spool:
+                if retries:
+                    spool.addimage(dc, 'greatest:hits', layer_ids)
+                    self.assertEqual(spool.layer_ids, set(layer_ids))
+                else:
+                    with self.assertRaises(IOError):
+                        spool.addimage(dc, 'greatest:hits', layer_ids)
+
+            self.assertEqual(len(dc.retrieved), retries + 1)
+
+    def test_spooltiers(self):
+        layer_ids = [ l[':id'] for l in inspectlayers(self._dc, 'greatest:hits')[':layers'] ]
+
+        with LayerSpool() as spool:
+            spool.addimage(self._dc, 'greatest:hits')
+            expected = {}
+
+            for layer_id in layer_ids:
+                with spool.openlayer(layer_id) as layer_reader:
+                    expected[layer_id] = [ i.name for i in layer_reader ]
+
+        total_size = spool.spooled_size
+        self.assertEqual(spool.memory_size, 0)
+
+        # Whatever fits goes in memory, and the rest goes to spool_dir
+        for memory_limit in ( 0, total_size // 2, total_size ):
+            spool_dir = mkdtemp(dir=self._tmp_dir)
+
+            with LayerSpool(spool_dir=spool_dir, memory_limit=memory_limit, size_limit=total_size) as spool:
+                spool.addimage(self._dc, 'greatest:hits')
+                self.assertEqual(spool.spooled_size, total_size, msg=memory_limit)
+                self.assertLessEqual(spool.memory_size, memory_limit, msg=memory_limit)
+                self.assertEqual(len(listdir(spool_dir)), 1, msg=memory_limit)
+                num_spooled = len(listdir(ospath_join(spool_dir, listdir(spool_dir)[0])))
+                self.assertEqual(num_spooled == len(layer_ids), spool.memory_size == 0, msg=memory_limit)
+                self.assertEqual(num_spooled == 0, spool.memory_size == total_size, msg=memory_limit)
+
+                for layer_id in layer_ids:
+                    with spool.openlayer(layer_id) as layer_reader:
+                        self.assertEqual([ i.name for i in layer_reader ], expected[layer_id], msg=memory_limit)
+
+            self.assertEqual(listdir(spool_dir), [], msg=memory_limit)
+
+        # Nothing is written for a layer that would exceed size_limit
+        with LayerSpool(memory_limit=total_size, size_limit=total_size - 1) as spool:
+            with self.assertRaises(SpoolLimitExceeded):
+                spool.addimage(self._dc, 'greatest:hits')
+
+            self.assertLess(spool.spooled_size, total_size)
+            self.assertEqual(spool.memory_size, spool.spooled_size)
+
+    # ---- Protected methods ---------------------------------------------
+
+    def _checkgraph(self, root, driver):
+        with GraphDriverClient(root, driver) as dc:
+            self.assertEqual(dc.driver, 'aufs' if driver == 'aufs' else 'overlay2')
+            layers = inspectlayers(dc, 'fab:latest')[':layers']
+            self.assertEqual(len(layers), 2)
+            self.assertIn('fab:latest', layers[0][':repo_tags'])
+            self.assertEqual(layers[0][':parent_id'], layers[1][':id'])
+            self.assertEqual(layers[0]['Size'], 20)
+            self.assertEqual(layers[0]['VirtualSize'], 30)
+
+            target_file = BytesIO()
+
+            with TarFile(mode='w', fileobj=target_file) as tar_file:
+                extractlayers(dc, layers, tar_file)
+
+        target_file.seek(0)
+
+        with TarFile(mode='r', fileobj=target_file) as tar_file:
+            infos = dict(( i.name, i ) for i in tar_file)
+            self.assertEqual(sorted(infos), [ 'etc', 'etc/a.txt', 'etc/a2', 'etc/c.txt', 'opt', 'opt/x', 'opt/x/3' ])
+            self.assertTrue(infos['etc/a2'].islnk())
+            self.assertEqual(infos['etc/a2'].linkname, 'etc/a.txt')
+            self.assertEqual(tar_file.extractfile(infos['etc/c.txt']).read(), b'c')
+            self.assertEqual(tar_file.extractfile(infos['etc/a.txt']).read(), b'a')
+
+    def _makegraph(self, driver, top_extras):
+        # Fabricates a Docker root directory containing a two-layer image
+        # ("fab:latest"), where the top layer removes etc/b.txt and makes
+        # opt/x opaque (which is up to the caller via top_extras if driver
+        # is "overlay2")
+        root = ospath_join(self._tmp_dir, 'docker')
+        image_root = ospath_join(root, 'image', driver)
+        diffs = (
+            {
+                'etc/a.txt': b'a',
+                'etc/b.txt': b'b',
+                'opt/x/1': b'1',
+                'opt/x/2': b'2',
+            }, dict({
+                'etc/c.txt': b'c',
+                'opt/x/3': b'3',
+            }, **top_extras),
+        )
+        diff_ids = []
+        chain_id = None
+
+        for i, diff in enumerate(diffs):
+            cache_id = 'cache{}'.format(i)
+            diff_dir = ospath_join(root, 'aufs', 'diff', cache_id) if driver == 'aufs' else ospath_join(root, driver, cache_id, 'diff')
+            makedirs(ospath_join(diff_dir, 'etc'))
+            makedirs(ospath_join(diff_dir, 'opt', 'x'))
+
+            for name, content in diff.items():
+                path = ospath_join(diff_dir, name)
+
+                if content is None:
+                    makedirs(path)
+                else:
+                    with open(path, 'wb') as f:
+                        f.write(content)
+
+            if i == 0:
+                link(ospath_join(diff_dir, 'etc', 'a.txt'), ospath_join(diff_dir, 'etc', 'a2'))
+
+            diff_id = 'sha256:' + sha256(cache_id.encode('utf-8')).hexdigest()
+            parent_id = chain_id
+            chain_id = diff_id if chain_id is None else 'sha256:' + sha256('{} {}'.format(chain_id, diff_id).encode('utf-8')).hexdigest()
+            diff_ids.append(diff_id)
+            layer_dir = ospath_join(image_root, 'layerdb', 'sha256', chain_id.split(':')[1])
+            makedirs(layer_dir)
+
+            for name, content in ( ( 'cache-id', cache_id ), ( 'diff', diff_id ), ( 'parent', parent_id ), ( 'size', str(10 * (i + 1)) ) ):
+                if content is not None:
+                    with open(ospath_join(layer_dir, name), 'wb') as f:
+                        f.write(content.encode('utf-8'))
+
+        config = json_dumps({ 'created': '2015-09-08T21:01:23.456789012Z', 'rootfs': { 'type': 'layers', 'diff_ids': diff_ids } }).encode('utf-8')
+        image_id = sha256(config).hexdigest()
+        config_path = ospath_join(image_root, 'imagedb', 'content', 'sha256', image_id)
+        makedirs(dirname(config_path))
+
+        with open(config_path, 'wb') as f:
+            f.write(config)
+
+        with open(ospath_join(image_root, 'repositories.json'), 'wb') as f:
+            f.write(json_dumps({ 'Repositories': { 'fab': { 'fab:latest': 'sha256:' + image_id, 'fab@sha256:' + '0' * 64: 'sha256:' + image_id } } }).encode('utf-8'))
+
+        return root
+
+    def _hexdigest(self, dc, image_spec):
+        target_file = HashedBytesIo()
+
+        with TarFile(mode='w', fileobj=target_file) as tar_file:
+            extractlayers(dc, inspectlayers(dc, image_spec)[':layers'], tar_file)
+
+        return target_file.hash_obj.hexdigest()
+
+# ---- Initialization ----------------------------------------------------
+
+if __name__ == '__main__':
+    from unittest import main
+    main()
@@ -0,0 +1,397 @@
+# -*- encoding: utf-8; mode: python; grammar-ext: py -*-
+
+# ========================================================================
+"""
+Copyright and other protections apply. Please see the accompanying
+:doc:`LICENSE <LICENSE>` and :doc:`CREDITS <CREDITS>` file(s) for rights
+and restrictions governing use of this software. All rights not expressly
+waived or licensed are reserved. If those files are missing or appear to
+be modified from their originals, then please contact the author before
+viewing or using this software in any capacity.
+"""
+# ========================================================================
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals,
+)
+from builtins import *  # noqa: F401,F403; pylint: disable=redefined-builtin,unused-wildcard-import,useless-suppression,wildcard-import
+from future.builtins.disabled import *  # noqa: F401,F403; pylint: disable=redefined-builtin,unused-wildcard-import,useless-suppression,wildcard-import
+
+# ---- Imports -----------------------------------------------------------
+
+from gzip import GzipFile
+from hashlib import sha256
+from io import BytesIO
+from json import loads as json_loads
+from os import (
+    listdir,
+    lstat,
+    readlink,
+    symlink,
+    utime,
+    walk,
+)
+from os.path import (
+    join as ospath_join,
+    lexists,
+    relpath,
+)
+from shutil import rmtree
+from stat import (
+    S_IMODE,
+    S_ISLNK,
+    S_ISREG,
+)
+from tarfile import (
+    BLOCKSIZE,
+    DIRTYPE,
+    ENCODING,
+    LNKTYPE,
+    PAX_FORMAT,
+    SYMTYPE,
+    TarFile,
+    TarInfo,
+)
+from tempfile import mkdtemp
+from unittest import TestCase
+from dimgx import (
+    ArchiveCache,
+    ArchiveIndexer,
+    BlockGzipFile,
+    DigestingFile,
+    DirectoryWriter,
+    OciLayoutWriter,
+    UnsafeTarPath,
+    extractlayers,
+    inspectlayers,
+)
+from _dimgx.targets import sparsemember
+from test.fauxdockerclient import FauxDockerClient
+
+# ---- Constants ---------------------------------------------------------
+
+__all__ = ()
+
+# ---- Classes -----------------------------------------------------------
+
+# ========================================================================
+class TargetsTestCase(TestCase):
+
+    # ---- Public hooks --------------------------------------------------
+
+    def setUp(self):
+        super().setUp()
+        self.longMessage = True
+        self.maxDiff = None
+        self._dc = FauxDockerClient()
+        self._tmp_dir = mkdtemp()
+
+    def tearDown(self):
+        super().tearDown()
+        rmtree(self._tmp_dir, ignore_errors=True)
+
+    def test_directorywriter(self):
+        for image_spec in ( 'getto:dachoppa', 'greatest:hits' ):
+            layers = inspectlayers(self._dc, image_spec)[':layers']
+            tar_path = ospath_join(self._tmp_dir, image_spec, 'from-tar')
+            dir_path = ospath_join(self._tmp_dir, image_spec, 'direct')
+            target_file = BytesIO()
+
+            with TarFile(mode='w', fileobj=target_file) as tar_file:
+                extractlayers(self._dc, layers, tar_file)
+
+            target_file.seek(0)
+
+            with TarFile(mode='r', fileobj=target_file) as tar_file:
+                tar_file.extractall(tar_path)
+
+            with DirectoryWriter(dir_path, num_workers=4, preserve_owner=False) as dir_writer:
+                extractlayers(self._dc, layers, dir_writer)
+
+            self.assertEqual(_snapshot(dir_path), _snapshot(tar_path), msg=image_spec)
+
+    def test_archivecache(self):
+        for link in ( False, True ):
+            cache_dir = ospath_join(self._tmp_dir, 'cache-{}'.format(link))
+            cache = ArchiveCache(cache_dir, max_size=250, link=link)
+            keys = [ cache.key([ 'a', 'b' ], compression=None), cache.key([ 'a', 'b' ], compression='gz'), cache.key([ 'b', 'a' ], compression=None) ]
+            self.assertEqual(len(set(keys)), 3)
+            self.assertEqual(cache.key([ 'a', 'b' ], compression=None), keys[0])
+            target_path = ospath_join(self._tmp_dir, 'target-{}'.format(link))
+            self.assertFalse(cache.fetch(keys[0], target_path))
+
+            archive_paths = []
+
+            for i, key in enumerate(keys):
+                archive_paths.append(ospath_join(self._tmp_dir, 'archive-{}-{}'.format(link, i)))
+
+                with open(archive_paths[i], 'wb') as archive_file:
+                    archive_file.write(bytes(bytearray([ i ])) * 100)
+
+            for i, key in enumerate(keys[:2]):
+                cache.store(key, archive_paths[i])
+                utime(ospath_join(cache_dir, key), ( 1000 * (i + 1), 1000 * (i + 1) ))
+
+            # Using the first makes the second the least recently used, so
+            # storing a third evicts it
+            self.assertTrue(cache.fetch(keys[0], target_path))
+            self.assertEqual(lstat(target_path).st_ino == lstat(ospath_join(cache_dir, keys[0])).st_ino, link)
+            cache.store(keys[2], archive_paths[2])
+            self.assertEqual(sorted(listdir(cache_dir)), sorted(( keys[0], keys[2] )))
+
+            with open(target_path, 'rb') as target_file:
+                self.assertEqual(target_file.read(), b'\0' * 100)
+
+    def test_archiveindexer(self):
+        layers = inspectlayers(self._dc, 'greatest:hits')[':layers']
+        expected_file = BytesIO()
+
+        with TarFile(mode='w', fileobj=expected_file) as tar_file:
+            extractlayers(self._dc, layers, tar_file)
+
+        expected_file.seek(0)
+
+        with TarFile(mode='r', fileobj=expected_file) as tar_file:
+            expected = dict(( i.name, ( i.type, tar_file.extractfile(i).read() if i.isreg() else None ) ) for i in tar_file)
+
+        for block_size in ( None, BLOCKSIZE, 3 * BLOCKSIZE + 1, 1 << 20 ):
+            msg = 'block_size: {}'.format(block_size)
+            target_file = BytesIO()
+            block_file = None if block_size is None else BlockGzipFile(target_file, block_size, compresslevel=1)
+
+            with TarFile(mode='w', fileobj=target_file if block_file is None else block_file) as tar_file:
+                indexer = ArchiveIndexer(tar_file)
+                extractlayers(self._dc, layers, indexer)
+
+            if block_file is not None:
+                block_file.close()
+
+                # It's still an ordinary gzip stream
+                with TarFile(mode='r', fileobj=GzipFile(mode='rb', fileobj=BytesIO(target_file.getvalue()))) as tar_file:
+                    self.assertEqual(tar_file.getnames(), [ name for name, _, _, _, _ in indexer.members ], msg=msg)
+
+            index_file = BytesIO()
+            indexer.writeindex(index_file, None if block_file is None else block_file.blocks)
+            index = json_loads(index_file.getvalue().decode('utf-8'))
+            self.assertEqual(sorted(name for name, _, _, _, _ in index['members']), sorted(expected), msg=msg)
+
+            # Read each member (in reverse, to be sure nothing depends on
+            # having read what came before) via the index alone
+            for name, header_offset, data_offset, size, entry_type in reversed(index['members']):
+                header = _readindexed(target_file.getvalue(), index.get('blocks'), header_offset, BLOCKSIZE)
+                info = TarInfo.frombuf(header, ENCODING, 'surrogateescape')
+                self.assertEqual(info.name.rstrip('/'), name, msg=msg)
+                self.assertEqual(entry_type.encode('ascii'), expected[name][0], msg=msg)
+
+                if expected[name][1] is not None:
+                    self.assertEqual(_readindexed(target_file.getvalue(), index.get('blocks'), data_offset, size), expected[name][1], msg=msg)
+
+    def test_digestingfile(self):
+        layers = inspectlayers(self._dc, 'greatest:hits')[':layers']
+        target_file = BytesIO()
+        digesting_file = DigestingFile(target_file)
+
+        with TarFile(mode='w', fileobj=digesting_file) as tar_file:
+            extractlayers(self._dc, layers, tar_file, verify=True)
+
+        self.assertEqual(digesting_file.digest, 'sha256:' + sha256(target_file.getvalue()).hexdigest())
+
+    def test_links(self):
+        dir_path = ospath_join(self._tmp_dir, 'links')
+        entries = (
+            ( 'usr/bin/b', SYMTYPE, 'a' ),  # before its target and parent
+            ( 'usr/bin/c', LNKTYPE, 'usr/bin/a' ),  # before its target
+            ( 'usr/bin/a', None, b'#!/bin/sh\n' ),
+            ( 'usr/bin', DIRTYPE, None ),
+            ( 'usr', DIRTYPE, None ),
+        )
+
+        with DirectoryWriter(dir_path, num_workers=2, preserve_owner=False) as dir_writer:
+            for name, entry_type, data in entries:
+                info = TarInfo(name)
+                info.mtime = 1431216000
+                info.mode = 0o555 if entry_type == DIRTYPE else 0o755
+
+                if entry_type is None:
+                    info.size = len(data)
+                    dir_writer.addfile(info, BytesIO(data))
+                else:
+                    info.type = entry_type
+
+                    if data is not None:
+                        info.linkname = data
+
+                    dir_writer.addfile(info)
+
+        snapshot = _snapshot(dir_path)
+        self.assertEqual(snapshot['usr/bin/b'], ( 'link', 'a' ))
+        self.assertEqual(snapshot['usr/bin/c'], ( 0o755, 1431216000, b'#!/bin/sh\n' ))
+        self.assertEqual(snapshot['usr/bin'], ( 0o555, 1431216000 ))
+        self.assertEqual(lstat(ospath_join(dir_path, 'usr', 'bin', 'a')).st_ino, lstat(ospath_join(dir_path, 'usr', 'bin', 'c')).st_ino)
+
+    def test_ocilayout(self):
+        oci_path = ospath_join(self._tmp_dir, 'oci')
+
+        for image_spec in ( 'getto:dachoppa', 'greatest:hits', 'greatest:hits' ):
+            layers = inspectlayers(self._dc, image_spec)[':layers']
+            target_file = BytesIO()
+
+            with TarFile(mode='w', fileobj=target_file) as tar_file:
+                extractlayers(self._dc, layers, tar_file)
+
+            with OciLayoutWriter(oci_path, image_spec, { 'config': { 'Cmd': [ '/bin/sh' ] } }) as oci_writer:
+                extractlayers(self._dc, layers, oci_writer)
+
+            manifest = _readjson(oci_path, oci_writer.manifest_descriptor['digest'])
+            config = _readjson(oci_path, manifest['config']['digest'])
+            self.assertEqual(config['config'], { 'Cmd': [ '/bin/sh' ] })
+            self.assertEqual(config['os'], 'linux')
+            layer_descriptor, = manifest['layers']
+            blob = _readblob(oci_path, layer_descriptor['digest'])
+            self.assertEqual(layer_descriptor['size'], len(blob))
+            self.assertEqual(layer_descriptor['digest'], 'sha256:' + sha256(blob).hexdigest())
+            layer = GzipFile(mode='rb', fileobj=BytesIO(blob)).read()
+            self.assertEqual(config['rootfs']['diff_ids'], [ 'sha256:' + sha256(layer).hexdigest() ])
+            target_file.seek(0)
+
+            with TarFile(mode='r', fileobj=target_file) as expected_tar_file, \
+                    TarFile(mode='r', fileobj=BytesIO(layer)) as layer_tar_file:
+                self.assertEqual([ i.get_info() for i in layer_tar_file ], [ i.get_info() for i in expected_tar_file ], msg=image_spec)
+
+        with open(ospath_join(oci_path, 'index.json'), 'rb') as index_file:
+            index = json_loads(index_file.read().decode('utf-8'))
+
+        self.assertEqual(sorted(m['annotations']['org.opencontainers.image.ref.name'] for m in index['manifests']), [ 'getto:dachoppa', 'greatest:hits' ])
+        self.assertEqual([ name for name in listdir(ospath_join(oci_path, 'blobs', 'sha256')) if name.startswith('.') ], [])
+
+    def test_sparsemember(self):
+        data = b'head' + b'\0' * 8188 + b'tail' + b'\0' * 8188
+        info = TarInfo('var/lib/db.img')
+        info.mtime = 1431216000
+        info.size = len(data)
+        info.sparse = [ ( 0, 4 ), ( 8192, 4 ) ]
+        member_info, member_file = sparsemember(info, BytesIO(data))
+        self.assertEqual(member_info.name, 'var/lib/GNUSparseFile.0/db.img')
+        self.assertEqual(member_info.size, sparsemember(info)[0].size)
+        self.assertEqual(len(member_file.read()), member_info.size)
+        target_file = BytesIO()
+
+        with TarFile(mode='w', fileobj=target_file, format=PAX_FORMAT) as tar_file:
+            tar_file.addfile(*sparsemember(info, BytesIO(data)))
+
+        self.assertLess(len(target_file.getvalue()), len(data))
+        target_file.seek(0)
+
+        with TarFile(mode='r', fileobj=target_file) as tar_file:
+            member, = list(tar_file)
+            self.assertEqual(( member.name, member.size, member.mtime ), ( info.name, info.size, info.mtime ))
+            self.assertEqual(member.sparse, [ ( 0, BLOCKSIZE ), ( 8192, BLOCKSIZE ), ( 16384, 0 ) ])
+            self.assertEqual(tar_file.extractfile(member).read(), data)
+
+        # A directory gets the data segments, with holes in between
+        dir_path = ospath_join(self._tmp_dir, 'sparse')
+
+        with DirectoryWriter(dir_path, preserve_owner=False) as dir_writer:
+            dir_writer.addfile(info, BytesIO(data))
+
+        with open(ospath_join(dir_path, 'var', 'lib', 'db.img'), 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_unsafepaths(self):
+        for name in ( '../escape', '/etc/passwd', 'a/../../escape' ):
+            with DirectoryWriter(ospath_join(self._tmp_dir, 'unsafe'), num_workers=1) as dir_writer:
+                with self.assertRaises(UnsafeTarPath, msg=name):
+                    dir_writer.addfile(TarInfo(name), BytesIO())
+
+        # Neither an existing symlink nor one from an earlier entry can be
+        # used to write outside of the directory
+        outside_path = ospath_join(self._tmp_dir, 'outside')
+        secret_path = ospath_join(outside_path, 'secret')
+        dir_path = ospath_join(self._tmp_dir, 'symlinked')
+
+        with DirectoryWriter(outside_path, num_workers=1):
+            pass
+
+        with open(secret_path, 'wb') as secret_file:
+            secret_file.write(b'secret')
+
+        with DirectoryWriter(dir_path, num_workers=1) as dir_writer:
+            symlink(outside_path, ospath_join(dir_path, 'escape'))
+
+            with self.assertRaises(UnsafeTarPath):
+                dir_writer.addfile(TarInfo('escape/passwd'), BytesIO())
+
+        for linkname in ( 'escape/secret', 'sneaky/secret' ):
+            with self.assertRaises(UnsafeTarPath, msg=linkname):
+                with DirectoryWriter(dir_path, num_workers=1) as dir_writer:
+                    info = TarInfo('sneaky')
+                    info.type = SYMTYPE
+                    info.linkname = outside_path
+                    dir_writer.addfile(info)
+                    info = TarInfo('stolen')
+                    info.type = LNKTYPE
+                    info.linkname = linkname
+                    dir_writer.addfile(info)
+
+        self.assertFalse(lexists(ospath_join(dir_path, 'stolen')))
+
+        # A directory replaces the symlink rather than following it
+        with DirectoryWriter(dir_path, num_workers=1) as dir_writer:
+            info = TarInfo('escape')
+            info.type = DIRTYPE
+            info.mode = 0o700
+            dir_writer.addfile(info)
+
+        self.assertFalse(S_ISLNK(lstat(ospath_join(dir_path, 'escape')).st_mode))
+        self.assertEqual(listdir(outside_path), [ 'secret' ])
+        self.assertNotEqual(S_IMODE(lstat(outside_path).st_mode), 0o700)
+
+# ---- Functions ---------------------------------------------------------
+
+# ========================================================================
+def _readblob(oci_path, digest):
+    with open(ospath_join(oci_path, 'blobs', *digest.split(':')), 'rb') as blob_file:
+        return blob_file.read()
+
+# ========================================================================
+def _readindexed(archive, blocks, offset, size):
+    # Reads size bytes from offset in the (uncompressed) archive, starting
+    # with the block containing offset if it's compressed in blocks
+    if blocks is None:
+        return archive[offset:offset + size]
+
+    block_offset, compressed_offset = [ block for block in blocks if block[0] <= offset ][-1]
+    gzip_file = GzipFile(mode='rb', fileobj=BytesIO(archive[compressed_offset:]))
+    gzip_file.read(offset - block_offset)
+
+    return gzip_file.read(size)
+
+# ========================================================================
+def _readjson(oci_path, digest):
+    return json_loads(_readblob(oci_path, digest).decode('utf-8'))
+
+# ========================================================================
+def _snapshot(root):
+    snapshot = {}
+
+    for dir_path, dir_names, file_names in walk(root):
+        for name in dir_names + file_names:
+            path = ospath_join(dir_path, name)
+            st = lstat(path)
+            rel_path = relpath(path, root)
+
+            if S_ISLNK(st.st_mode):
+                snapshot[rel_path] = ( 'link', readlink(path) )
+            elif S_ISREG(st.st_mode):
+                with open(path, 'rb') as f:
+                    snapshot[rel_path] = ( S_IMODE(st.st_mode), int(st.st_mtime), f.read() )
+            else:
+                snapshot[rel_path] = ( S_IMODE(st.st_mode), int(st.st_mtime) )
+
+    return snapshot
+
+# ---- Initialization ----------------------------------------------------
+
+if __name__ == '__main__':
+    from unittest import main
+    main()